@@ -0,0 +1,281 @@
+import contextlib
+import logging
+import threading
+
+from .client import OpnBindClient
+from .metrics import DRIFTS
+from .reconcile import read_desired_services
+from .resilience import paced
+
+LOGGER = logging.getLogger(__name__)
+
+# Default interval in seconds between two drift audits
+DEFAULT_AUDIT_INTERVAL = 3600.0
+
+# Default maximum number of bind API requests per second an audit makes
+DEFAULT_AUDIT_RATE = 2.0
+
+# The kinds of drift between a mapping and its bind record
+DRIFT_MISSING = "missing"
+DRIFT_CHANGED = "changed"
+DRIFT_DISABLED = "disabled"
+DRIFT_ORPHANED = "orphaned"
+
+class AuditStopped(Exception):
+    """
+    Raised instead of making a bind API request once the auditor is stopped
+    """
+
+def find_drift(client : OpnBindClient, api_client, active_services, pace=None):
+    """
+    Compares the mapping labels of the tracked services with their bind records
+
+    Reads all swarm services with one listing and the records of every
+    domain in use with one bulk read. Services that are not tracked yet are
+    left to the event handling and the reconciliation.
+
+    Parameters
+    ----------
+    client : OpnBindClient
+        The bind API client
+    api_client : docker.APIClient
+        The docker API client
+    active_services : dict
+        The repository of active services
+    pace : callable
+        Called before the records of every domain are read, returns False to stop the audit
+
+    Returns
+    -------
+    list
+        The drifts, each naming the `service`, the `selector` of the mapping,
+        the `kind` of drift, the desired or tracked `record` and the bind
+        record `row` or None, if it is gone
+    """
+    desired = read_desired_services(api_client)
+    tracked = { service_id : dict(service["records"]) for service_id, service in active_services.items() }
+
+    # Read the records of all domains in use once
+    domain_names = { host_record["domain"] for host_records in desired.values() for host_record in host_records.values() }
+    domain_names.update(host_record["domain"] for records in tracked.values() for host_record in records.values() if host_record.get("domain"))
+
+    rows = { }
+    for domain_name in sorted(domain_names):
+        if pace and not pace():
+            return [ ]
+
+        domain_id = client.search_domain(domain_name)
+        if not domain_id:
+            continue
+
+        rows.update((row["uuid"], row) for row in client.list_records(domain_id))
+
+    drifts = [ ]
+    for service_id, host_records in desired.items():
+        records = tracked.get(service_id)
+        if records == None:
+            continue
+
+        for selector, host_record in host_records.items():
+            record_id = records.get(selector, { }).get("id")
+            row = rows.get(record_id) if record_id else None
+
+            if not row:
+                kind = DRIFT_MISSING
+            elif (row.get("type"), row.get("name"), row.get("value")) != (host_record["type"], host_record["host"], host_record["value"]):
+                kind = DRIFT_CHANGED
+            elif row.get("enabled", "1") != "1":
+                kind = DRIFT_DISABLED
+            else:
+                continue
+
+            drifts.append({ "service" : service_id, "selector" : selector, "kind" : kind, "record" : dict(host_record, id=record_id), "row" : row })
+
+    # Records of removed services that failed to be removed
+    for service_id, records in tracked.items():
+        if service_id in desired:
+            continue
+
+        for selector, host_record in records.items():
+            row = rows.get(host_record.get("id"))
+            if row:
+                drifts.append({ "service" : service_id, "selector" : selector, "kind" : DRIFT_ORPHANED, "record" : host_record, "row" : row })
+
+    return drifts
+
+def fix_drift(client : OpnBindClient, active_services, drift):
+    """
+    Replaces or removes a drifted bind record and tracks the result
+
+    The drift is skipped, if the tracked record changed since it was found,
+    e.g. because an event of the service was handled meanwhile. Drifted
+    records the updater did not add are never changed. Orphaned ones are
+    only released from tracking.
+
+    Returns
+    -------
+    bool
+        True, if the bind records were changed
+    """
+    service_id = drift["service"]
+    selector = drift["selector"]
+
+    service = active_services.get(service_id)
+    if not service or service["records"].get(selector, { }).get("id") != drift["record"].get("id"):
+        LOGGER.info("Skipped fixing drift of mapping %s of service %s, it changed meanwhile", selector, service_id)
+        return False
+
+    records = dict(service["records"])
+    owned = drift["row"] and client.owns(drift["row"]["uuid"])
+
+    if drift["row"] and not owned and drift["kind"] != DRIFT_ORPHANED:
+        LOGGER.warning("Left %s bind record of mapping %s of service %s as is, it was not added by the updater", drift["kind"], selector, service_id)
+        return False
+
+    if owned:
+        client.remove_record(drift["row"]["uuid"])
+    records.pop(selector, None)
+
+    if drift["kind"] != DRIFT_ORPHANED:
+        host_record = dict(drift["record"])
+        host_record["domain_id"] = client.search_domain(host_record["domain"])
+        if host_record["domain_id"]:
+            # Adopt a record recreated by hand, a later audit compares its value
+            record_id = None if drift["row"] else client.records.lookup(host_record["domain_id"], host_record["type"], host_record["host"])
+            if not record_id:
+                record_id = client.add_record(host_record["domain_id"], host_record["host"], host_record["type"], host_record["value"]).get("uuid")
+
+            host_record["id"] = record_id
+            records[selector] = host_record
+
+    if records:
+        active_services[service_id] = { "id" : service_id, "records" : records }
+    else:
+        active_services.pop(service_id, None)
+
+    if drift["kind"] == DRIFT_ORPHANED and not owned:
+        LOGGER.info("Released orphaned bind record of mapping %s of service %s, it was not added by the updater", selector, service_id)
+        return False
+
+    LOGGER.info("Fixed %s bind record of mapping %s of service %s", drift["kind"], selector, service_id)
+    return True
+
+class DriftAuditor:
+    """
+    Periodically audits the bind records of a firewall against the swarm services in the background
+
+    Drift is caused e.g. by records edited in the OPNSense GUI or by removals
+    that failed for good. The auditor either reports the drift or fixes it.
+    It yields to the live event handling: it only reads a domain or fixes a
+    drift while `idle` holds and never makes more than `rate` bind API
+    requests per second, retries and paged reads included.
+
+    Parameters
+    ----------
+    name : str
+        The name of the firewall used in logs and metrics
+    client : OpnBindClient
+        The bind API client
+    api_client : docker.APIClient
+        The docker API client
+    active_services : dict
+        The repository of active services of the firewall
+    interval : float
+        The time in seconds between two audits
+    fix : bool
+        True to fix the drift, False to only report it
+    rate : float
+        The maximum number of bind API requests per second
+    idle : callable
+        Returns True, if no live events are waiting to be processed
+    reconfigure : callable
+        Requests a bind reconfigure after the drift was fixed
+    ordered : callable
+        Returns the lock ordering a fix with the events of a service
+    """
+
+    def __init__(self, name, client : OpnBindClient, api_client, active_services, interval=DEFAULT_AUDIT_INTERVAL, fix=False, rate=DEFAULT_AUDIT_RATE, idle=None, reconfigure=None, ordered=None):
+        self.name = name
+        self.client = client
+        self.api_client = api_client
+        self.active_services = active_services
+        self.interval = interval
+        self.fix = fix
+        self.rate = rate
+        self.idle = idle or (lambda: True)
+        self.reconfigure = reconfigure or client.reconfigure
+        self.ordered = ordered or (lambda service_id: contextlib.nullcontext())
+
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="drift-auditor-{}".format(name), daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def audit(self):
+        """
+        Audits the bind records once and reports or fixes the drift
+
+        Returns
+        -------
+        list
+            The drifts found
+        """
+        with paced(self._throttle):
+            try:
+                drifts = find_drift(self.client, self.api_client, self.active_services, pace=self._pace)
+            except AuditStopped:
+                return [ ]
+
+        for drift in drifts:
+            DRIFTS.inc(target=self.name, kind=drift["kind"])
+            LOGGER.warning("Found %s bind record of mapping %s of service %s on firewall %s: %s", drift["kind"], drift["selector"], drift["service"], self.name, drift["row"] or drift["record"])
+
+        if not self.fix:
+            return drifts
+
+        fixed = 0
+        for drift in drifts:
+            if not self._pace():
+                break
+
+            try:
+                # Never interleave with an event of the service being handled
+                with self.ordered(drift["service"]), paced(self._throttle):
+                    if fix_drift(self.client, self.active_services, drift):
+                        fixed += 1
+            except AuditStopped:
+                break
+            except Exception as ex:
+                LOGGER.error("Failed to fix %s bind record of mapping %s of service %s: %s", drift["kind"], drift["selector"], drift["service"], ex)
+
+        if fixed:
+            self.reconfigure()
+
+        return drifts
+
+    def close(self):
+        self.stopped.set()
+        if self.thread.is_alive():
+            self.thread.join()
+
+    def _pace(self):
+        # Wait until no events are waiting before the next step of the audit
+        while not self.idle():
+            if self.stopped.wait(1.0 / self.rate):
+                return False
+
+        return not self.stopped.is_set()
+
+    def _throttle(self):
+        # Every bind API request of the audit waits for a free slot of the rate limit
+        if self.stopped.wait(1.0 / self.rate):
+            raise AuditStopped("Stopped the audit of firewall {}".format(self.name))
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.audit()
+            except Exception as ex:
+                LOGGER.error("Failed to audit bind records of firewall %s: %s", self.name, ex)
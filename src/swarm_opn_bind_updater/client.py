@@ -0,0 +1,774 @@
+import logging
+import threading
+import time
+
+import requests
+
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+from .metrics import API_SECONDS, API_ERRORS, API_RETRIES
+from .eventlog import count_api_call
+from .resilience import BindApiError, CircuitBreaker, RETRYABLE_STATUS_CODES, DEFAULT_RETRIES, DEFAULT_BACKOFF, backoff_delay, is_retryable, pace_request
+
+LOGGER = logging.getLogger(__name__)
+
+# Default number of pooled keep-alive connections per firewall
+DEFAULT_POOL_SIZE = 4
+
+# Default timeout in seconds for a single bind API call
+DEFAULT_TIMEOUT = 30.0
+
+# Default time in seconds the domain index is trusted before it is refreshed
+DEFAULT_DOMAIN_TTL = 300.0
+
+# Default number of records read per searchRecord page
+DEFAULT_PAGE_SIZE = 500
+
+# Default time in seconds the record index of a domain is trusted before it is refreshed
+DEFAULT_RECORD_TTL = 300.0
+
+class DomainIndex:
+    """
+    In-process index of the bind domains
+
+    Maps domain names to their uuid and enabled flag. The index is loaded
+    with a single domain fetch and trusted for `ttl` seconds. A lookup for
+    an unknown name forces one refresh, so newly created domains are found
+    without waiting for the TTL to expire.
+
+    Parameters
+    ----------
+    fetch : callable
+        Returns the domain payload of the bind API, i.e. a dict of domain id
+        to domain attributes
+    ttl : float
+        The time in seconds the index is trusted
+    """
+
+    def __init__(self, fetch, ttl=DEFAULT_DOMAIN_TTL):
+        self.fetch = fetch
+        self.ttl = ttl
+        self.domains = { }
+        self.loaded_at = None
+        self.lock = threading.Lock()
+
+    def invalidate(self):
+        """
+        Drops the index, so the next lookup fetches the domains again
+        """
+        with self.lock:
+            self.domains = { }
+            self.loaded_at = None
+
+    def refresh(self):
+        """
+        Fetches the domains and rebuilds the index
+        """
+        domains = { }
+        for domain_id, domain in self.fetch().items():
+            name = domain["domainname"]
+            enabled = domain["enabled"] == "1"
+
+            # Prefer an enabled domain over a disabled one with the same name
+            if name in domains and domains[name][1]:
+                continue
+
+            domains[name] = (domain_id, enabled)
+
+        with self.lock:
+            self.domains = domains
+            self.loaded_at = time.monotonic()
+
+    def lookup(self, domain_name):
+        """
+        Looks up a domain by its name
+
+        Parameters
+        ----------
+        domain_name : str
+            The name of the domain to look up
+
+        Returns
+        -------
+        tuple
+            The domain id and enabled flag or None, if the domain is unknown
+        """
+        refreshed = False
+        if self._expired():
+            self.refresh()
+            refreshed = True
+
+        entry = self.domains.get(domain_name)
+        if not entry and not refreshed:
+            self.refresh()
+            entry = self.domains.get(domain_name)
+
+        return entry
+
+    def _expired(self):
+        with self.lock:
+            return self.loaded_at == None or time.monotonic() - self.loaded_at >= self.ttl
+
+class RecordIndex:
+    """
+    In-process index of the bind records
+
+    The records of a domain are read once page by page and indexed by
+    (domain id, record type, record name), so lookups cost O(1). The index
+    is updated incrementally on our own adds and removes, trusted for `ttl`
+    seconds per domain and can be refreshed explicitly. The records are read
+    without holding the lock, so a refresh does not block the lookups of
+    other workers. Concurrent loads of the same domain share a single read.
+
+    Parameters
+    ----------
+    fetch : callable
+        Returns all record rows of a domain id
+    ttl : float
+        The time in seconds the records of a domain are trusted
+    """
+
+    def __init__(self, fetch, ttl=DEFAULT_RECORD_TTL):
+        self.fetch = fetch
+        self.ttl = ttl
+        self.records = { }
+        self.names = { }
+        self.keys = { }
+        self.loaded_at = { }
+        self.lock = threading.RLock()
+
+        # Reads in progress per domain and the own changes made meanwhile
+        self.loading = { }
+        self.changes = { }
+
+    def invalidate(self, domain_id=None):
+        """
+        Drops the records of a domain or of all domains
+
+        Parameters
+        ----------
+        domain_id : str
+            The id of the domain to drop or None for all domains
+        """
+        with self.lock:
+            if domain_id == None:
+                self.loaded_at.clear()
+            else:
+                self.loaded_at.pop(domain_id, None)
+
+    def refresh(self, domain_id):
+        """
+        Reads all records of a domain and rebuilds its part of the index
+
+        Parameters
+        ----------
+        domain_id : str
+            The id of the domain to read
+        """
+        changes = [ ]
+        with self.lock:
+            self.changes.setdefault(domain_id, [ ]).append(changes)
+
+        try:
+            rows = self.fetch(domain_id)
+        finally:
+            with self.lock:
+                self.changes[domain_id].remove(changes)
+                if not self.changes[domain_id]:
+                    del self.changes[domain_id]
+
+        with self.lock:
+            for key, uuid in list(self.records.items()):
+                if key[0] == domain_id:
+                    self._discard(uuid)
+
+            for row in rows:
+                self._add(domain_id, row["type"], row["name"], row["uuid"])
+
+            # Replay our own changes the rows read may not include yet
+            for change in changes:
+                if change[0] == "add":
+                    self._add(*change[1:])
+                else:
+                    self._discard(change[1])
+
+            self.loaded_at[domain_id] = time.monotonic()
+
+    def lookup(self, domain_id, record_type, record_name):
+        """
+        Looks up a record by its domain id, type and name
+
+        Returns
+        -------
+        str
+            The record id or None, if the record could not be found
+        """
+        self._load(domain_id)
+        return self.records.get((domain_id, record_type, record_name))
+
+    def lookup_name(self, domain_id, record_name):
+        """
+        Looks up all records with the given name in a domain
+
+        Returns
+        -------
+        dict
+            The record ids keyed by record type
+        """
+        self._load(domain_id)
+        return dict(self.names.get((domain_id, record_name), { }))
+
+    def add(self, domain_id, record_type, record_name, uuid, loaded=False):
+        """
+        Adds a record to the index, if the records of its domain are loaded
+        """
+        with self.lock:
+            for changes in self.changes.get(domain_id, [ ]):
+                changes.append(("add", domain_id, record_type, record_name, uuid))
+
+            if loaded or domain_id in self.loaded_at:
+                self._add(domain_id, record_type, record_name, uuid)
+
+    def discard(self, uuid):
+        """
+        Removes a record from the index
+        """
+        with self.lock:
+            # The domain of a record not indexed yet is unknown, so every read in progress learns of it
+            key = self.keys.get(uuid)
+            pending = self.changes.get(key[0], [ ]) if key else [ changes for domain_changes in self.changes.values() for changes in domain_changes ]
+            for changes in pending:
+                changes.append(("discard", uuid))
+
+            self._discard(uuid)
+
+    def _add(self, domain_id, record_type, record_name, uuid):
+        key = (domain_id, record_type, record_name)
+        self.records[key] = uuid
+        self.names.setdefault((domain_id, record_name), { })[record_type] = uuid
+        self.keys[uuid] = key
+
+    def _discard(self, uuid):
+        key = self.keys.pop(uuid, None)
+        if not key:
+            return
+
+        domain_id, record_type, record_name = key
+        if self.records.get(key) == uuid:
+            del self.records[key]
+
+        types = self.names.get((domain_id, record_name), { })
+        if types.get(record_type) == uuid:
+            del types[record_type]
+        if not types:
+            self.names.pop((domain_id, record_name), None)
+
+    def _load(self, domain_id):
+        while True:
+            with self.lock:
+                loaded_at = self.loaded_at.get(domain_id)
+                if loaded_at != None and time.monotonic() - loaded_at < self.ttl:
+                    return
+
+                loading = self.loading.get(domain_id)
+                if loading == None:
+                    loading = self.loading[domain_id] = threading.Event()
+                    break
+
+            # Wait for the read of another worker, retry if it failed
+            loading.wait()
+
+        try:
+            self.refresh(domain_id)
+        finally:
+            with self.lock:
+                del self.loading[domain_id]
+            loading.set()
+
+class OpnBindClient:
+    """
+    Client for the OPNSense bind API
+
+    The client owns a pooled `requests.Session`, so consecutive calls to the
+    same firewall reuse keep-alive connections instead of paying a TCP and TLS
+    handshake per call. Authentication and timeouts are set once.
+
+    Parameters
+    ----------
+    api_key : str
+        The API key used for authentication
+    api_secret : str
+        The API secret used for authentication
+    api_gw_url : str
+        The base URL for accessing the OPNSense API. This is an URL without path
+        Example: "https://fw.example.org"
+    pool_size : int
+        The maximum number of keep-alive connections kept open to the firewall
+    timeout : float
+        The timeout in seconds for a single API call
+    domain_ttl : float
+        The time in seconds the domain index is trusted before it is refreshed
+    record_ttl : float
+        The time in seconds the record index of a domain is trusted before it is refreshed
+    retries : int
+        The number of retries of a call failing with a retryable error
+    backoff : float
+        The base delay in seconds of the jittered exponential backoff between retries
+    breaker : CircuitBreaker
+        The circuit breaker pausing calls while the firewall is down
+    owned : MutableMapping
+        The index of the records added by this client keyed by record id,
+        e.g. a persisted `ServiceRepository`. Defaults to an in-memory dict.
+    """
+
+    def __init__(self, api_key, api_secret, api_gw_url, pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT, domain_ttl=DEFAULT_DOMAIN_TTL, record_ttl=DEFAULT_RECORD_TTL, retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF, breaker=None, owned=None):
+        self.api_gw_url = api_gw_url
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.breaker = breaker or CircuitBreaker()
+        self.domains = DomainIndex(self.fetch_domains, ttl=domain_ttl)
+        self.records = RecordIndex(self.list_records, ttl=record_ttl)
+        self.owned = owned if owned != None else { }
+
+        self.session = requests.Session()
+        self.session.auth = (api_key, api_secret)
+
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """
+        Closes all pooled connections of the client
+        """
+        self.session.close()
+
+    def reconfigure(self):
+        """
+        Instructs the bind service to reload its configuration
+
+        Returns
+        -------
+        dict
+            The result returned by the bind API
+
+        Raises
+        ------
+        BindApiError
+            If an error occoured accessing the bind API
+        """
+        response = self._post("/api/bind/service/reconfigure", { })
+
+        if response.status_code != 200:
+            _handle_response(response, "Failed to reconfigure bind service")
+
+        result = response.json()
+        if result["status"] != "ok":
+            raise BindApiError("Bind service responded with unexpected result : {}".format(result))
+
+        return result
+
+    def fetch_domains(self):
+        """
+        Reads all domains from the bind API
+
+        Returns
+        -------
+        dict
+            The domains keyed by their domain id
+        """
+        response = self._get("/api/bind/domain/get")
+
+        if response.status_code != 200:
+            _handle_response(response, "Failed to read domains")
+
+        payload = response.json()
+        return payload["domain"]["domains"]["domain"]
+
+    def search_domain(self, domain_name):
+        """
+        Searches the bind api for a domain by its name
+
+        The domain is looked up in the domain index of the client, so the
+        domains are only fetched when the index is expired or the name is
+        unknown.
+
+        Parameters
+        -----------
+        domain_name : str
+            The name of the domain to search for.
+            Example: "example.org"
+
+        Returns
+        -------
+        str
+            The domain id or None, if the domain could not be found
+        """
+        entry = self.domains.lookup(domain_name)
+        if not entry:
+            return None
+
+        domain_id, enabled = entry
+        if not enabled:
+            LOGGER.warning("Domain %s is not enabled", domain_name)
+            return None
+
+        return domain_id
+
+    def search_record(self, domain_name, record_type, record_name):
+        """
+        Searches the bind API for a record matching domain name, record type and record name
+
+        The record is looked up in the record index of the client, which reads
+        all records of the domain once.
+
+        Parameters
+        ----------
+        domain_name : str
+            The domain to search for
+        record_type : str
+            The record type to search for.
+            Example: "A", "PTR, "CNAME", etc.
+        record_name : str
+            The name to search for
+
+        Returns
+        -------
+        str
+            The record id or None, if the record could not be found
+        """
+        domain_id = self.search_domain(domain_name)
+        if not domain_id:
+            return None
+
+        uuid = self.records.lookup(domain_id, record_type, record_name)
+        if not uuid:
+            types = self.records.lookup_name(domain_id, record_name)
+            if not types:
+                return None
+
+            # Keep the previous behaviour of matching on the name only
+            type, uuid = next(iter(types.items()))
+            LOGGER.warning("Record %s is already mapped to record type %s", record_name, type)
+
+        LOGGER.debug("Record %s has uuid %s", record_name, uuid)
+        return uuid
+
+    def list_records(self, domain_id=None, page_size=DEFAULT_PAGE_SIZE):
+        """
+        Reads all records from the bind API page by page
+
+        Parameters
+        ----------
+        domain_id : str
+            The id of the domain to read the records of or None for all records
+        page_size : int
+            The number of records read per request
+
+        Returns
+        -------
+        list
+            The record rows as returned by the bind API
+        """
+        rows = [ ]
+        current = 1
+
+        while True:
+            request_payload = {
+                "current" : current,
+                "rowCount" : page_size,
+                "sort" : { },
+                "searchPhrase" : ""
+            }
+            if domain_id:
+                request_payload["domain"] = domain_id
+
+            response = self._post("/api/bind/record/searchRecord", request_payload)
+
+            if response.status_code != 200:
+                _handle_response(response, "Failed to list records of domain {}".format(domain_id))
+
+            response_payload = response.json()
+            page = response_payload["rows"]
+            rows.extend(page)
+
+            if len(page) < page_size or len(rows) >= int(response_payload.get("total", len(rows))):
+                return rows
+
+            current += 1
+
+    def add_record(self, domain_id, name, record_type, value):
+        """
+        Add a new record to the bind dns database via bind API
+
+        Parameters
+        ----------
+        domain_id : str
+            The id of the domain this record should be added to
+        name
+            The name of the newly created record
+        record_type
+            The type of the newly created record
+        value
+            The value of the newly created record
+
+        Raises
+        ------
+        BindApiError
+            If an error occoured accessing the bind API
+        """
+        payload = _create_record_payload(domain_id, name, record_type, value)
+
+        attempt = 0
+        while True:
+            try:
+                response = self._post("/api/bind/record/addRecord", payload)
+                if response.status_code != 200:
+                    _handle_response(response, "Failed to add host")
+                break
+
+            except BindApiError as ex:
+                # Rejected requests were retried already
+                if not is_retryable(ex) or ex.status_code == 429:
+                    raise
+
+                # The record may have been added nonetheless, so it is only sent again, if a fresh read does not find it
+                self.records.invalidate(domain_id)
+                if attempt >= self.retries or self.breaker.is_open():
+                    raise
+
+                time.sleep(backoff_delay(attempt, self.backoff))
+                attempt += 1
+
+                record_id = self.records.lookup(domain_id, record_type, name)
+                if record_id:
+                    LOGGER.info("Found bind record %s added by a failed request", record_id)
+                    self.owned[record_id] = { "domain_id" : domain_id, "name" : name, "type" : record_type }
+                    return { "result" : "saved", "uuid" : record_id }
+
+        result = response.json()
+        if result["result"] != "saved":
+            raise BindApiError("Failed to add host \"{}\" to domain id \"{}\" : {}".format(name, domain_id, result))
+
+        if result.get("uuid"):
+            self.records.add(domain_id, record_type, name, result["uuid"])
+            self.owned[result["uuid"]] = { "domain_id" : domain_id, "name" : name, "type" : record_type }
+
+        return result
+
+    def remove_record(self, record_id):
+        """
+        Remove a record from the bind dns database via bind API
+
+        Parameters
+        ----------
+        record_id : str
+            The id of the record to be deleted
+
+        Raises
+        ------
+        BindApiError
+            If an error occoured accessing the bind API
+        """
+        response = self._post("".join(["/api/bind/record/delRecord/", record_id]), { })
+
+        if response.status_code != 200:
+            _handle_response(response, "Failed to remove host")
+
+        result = response.json()
+        if result["result"] != "deleted":
+            raise BindApiError("Failed to remove host: {}".format(result))
+
+        self.records.discard(record_id)
+        self.owned.pop(record_id, None)
+
+        return result
+
+    def owns(self, record_id):
+        """
+        Returns True, if the record was added by the updater
+
+        Records the updater adopted, e.g. records created by hand, are not
+        owned and must never be changed or removed by the updater.
+        """
+        return record_id in self.owned
+
+    def list_owned_records(self, domain_id=None):
+        """
+        Reads the records added by the updater in one pass over the records of a domain
+
+        Parameters
+        ----------
+        domain_id : str
+            The id of the domain to read the records of or None for all records
+
+        Returns
+        -------
+        list
+            The record rows as returned by the bind API
+        """
+        return [ row for row in self.list_records(domain_id) if row["uuid"] in self.owned ]
+
+    def remove_host_by_domain_and_name(self, domain_name, record_name, record_type):
+        """
+        Remove a record identified by its domain name, record name and record type
+
+        Parameters
+        ----------
+        domain_name : str
+            The domain name the record is assigned to
+        record_name : str
+            The name of the record to be deleted
+        record_type : str
+            The type of the record to be deleted
+
+        Raises
+        ------
+        BindApiError
+            If an error occoured accessing the bind API
+        """
+        domain_id = self.search_domain(domain_name)
+        if domain_id == None:
+            raise BindApiError("Domain \"{}\" unknown or not enabled".format(domain_name))
+
+        record_id = self.search_record(domain_name, record_type, record_name)
+        if record_id == None:
+            raise BindApiError("Record \"{}\" with type \"{}\" not found under domain \"{}\"".format(record_name, record_type, domain_name))
+
+        return self.remove_record(record_id)
+
+    def _get(self, path):
+        return self._request("GET", path)
+
+    def _post(self, path, payload):
+        # Adding a record twice creates a duplicate, so only retry it when it was not sent or rejected
+        idempotent = not path.startswith("/api/bind/record/addRecord")
+        return self._request("POST", path, payload, idempotent=idempotent)
+
+    def _request(self, method, path, payload=None, idempotent=True):
+        url = "".join([self.api_gw_url, path])
+
+        # Label metrics by controller and action, without record ids
+        endpoint = "/".join(path.split("/")[3:5])
+
+        attempt = 0
+        while True:
+            pace_request()
+            self.breaker.before_call()
+            count_api_call()
+
+            try:
+                with API_SECONDS.time(endpoint=endpoint):
+                    response = self.session.request(method, url, json=payload, timeout=self.timeout)
+
+            except requests.RequestException as ex:
+                API_ERRORS.inc(endpoint=endpoint)
+                self.breaker.record_failure()
+
+                if (not idempotent and not _not_connected(ex)) or attempt >= self.retries or self.breaker.is_open():
+                    raise BindApiError("Failed to call {}: {}".format(endpoint, ex), retryable=True) from ex
+
+            except Exception:
+                # Never leave a trial call of the breaker pending
+                API_ERRORS.inc(endpoint=endpoint)
+                self.breaker.record_failure()
+                raise
+
+            else:
+                if response.status_code != 200:
+                    API_ERRORS.inc(endpoint=endpoint)
+
+                if response.status_code not in RETRYABLE_STATUS_CODES:
+                    self.breaker.record_success()
+                    return response
+
+                self.breaker.record_failure()
+
+                # A gateway error may follow a request the firewall carried out, only a rejected one is safe to send again
+                if (not idempotent and response.status_code != 429) or attempt >= self.retries or self.breaker.is_open():
+                    return response
+
+            API_RETRIES.inc(endpoint=endpoint)
+            time.sleep(backoff_delay(attempt, self.backoff))
+            attempt += 1
+
+def _not_connected(ex):
+    """
+    Returns True, if a request failed before the connection was established, so it was not sent
+    """
+    if isinstance(ex, requests.ConnectTimeout):
+        return True
+
+    # Requests wraps the error of urllib3 and the reason of its retries
+    reason = ex.args[0] if ex.args else None
+    return isinstance(getattr(reason, "reason", reason), NewConnectionError)
+
+# Repository for shared clients, keyed by credentials and base URL
+CLIENTS = { }
+CLIENTS_LOCK = threading.Lock()
+
+def get_client(api_key, api_secret, api_gw_url, **options):
+    """
+    Returns the shared client for the given credentials and base URL
+
+    The client is created on first use. The options, e.g. pool size, timeout
+    and cache TTLs, are passed to `OpnBindClient` and only apply when the
+    client is created. The option `client_class` replaces `OpnBindClient`,
+    e.g. with a client planning changes in a dry run.
+
+    Returns
+    -------
+    OpnBindClient
+        The shared client
+    """
+    key = (api_key, api_secret, api_gw_url)
+
+    with CLIENTS_LOCK:
+        client = CLIENTS.get(key)
+        if not client:
+            client_class = options.pop("client_class", OpnBindClient)
+            client = client_class(api_key, api_secret, api_gw_url, **options)
+            CLIENTS[key] = client
+            LOGGER.debug("Created bind client for %s", api_gw_url)
+
+    return client
+
+def close_clients():
+    """
+    Closes and forgets all shared clients
+    """
+    with CLIENTS_LOCK:
+        for client in CLIENTS.values():
+            client.close()
+        CLIENTS.clear()
+
+def _create_record_payload(domain_id, name, type, value):
+    return {
+        "record" : {
+            "enabled" : "1",
+            "domain"  : domain_id,
+            "name"    : name,
+            "type"    : type,
+            "value"   : value
+        }
+    }
+
+def _handle_response(response : requests.Response, message):
+    retryable = response.status_code in RETRYABLE_STATUS_CODES
+
+    if not 'application/json' in response.headers.get('Content-Type', ''):
+        if response.text != None and response.text != "":
+            raise BindApiError("{} - {}: {}".format(response.status_code, message, response.text), response.status_code, retryable)
+        else:
+            raise BindApiError("{} - {}".format(response.status_code, message), response.status_code, retryable)
+
+    raise BindApiError("{} - {}: {}".format(response.status_code, message, response.json()), response.status_code, retryable)
@@ -0,0 +1,215 @@
+import contextvars
+import hashlib
+import json
+import logging
+import time
+import uuid
+
+from contextlib import contextmanager
+
+LOGGER = logging.getLogger(__name__)
+
+# The stages of processing an event that are timed
+STAGE_INSPECT = "inspect"
+STAGE_LOOKUP = "lookup"
+STAGE_ADD = "add"
+STAGE_REMOVE = "remove"
+STAGE_RECONFIGURE = "reconfigure"
+
+# The log formats
+LOG_FORMAT_TEXT = "text"
+LOG_FORMAT_JSON = "json"
+
+# The trace of the event processed by the current thread or task
+CURRENT_TRACE = contextvars.ContextVar("event_trace", default=None)
+
+class EventTrace:
+    """
+    Collects what processing a single docker event did
+
+    Parameters
+    ----------
+    action : str
+        The action of the event, e.g. "create"
+    service_id : str
+        The id of the service the event belongs to
+    target : str
+        The name of the firewall the event is applied to or None
+    correlation_id : str
+        The id shared by the traces of one docker event on all firewalls, random if None
+    """
+
+    def __init__(self, action, service_id, target=None, correlation_id=None):
+        self.correlation_id = correlation_id or uuid.uuid4().hex[:16]
+        self.action = action
+        self.service_id = service_id
+        self.target = target
+
+        self.result = "applied"
+        self.api_calls = 0
+        self.records = [ ]
+        self.stages = { }
+        self.started = time.perf_counter()
+        self.duration = None
+
+    def add_stage(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def to_dict(self):
+        """
+        Returns the trace as a dict with durations in milliseconds
+        """
+        return {
+            "correlation_id" : self.correlation_id,
+            "action" : self.action,
+            "service" : self.service_id,
+            "target" : self.target,
+            "result" : self.result,
+            "records" : list(self.records),
+            "api_calls" : self.api_calls,
+            "duration_ms" : round((self.duration or 0.0) * 1000, 3),
+            "stages_ms" : { stage : round(seconds * 1000, 3) for stage, seconds in self.stages.items() }
+        }
+
+def event_correlation_id(event):
+    """
+    Derives the correlation id of a docker event from its service and time
+
+    Every firewall the event is applied to derives the same id, so the event
+    can be followed across firewalls.
+    """
+    key = "{}:{}:{}".format(event["Actor"]["ID"], event.get("timeNano"), event.get("Action"))
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+
+def current_trace():
+    """
+    Returns the trace of the event processed by the caller or None
+    """
+    return CURRENT_TRACE.get()
+
+@contextmanager
+def trace_event(action, service_id, target=None, correlation_id=None):
+    """
+    Traces the processing of an event and logs it as one line when done
+
+    Yields
+    ------
+    EventTrace
+        The trace, also returned by `current_trace` within the block
+    """
+    trace = EventTrace(action, service_id, target, correlation_id)
+    token = CURRENT_TRACE.set(trace)
+    try:
+        yield trace
+    except BaseException:
+        trace.result = "failed"
+        raise
+    finally:
+        CURRENT_TRACE.reset(token)
+        trace.duration = time.perf_counter() - trace.started
+
+        # The trace is only turned into a dict by the JSON formatter
+        if LOGGER.isEnabledFor(logging.INFO):
+            LOGGER.info("Processed %s event of service %s: %s, %d records, %d bind API calls in %.1f ms", trace.action, trace.service_id, trace.result, len(trace.records), trace.api_calls, trace.duration * 1000, extra={ "event" : trace })
+
+@contextmanager
+def stage(name):
+    """
+    Adds the duration of the enclosed block to a stage of the current trace
+    """
+    trace = CURRENT_TRACE.get()
+    if trace == None:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add_stage(name, time.perf_counter() - start)
+
+def count_api_call():
+    """
+    Counts a bind API request of the current trace
+    """
+    trace = CURRENT_TRACE.get()
+    if trace != None:
+        trace.api_calls += 1
+
+def record_touched(change, host_record):
+    """
+    Notes a bind record added, removed or released by the current trace
+
+    Parameters
+    ----------
+    change : str
+        What happened to the record, e.g. "added"
+    host_record : dict
+        The host record
+    """
+    trace = CURRENT_TRACE.get()
+    if trace != None:
+        trace.records.append({ "change" : change, "type" : host_record.get("type"), "host" : host_record.get("host"), "domain" : host_record.get("domain"), "id" : host_record.get("id") })
+
+def log_reconfigure(seconds, pending, correlation_ids, failed=False):
+    """
+    Logs a bind reconfigure along with the events it was requested by
+    """
+    if LOGGER.isEnabledFor(logging.INFO):
+        LOGGER.info("Reconfigure of bind service for %d requests %s in %.1f ms", pending, "failed" if failed else "done", seconds * 1000, extra={ "reconfigure" : {
+            "stage" : STAGE_RECONFIGURE,
+            "result" : "failed" if failed else "applied",
+            "requests" : pending,
+            "correlation_ids" : list(correlation_ids),
+            "duration_ms" : round(seconds * 1000, 3)
+        } })
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats log records as single JSON lines
+
+    Lines logged while an event is processed carry its correlation id. The
+    line logged once an event is done holds the whole trace.
+    """
+
+    def format(self, record):
+        payload = {
+            "time" : self.formatTime(record),
+            "level" : record.levelname,
+            "logger" : record.name,
+            "message" : record.getMessage()
+        }
+
+        trace = getattr(record, "event", None) or CURRENT_TRACE.get()
+        if trace != None:
+            if hasattr(record, "event"):
+                payload.update(trace.to_dict())
+            else:
+                payload["correlation_id"] = trace.correlation_id
+
+        if hasattr(record, "reconfigure"):
+            payload.update(record.reconfigure)
+
+        if record.exc_info:
+            payload["exception"] = self.formatException(record.exc_info)
+
+        return json.dumps(payload, default=str)
+
+def configure_logging(log_format=LOG_FORMAT_TEXT, level=logging.INFO):
+    """
+    Configures the root logger to log plain text or one JSON line per record
+
+    Raises
+    ------
+    ValueError
+        If the log format is unknown
+    """
+    match log_format:
+        case "text":
+            logging.basicConfig(level=level, force=True)
+        case "json":
+            handler = logging.StreamHandler()
+            handler.setFormatter(JsonFormatter())
+            logging.basicConfig(level=level, handlers=[ handler ], force=True)
+        case _:
+            raise ValueError("Unknown log format {}, expected text or json".format(log_format))
@@ -0,0 +1,273 @@
+import collections
+import json
+import logging
+import os
+import threading
+import time
+
+from .resilience import backoff_delay
+
+LOGGER = logging.getLogger(__name__)
+
+# Default base and maximum delay in seconds between two reconnects
+DEFAULT_RECONNECT_BACKOFF = 1.0
+DEFAULT_RECONNECT_MAX_BACKOFF = 30.0
+
+# Number of recent events remembered to drop duplicates after a reconnect
+DEFAULT_DEDUPLICATION_WINDOW = 1024
+
+# Minimum time in seconds between two writes of the cursor file
+DEFAULT_SAVE_INTERVAL = 1.0
+
+def _event_key(event):
+    return (event.get("timeNano"), event.get("Action"), event.get("Actor", { }).get("ID"))
+
+class EventCursor:
+    """
+    Position in the docker event stream
+
+    Tracks the `timeNano` of the events read and of the events whose
+    processing finished. The read position is used to resume the stream
+    after a reconnect. The processed position is the newest point in time up
+    to which all events were processed, and is persisted to a file, so a
+    restarted daemon resumes where it stopped.
+
+    Parameters
+    ----------
+    path : str
+        The file the processed position is persisted to or None to keep it in memory
+    save_interval : float
+        The minimum time in seconds between two writes of the file
+    """
+
+    def __init__(self, path=None, save_interval=DEFAULT_SAVE_INTERVAL):
+        self.path = path
+        self.save_interval = save_interval
+
+        self.last_read = None
+        self.last_done = None
+        self.in_flight = collections.Counter()
+        self.saved_at = 0.0
+        self.lock = threading.Lock()
+
+        # Workers finish events concurrently, but the file is written by one at a time
+        self.save_lock = threading.Lock()
+
+    def load(self):
+        """
+        Reads the persisted position
+
+        Returns
+        -------
+        int
+            The persisted position in nanoseconds or None
+        """
+        if not self.path or not os.path.exists(self.path):
+            return None
+
+        with open(self.path, "r", encoding="utf-8") as cursor:
+            try:
+                position = int(cursor.read().strip())
+            except ValueError:
+                LOGGER.warning("Ignoring invalid event cursor in %s", self.path)
+                return None
+
+        with self.lock:
+            self.last_read = position
+            self.last_done = position
+
+        LOGGER.info("Resuming docker events from %d", position)
+        return position
+
+    def read(self, event, count=1):
+        """
+        Records an event as read, but not yet processed
+
+        Parameters
+        ----------
+        event : dict
+            The decoded docker event
+        count : int
+            The number of times the event will be reported as done, e.g. once per firewall
+        """
+        time_nano = event.get("timeNano")
+        if time_nano == None:
+            return
+
+        with self.lock:
+            self.last_read = max(self.last_read or 0, time_nano)
+            self.in_flight[time_nano] += count
+
+    def done(self, event):
+        """
+        Records an event as processed and persists the position, if due
+        """
+        time_nano = event.get("timeNano")
+        if time_nano == None:
+            return
+
+        with self.lock:
+            self.in_flight[time_nano] -= 1
+            if self.in_flight[time_nano] <= 0:
+                del self.in_flight[time_nano]
+
+            self.last_done = max(self.last_done or 0, time_nano)
+            due = time.monotonic() - self.saved_at >= self.save_interval
+
+        # The event was processed, failing to persist the position only delays the cursor
+        if due:
+            try:
+                self.save()
+            except OSError as ex:
+                LOGGER.warning("Failed to save event cursor to %s: %s", self.path, ex)
+
+    def processed(self):
+        """
+        Returns the newest position up to which all events were processed
+        """
+        with self.lock:
+            if self.in_flight:
+                return min(self.in_flight) - 1
+
+            return self.last_done
+
+    def save(self):
+        """
+        Atomically writes the processed position to the cursor file
+        """
+        if not self.path:
+            return
+
+        # Read the position while saving, so an older one never replaces a newer one
+        with self.save_lock:
+            position = self.processed()
+            if position == None:
+                return
+
+            temporary_path = self.path + ".tmp"
+            with open(temporary_path, "w", encoding="utf-8") as cursor:
+                cursor.write(str(position))
+
+            os.replace(temporary_path, self.path)
+
+            with self.lock:
+                self.saved_at = time.monotonic()
+
+def since_parameter(position):
+    """
+    Formats a position in nanoseconds as `since` parameter of the docker events API
+    """
+    return "{}.{:09d}".format(position // 1000000000, position % 1000000000)
+
+class ResumableEventStream:
+    """
+    Docker event stream that reconnects and resumes after failures
+
+    Whenever the underlying stream fails or ends, it is reopened after a
+    jittered exponential backoff with `since` set to the last event read.
+    Events delivered again after reopening are dropped.
+
+    Parameters
+    ----------
+    open_stream : callable
+        Opens the raw docker event stream, receiving the `since` parameter or None
+    cursor : EventCursor
+        The cursor tracking the position in the stream
+    backoff : float
+        The base delay in seconds between two reconnects
+    max_backoff : float
+        The maximum delay in seconds between two reconnects
+    """
+
+    def __init__(self, open_stream, cursor, backoff=DEFAULT_RECONNECT_BACKOFF, max_backoff=DEFAULT_RECONNECT_MAX_BACKOFF, window=DEFAULT_DEDUPLICATION_WINDOW):
+        self.open_stream = open_stream
+        self.cursor = cursor
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self.recent = collections.deque(maxlen=window)
+        self.recent_keys = set()
+
+        self.stream = None
+        self.closed = threading.Event()
+        self.reconnects = 0
+        self.duplicates = 0
+
+        self._open()
+
+    def close(self):
+        """
+        Closes the stream, ending the iteration
+        """
+        self.closed.set()
+
+        stream = self.stream
+        if stream:
+            stream.close()
+
+    def __iter__(self):
+        attempt = 0
+
+        while not self.closed.is_set():
+            try:
+                if self.stream == None:
+                    self._open()
+
+                for raw_event in self.stream:
+                    event = json.loads(raw_event)
+                    attempt = 0
+
+                    if self._is_duplicate(event):
+                        self.duplicates += 1
+                        continue
+
+                    self.cursor.read(event)
+                    yield event
+
+                LOGGER.warning("Docker event stream ended")
+
+            except Exception as ex:
+                if self.closed.is_set():
+                    return
+
+                LOGGER.warning("Docker event stream failed: %s", ex)
+
+            self._discard()
+            if self.closed.wait(backoff_delay(attempt, self.backoff, self.max_backoff)):
+                return
+
+            attempt += 1
+            self.reconnects += 1
+
+    def _open(self):
+        position = self.cursor.last_read
+        since = since_parameter(position) if position != None else None
+
+        self.stream = self.open_stream(since)
+        LOGGER.info("Opened docker event stream since %s", since)
+
+    def _discard(self):
+        stream, self.stream = self.stream, None
+        if stream:
+            try:
+                stream.close()
+            except Exception as ex:
+                LOGGER.debug("Failed to close docker event stream: %s", ex)
+
+    def _is_duplicate(self, event):
+        key = _event_key(event)
+
+        # Events before the resume position were already read
+        time_nano = event.get("timeNano")
+        if time_nano != None and self.cursor.last_read != None and time_nano < self.cursor.last_read:
+            return True
+
+        if key in self.recent_keys:
+            return True
+
+        if len(self.recent) == self.recent.maxlen:
+            self.recent_keys.discard(self.recent[0])
+
+        self.recent.append(key)
+        self.recent_keys.add(key)
+        return False
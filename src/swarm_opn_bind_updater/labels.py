@@ -0,0 +1,197 @@
+import collections
+import logging
+import re
+import threading
+
+LOGGER = logging.getLogger(__name__)
+
+# Define prefix and pattern for our labels
+LABEL_PREFIX = "com.aixo.cloud.ingress.mappings."
+LABEL_PATTERN = re.compile(r"(com\.aixo\.cloud\.ingress\.mappings)\.(\w+)\.(domain|host|type|value)")
+
+# Attributes every host record must have
+HOST_RECORD_KEYS = ("domain", "host", "type", "value")
+
+# Default number of services whose parsed host records are cached
+DEFAULT_MAPPING_CACHE_SIZE = 4096
+
+def mapping_labels(labels_payload):
+    """
+    Returns only our labels, skipping the labels of other tools with a cheap prefix test
+    """
+    return { label : value for label, value in (labels_payload or { }).items() if label.startswith(LABEL_PREFIX) }
+
+def parse_host_records(labels_payload, service_id):
+    """
+    Collects the host records from the labels of a service
+
+    Parameters
+    ----------
+    labels_payload : dict
+        The labels of the service spec
+    service_id : str
+        The id of the service, used for logging
+
+    Returns
+    -------
+    dict
+        The complete host records keyed by their selector. Incomplete host
+        records are logged and skipped.
+    """
+
+    # Preset host records to add
+    host_records = { }
+
+    # Collect host records
+    for label_payload, value in mapping_labels(labels_payload).items():
+        # Match label to our label pattern
+        result = LABEL_PATTERN.match(label_payload)
+
+        # Check if one of our label was found
+        if not result:
+            LOGGER.debug("Ignoring label %s", label_payload)
+            continue
+
+        # Check if a value was given
+        if not value:
+            LOGGER.error("Label %s does not have a value", label_payload)
+
+        # Extract label parts
+        selector = result.group(2)
+        key = result.group(3)
+
+        # Get host record by selector or create a new one
+        host_record = host_records.get(selector, { })
+
+        # Add host attribute
+        host_record[key] = value
+
+        # Store back host record
+        host_records[selector] = host_record
+
+    # Drop incomplete host records
+    for selector, host_record in list(host_records.items()):
+        if not host_record.get("domain"):
+            LOGGER.error("Failed to read domain name label on service %s", service_id)
+            host_records.pop(selector)
+
+        elif not host_record.get("host"):
+            LOGGER.error("Failed to read host label on service %s", service_id)
+            host_records.pop(selector)
+
+        elif not host_record.get("type"):
+            LOGGER.error("Failed to read type label on service %s", service_id)
+            host_records.pop(selector)
+
+        elif not host_record.get("value"):
+            LOGGER.error("Failed to read value label on service %s", service_id)
+            host_records.pop(selector)
+
+    return host_records
+
+class MappingCache:
+    """
+    Caches the parsed host records of services keyed by service id and spec version
+
+    Docker increases the version of a service spec with every change, so the
+    host records parsed from a spec stay valid as long as the version does.
+    Only the latest version of a service is kept. The least recently used
+    services are evicted first.
+
+    Parameters
+    ----------
+    size : int
+        The maximum number of services cached
+    """
+
+    def __init__(self, size=DEFAULT_MAPPING_CACHE_SIZE):
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, service_id):
+        with self.lock:
+            return service_id in self.entries
+
+    def get(self, service_id, version=None):
+        """
+        Returns a copy of the cached host records of a service
+
+        Parameters
+        ----------
+        service_id : str
+            The id of the service
+        version : int
+            The version of the service spec or None for the latest cached version
+
+        Returns
+        -------
+        dict
+            The host records keyed by selector or None, if not cached
+        """
+        with self.lock:
+            entry = self.entries.get(service_id)
+            if entry == None or (version != None and entry[0] != version):
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(service_id)
+            self.hits += 1
+
+        # Callers amend the host records with bind ids
+        return { selector : dict(host_record) for selector, host_record in entry[1].items() }
+
+    def put(self, service_id, version, host_records):
+        with self.lock:
+            self.entries[service_id] = (version, { selector : dict(host_record) for selector, host_record in host_records.items() })
+            self.entries.move_to_end(service_id)
+
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def discard(self, service_id):
+        with self.lock:
+            self.entries.pop(service_id, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def domains(self):
+        """
+        Returns the names of all domains referenced by the cached host records
+        """
+        with self.lock:
+            return { host_record["domain"] for _, host_records in self.entries.values() for host_record in host_records.values() }
+
+    def parse(self, service_payload):
+        """
+        Returns the host records of an inspected service, parsing its labels only once per version
+
+        Parameters
+        ----------
+        service_payload : dict
+            The inspected service
+
+        Returns
+        -------
+        dict
+            The host records keyed by selector
+        """
+        service_id = service_payload["ID"]
+        version = service_payload.get("Version", { }).get("Index")
+
+        if version != None:
+            host_records = self.get(service_id, version)
+            if host_records != None:
+                return host_records
+
+        host_records = parse_host_records(service_payload["Spec"].get("Labels"), service_id)
+
+        if version != None:
+            self.put(service_id, version, host_records)
+
+        return host_records
@@ -0,0 +1,242 @@
+import json
+import logging
+import os
+import socket
+import threading
+import time
+
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+
+LOGGER = logging.getLogger(__name__)
+
+# Default time in seconds a lease stays valid without being renewed
+DEFAULT_LEASE_TTL = 15.0
+
+# Default interval in seconds in which a standby refreshes its indexes
+DEFAULT_WARM_INTERVAL = 60.0
+
+class LeaseBackend(ABC):
+    """
+    Base of the lock backends replicas elect their leader with
+
+    A backend grants a lease to one owner at a time. The lease expires
+    unless its owner renews it within its time to live, so a crashed leader
+    is replaced without manual intervention.
+    """
+
+    @abstractmethod
+    def acquire(self, owner, ttl):
+        """
+        Acquires or renews the lease for an owner
+
+        Parameters
+        ----------
+        owner : str
+            The identity of the replica
+        ttl : float
+            The time in seconds the lease stays valid
+
+        Returns
+        -------
+        bool
+            True, if the owner holds the lease now
+        """
+
+    @abstractmethod
+    def release(self, owner):
+        """
+        Gives up the lease, if the owner holds it
+        """
+
+    @abstractmethod
+    def holder(self):
+        """
+        Returns the owner of the valid lease or None
+        """
+
+class FileLeaseBackend(LeaseBackend):
+    """
+    Lease kept in a file, e.g. on storage shared by the swarm managers
+
+    The lease file holds the owner and the expiry time. Reading and writing
+    it is serialized by an advisory lock on a sibling `.lock` file, which
+    requires a POSIX platform. The expiry is compared with the wall clock,
+    so the clocks of the replicas must be synchronized well within the time
+    to live.
+
+    Parameters
+    ----------
+    path : str
+        The lease file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock_path = path + ".lock"
+
+    def acquire(self, owner, ttl):
+        with self._locked():
+            lease = self._read()
+            now = time.time()
+
+            if lease and lease.get("owner") != owner and lease.get("expires", 0) > now:
+                return False
+
+            self._write({ "owner" : owner, "expires" : now + ttl })
+            return True
+
+    def release(self, owner):
+        with self._locked():
+            lease = self._read()
+            if lease and lease.get("owner") == owner:
+                os.remove(self.path)
+
+    def holder(self):
+        with self._locked():
+            lease = self._read()
+
+        if lease and lease.get("expires", 0) > time.time():
+            return lease.get("owner")
+
+        return None
+
+    @contextmanager
+    def _locked(self):
+        # Only available on POSIX, imported here so the other commands work elsewhere
+        import fcntl
+
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        with open(self.lock_path, "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _read(self):
+        if not os.path.exists(self.path):
+            return None
+
+        try:
+            with open(self.path, "r", encoding="utf-8") as lease:
+                return json.load(lease)
+        except ValueError:
+            LOGGER.warning("Ignoring invalid lease in %s", self.path)
+            return None
+
+    def _write(self, lease):
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, "w", encoding="utf-8") as file:
+            json.dump(lease, file)
+            file.flush()
+            os.fsync(file.fileno())
+
+        os.replace(temporary_path, self.path)
+
+class LeaderElector:
+    """
+    Elects one leader among the daemon replicas sharing a lease backend
+
+    A background thread acquires or renews the lease every `renew_interval`
+    seconds. The listeners are notified when this replica becomes leader and
+    when it loses the lease, e.g. because the backend could not be reached.
+
+    Parameters
+    ----------
+    backend : LeaseBackend
+        The backend granting the lease
+    owner : str
+        The identity of this replica, defaults to host name and process id
+    ttl : float
+        The time in seconds the lease stays valid without being renewed
+    renew_interval : float
+        The time in seconds between two renewals, defaults to a third of the time to live
+    """
+
+    def __init__(self, backend : LeaseBackend, owner=None, ttl=DEFAULT_LEASE_TTL, renew_interval=None):
+        self.backend = backend
+        self.owner = owner or "{}:{}".format(socket.gethostname(), os.getpid())
+        self.ttl = ttl
+        self.renew_interval = renew_interval or ttl / 3
+
+        self.leader = False
+        self.elected_listeners = [ ]
+        self.demoted_listeners = [ ]
+
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="leader-elector", daemon=True)
+
+    def on_elected(self, listener):
+        """
+        Registers a callable notified whenever this replica becomes leader
+        """
+        self.elected_listeners.append(listener)
+
+    def on_demoted(self, listener):
+        """
+        Registers a callable notified whenever this replica stops being leader
+        """
+        self.demoted_listeners.append(listener)
+
+    def is_leader(self):
+        return self.leader
+
+    def start(self):
+        """
+        Tries to become leader once and starts the background thread
+        """
+        self.step()
+        self.thread.start()
+        return self
+
+    def step(self):
+        """
+        Acquires or renews the lease once and notifies the listeners of a change
+        """
+        try:
+            leader = self.backend.acquire(self.owner, self.ttl)
+        except Exception as ex:
+            LOGGER.error("Failed to renew leader lease: %s", ex)
+            leader = False
+
+        if leader == self.leader:
+            return
+
+        self.leader = leader
+
+        if leader:
+            LOGGER.info("Elected %s as leader", self.owner)
+            listeners = self.elected_listeners
+        else:
+            LOGGER.warning("Replica %s is no longer leader", self.owner)
+            listeners = self.demoted_listeners
+
+        for listener in listeners:
+            try:
+                listener()
+            except Exception as ex:
+                LOGGER.error("Failed to notify leadership change: %s", ex)
+
+    def close(self):
+        """
+        Stops the background thread and releases the lease, so a standby takes over at once
+        """
+        self.stopped.set()
+        if self.thread.is_alive():
+            self.thread.join()
+
+        if self.leader:
+            self.leader = False
+            try:
+                self.backend.release(self.owner)
+                LOGGER.info("Released leader lease of %s", self.owner)
+            except Exception as ex:
+                LOGGER.error("Failed to release leader lease: %s", ex)
+
+    def _run(self):
+        while not self.stopped.wait(self.renew_interval):
+            self.step()
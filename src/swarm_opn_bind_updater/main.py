@@ -1,16 +1,35 @@
+from __future__ import annotations
+
 import os
 import sys
+import signal
 import threading
 import time
 import argparse
+import collections
 import logging
 
 import dotenv
 
-import re
 import json
-import requests
-import docker
+
+from typing import TYPE_CHECKING
+
+from .client import get_client, close_clients, _create_record_payload, _handle_response
+from .client import DEFAULT_POOL_SIZE, DEFAULT_TIMEOUT, DEFAULT_DOMAIN_TTL, DEFAULT_RECORD_TTL
+from .scheduler import ReconfigureScheduler, DEFAULT_RECONFIGURE_DELAY, DEFAULT_RECONFIGURE_MAX_DELAY
+from .pipeline import EventPipeline, EventFanOut, DEFAULT_WORKERS, DEFAULT_QUEUE_SIZE
+from .labels import LABEL_PATTERN, HOST_RECORD_KEYS, MappingCache, mapping_labels, parse_host_records
+from .reconcile import reconcile_services, remove_service_records, recover_service_records, refresh_records
+from .state import ServiceRepository, JournalStateStore
+from .resilience import BindApiError, CircuitBreaker, DeadLetterQueue, is_retryable
+from .resilience import DEFAULT_RETRIES, DEFAULT_FAILURE_THRESHOLD, DEFAULT_RESET_TIMEOUT
+from .eventlog import STAGE_INSPECT, STAGE_LOOKUP, STAGE_ADD, STAGE_REMOVE, LOG_FORMAT_TEXT, stage, trace_event, event_correlation_id, record_touched, configure_logging
+from .metrics import MetricsServer, MetricsLogger, INSPECT_SECONDS, EVENT_SECONDS, EVENTS, QUEUE_DEPTH, TRACKED_SERVICES, TARGET_EVENTS
+
+# The docker SDK and the modules of single commands are only imported by the commands using them, so the one-shot commands start fast
+if TYPE_CHECKING:
+    import docker
 
 LOGGER = logging.getLogger(__name__)
 
@@ -19,22 +38,52 @@ CONFIG_API_GW_URL = "GW_API_URL"
 CONFIG_API_KEY = "GW_API_KEY"
 CONFIG_API_SECRET = "GW_API_SECRET"
 
+CONFIG_API_POOL_SIZE = "GW_API_POOL_SIZE"
+CONFIG_API_TIMEOUT = "GW_API_TIMEOUT"
+
+CONFIG_DOMAIN_CACHE_TTL = "GW_DOMAIN_CACHE_TTL"
+CONFIG_RECORD_CACHE_TTL = "GW_RECORD_CACHE_TTL"
+
+CONFIG_API_RETRIES = "GW_API_RETRIES"
+CONFIG_CIRCUIT_THRESHOLD = "GW_CIRCUIT_THRESHOLD"
+CONFIG_CIRCUIT_RESET = "GW_CIRCUIT_RESET"
+
+CONFIG_RECONFIGURE_DELAY = "GW_RECONFIGURE_DELAY"
+CONFIG_RECONFIGURE_MAX_DELAY = "GW_RECONFIGURE_MAX_DELAY"
+
+CONFIG_EVENT_WORKERS = "EVENT_WORKERS"
+CONFIG_EVENT_QUEUE_SIZE = "EVENT_QUEUE_SIZE"
+
+CONFIG_STATE_PATH = "STATE_PATH"
+
+CONFIG_LEADER_LOCK_PATH = "LEADER_LOCK_PATH"
+CONFIG_LEADER_LEASE_TTL = "LEADER_LEASE_TTL"
+
+CONFIG_AUDIT_INTERVAL = "AUDIT_INTERVAL"
+CONFIG_AUDIT_MODE = "AUDIT_MODE"
+CONFIG_AUDIT_RATE = "AUDIT_RATE"
+
+CONFIG_LOG_FORMAT = "LOG_FORMAT"
+
+CONFIG_METRICS_PORT = "METRICS_PORT"
+CONFIG_METRICS_ADDRESS = "METRICS_ADDRESS"
+CONFIG_METRICS_LOG_INTERVAL = "METRICS_LOG_INTERVAL"
+
 def reconfigure_bind_controller(api_key, api_secret, api_gw_url):
-    headers = {
-        "Content-Type" : "application/json"
-    }
-    payload = { }
-    url = "".join([api_gw_url, "/api/bind/service/reconfigure"])
-    response = requests.post(url=url, auth=(api_key, api_secret), headers=headers, json=payload)
+    """
+    Instructs the bind service to reload its configuration
 
-    if response.status_code != 200:
-        _handle_response(response, "Failed to reconfigure bind service")
-    
-    result = response.json()
-    if result["status"] != "ok":
-        raise Exception("Bind service responded with unexpected result : {}".format(result))
-    
-    return result
+    Parameters
+    ----------
+    api_key : str
+        The API key used for authentication
+    api_secret : str
+        The API secred used for authentication
+    base_url : str
+        The base URL for accessing the OPNSense API. This is an URL without path
+        Example: "https://fw.example.org"
+    """
+    return get_client(api_key, api_secret, api_gw_url).reconfigure()
 
 def search_domain(api_key, api_secret, api_gw_url, domain_name):
     """
@@ -58,27 +107,7 @@ def search_domain(api_key, api_secret, api_gw_url, domain_name):
     str
         The record id or None, if the record could not be found
     """
-
-    url = "".join([api_gw_url, "/api/bind/domain/get"])
-    response = requests.get(url, auth=(api_key, api_secret))
-
-    if response.status_code != 200:
-        _handle_response(response,"Failed to read domains")
-    
-    payload = response.json()
-    domains = payload["domain"]["domains"]["domain"]
-
-    for domain_id, domain in domains.items():
-        if domain["domainname"] != domain_name:
-            continue
-
-        if domain["enabled"] != "1":
-            LOGGER.warning("Domain %s is not enabled", domain["domainname"])
-            continue
-
-        return domain_id
-
-    return None        
+    return get_client(api_key, api_secret, api_gw_url).search_domain(domain_name)
 
 def search_record(api_key, api_secret, api_gw_url, domain_name, record_type, record_name):
     """
@@ -107,48 +136,12 @@ def search_record(api_key, api_secret, api_gw_url, domain_name, record_type, rec
         The record id or None, if the record could not be found
 
     """
-    headers = {
-        "Content-Type" : "application/json"
-    }
-    request_payload = {
-        "current" : 1,
-        "rowCount" : 50,
-        "sort" : {
-            "type" : "asc"
-        },
-        "searchPhrase" : record_name,
-        "domain" : search_domain(api_key, api_secret, api_gw_url, domain_name)
-    }
-    url = "".join([api_gw_url, "/api/bind/record/searchRecord"])
-
-    response = requests.post(url=url, auth=(api_key, api_secret), headers=headers, json=request_payload)
-
-    if response.status_code != 200:
-        _handle_response(response, "Failed to search record {} with type {} in domain {}".format(record_name, record_type, domain_name))
-    
-    response_payload = response.json()
-    for item in response_payload["rows"]:
-        name = item["name"]
-        type = item["type"]
-        uuid = item["uuid"]
-
-        if name != record_name:
-            continue
-
-        if type != record_type:
-            LOGGER.warning("Record %s is already mapped to record type %s", record_name, record_type)
-            
-        LOGGER.info("Record %s has uuid %s", record_name, uuid)
-        return uuid
-    
-    return None
+    return get_client(api_key, api_secret, api_gw_url).search_record(domain_name, record_type, record_name)
 
 def add_record(api_key, api_secret, api_gw_url, domain_id, name, record_type, value):
     """
     Add a new record to the bind dns database via bind API
 
-    The record will be added with type CNAME to the given domain
-
     Parameters
     ----------
     api_key : str
@@ -172,22 +165,7 @@ def add_record(api_key, api_secret, api_gw_url, domain_id, name, record_type, va
     Exception
         If an error occoured accessing the bind API
     """
-    headers = {
-        "Content-Type" : "application/json"
-    }
-    payload = _create_record_payload(domain_id, name, record_type, value)
-    url = "".join([api_gw_url, "/api/bind/record/addRecord"])
-
-    response = requests.post(url=url, auth=(api_key, api_secret), headers=headers, json=payload)
-
-    if response.status_code != 200:
-        _handle_response(response, "Failed to add host")
-
-    result = response.json()
-    if result["result"] != "saved":
-        raise Exception("Failed to add host \"{}\" to domain id \"{}\" : {}".format(name, domain_id, result))
-    
-    return result
+    return get_client(api_key, api_secret, api_gw_url).add_record(domain_id, name, record_type, value)
 
 def remove_record(api_key, api_secret, api_gw_url, record_id):
     """
@@ -210,26 +188,13 @@ def remove_record(api_key, api_secret, api_gw_url, record_id):
     Exception
         If an error occoured accessing the bind API
     """
+    return get_client(api_key, api_secret, api_gw_url).remove_record(record_id)
 
-    url = "".join([api_gw_url, "/api/bind/record/delRecord/", record_id])
-
-    response = requests.post(url=url, auth=(api_key, api_secret), json={})
-
-    if response.status_code != 200:
-        _handle_response(response, "Failed to remove host")
-    
-    result = response.json()
-    if result["result"] != "deleted":
-        raise Exception("Failed to remove host: {}".format(result))
-    
-    return result
-    
 def remove_host_by_domain_and_name(api_key, api_secret, api_gw_url, domain_name, record_name, record_type):
     """
     Remove a record from the bind dns database via bind API
 
-    The record will be identified by its domain name and its record name.
-    The record type will be implicitly assumed to be "CNAME"
+    The record will be identified by its domain name, its record name and its record type.
 
     Parameters
     ----------
@@ -244,197 +209,761 @@ def remove_host_by_domain_and_name(api_key, api_secret, api_gw_url, domain_name,
         The domain name the record is assigned to
     record_name : str
         The name of the record to be deleted
+    record_type : str
+        The type of the record to be deleted
 
     Raises
     ------
     Exception
         If an error occoured accessing the bind API
     """
+    return get_client(api_key, api_secret, api_gw_url).remove_host_by_domain_and_name(domain_name, record_name, record_type)
 
-    domain_id = search_domain(api_key, api_secret, api_gw_url, domain_name)
-    if domain_id == None:
-        raise Exception("Domain \"{}\" unknown or not enabled".format(domain_name))
-    
-    record_id = search_record(api_key, api_secret, api_gw_url, domain_name, record_type, record_name)
-    if record_id == None:
-        raise Exception("Record \"{}\" with type \"{}\" not found under domain \"{}\"".format(record_name, record_type, domain_name))
+# Repository for active services
+ACTIVE_SERVICES = ServiceRepository()
 
-    return remove_record(api_key, api_secret, api_gw_url, record_id)
+# Repositories for the active services of further firewalls keyed by base URL
+TARGET_SERVICES = { }
 
-# Define pattern for our labels
-LABEL_PATTERN = re.compile(r"(com\.aixo\.cloud\.ingress\.mappings)\.(\w+)\.(domain|host|type|value)")
+# Index of the bind records added by the updater on all firewalls, keyed by record id
+OWNED_RECORDS = ServiceRepository()
 
-# Repository for active services
-ACTIVE_SERVICES = { }
+def active_services(api_gw_url):
+    """
+    Returns the repository of the active services of a firewall
 
-def handle_service_created_event(api_key, api_secret, api_gw_url, api_client : docker.APIClient, service_id):
-    # Get service
-    service_payload = api_client.inspect_service(service_id)
+    The record ids differ between firewalls, so every firewall tracks its own
+    records. Firewalls without an own repository use `ACTIVE_SERVICES`.
+    """
+    return TARGET_SERVICES.get(api_gw_url, ACTIVE_SERVICES)
 
-    # Get spec from service
-    service_spec_payload = service_payload["Spec"]
+# Cache of the host records parsed from the service specs
+SERVICE_MAPPINGS = MappingCache()
 
-    # Read lables from service spec
-    labels_paylod = service_spec_payload["Labels"]
+def create_docker_client(docker_url):
+    """
+    Creates a docker client, importing the docker SDK on first use
 
-    # Preset host records to add
-    host_records = { }
+    Parameters
+    ----------
+    docker_url : str
+        The URL of the docker daemon, e.g. "unix:///var/run/docker.sock"
 
-    # Collect host records
-    for label_payload, value in labels_paylod.items():
-        # Match label to our label pattern
-        result = LABEL_PATTERN.match(label_payload)
+    Returns
+    -------
+    docker.DockerClient
+        The docker client
+    """
+    import docker
 
-        # Check if one of our label was found
-        if not result:
-            LOGGER.debug("Ignoring label %s", label_payload)
-            continue
+    return docker.DockerClient(base_url=docker_url)
 
-        # Check if a value was given
-        if not value:
-            LOGGER.error("Label %s does not have a value", label_payload)
+def inspect_service(api_client : docker.APIClient, service_id):
+    with INSPECT_SECONDS.time(), stage(STAGE_INSPECT):
+        return api_client.inspect_service(service_id)
 
-        # Extract label parts
-        selector = result.group(2)
-        key = result.group(3)
+def read_host_records(api_client : docker.APIClient, service_id, attributes=None, created=False):
+    """
+    Reads the host records of a service with as little work as possible
 
-        # Get host record by selector or create a new one
-        host_record = host_records.get(selector, { })
+    Mapping labels carried by the event attributes are used without inspecting
+    the service. A repeated create event of a cached service skips the inspect
+    as well. Otherwise the service is inspected and its labels are parsed
+    once per spec version.
+
+    Parameters
+    ----------
+    api_client : docker.APIClient
+        The docker API client
+    service_id : str
+        The id of the service
+    attributes : dict
+        The attributes of the docker event or None
+    created : bool
+        Whether the service was just created, so its spec cannot have changed since it was cached
+
+    Returns
+    -------
+    dict
+        The host records keyed by selector
+    """
+    labels = mapping_labels(attributes)
+    if labels:
+        return parse_host_records(labels, service_id)
 
-        # Add host attribute
-        host_record[key] = value
+    if created:
+        host_records = SERVICE_MAPPINGS.get(service_id)
+        if host_records != None:
+            LOGGER.debug("Using cached host records of service %s", service_id)
+            return host_records
 
-        # Store back host record
-        host_records[selector] = host_record
+    return SERVICE_MAPPINGS.parse(inspect_service(api_client, service_id))
+
+def handle_service_created_event(api_key, api_secret, api_gw_url, api_client : docker.APIClient, service_id, attributes=None, created=True):
+    # Collect host records from the labels of the service spec, an updated service may differ from the cached one
+    host_records = read_host_records(api_client, service_id, attributes, created=created)
+
+    # Records already tracked for this service
+    active = active_services(api_gw_url)
+    service = active.get(service_id) or { "id" : service_id, "records" : { } }
+    records = dict(service["records"])
 
     # Process host records
     for selector, host_record in host_records.items():
-        if not host_record.get("domain"):
-            LOGGER.error("Failed to read domain name label on service %s", service_id)
-            continue
+        if add_host_record(api_key, api_secret, api_gw_url, service_id, selector, host_record):
+            records[selector] = host_record
+
+    if not records:
+        return
+
+    service = {
+        "id" : service_id,
+        "records" : records
+    }
+
+    active[service_id] = service
+    LOGGER.info("Added service %s with %d bind records", service_id, len(records))
 
-        if not host_record.get("host"):
-            LOGGER.error("Failed to read host label on service %s", service_id)
-            continue
+def handle_service_updated_event(api_key, api_secret, api_gw_url, api_client : docker.APIClient, service_id, attributes=None):
+    """
+    Applies changed mapping labels of an updated service to the bind records
+
+    Only mappings whose domain, host, type or value changed are sent to the
+    bind API. An update that did not touch the mapping labels costs no bind
+    API call. Records of changed mappings the updater did not add are
+    released instead of removed.
 
-        if not host_record.get("type"):
-            LOGGER.error("Failed to read type label on service %s", service_id)
-            continue
+    Returns
+    -------
+    int
+        The number of changed bind records
+    """
+    active = active_services(api_gw_url)
+
+    service = active.get(service_id)
+    if not service:
+        LOGGER.info("Updated service %s is not tracked, handling it as created", service_id)
+        handle_service_created_event(api_key, api_secret, api_gw_url, api_client, service_id, attributes, created=False)
+        service = active.get(service_id)
+        return len(service["records"]) if service else 0
 
-        if not host_record.get("value"):
-            LOGGER.error("Failed to read value label on service %s", service_id)
-            continue
+    # Collect host records from the labels of the service spec
+    host_records = read_host_records(api_client, service_id, attributes)
 
+    records = dict(service["records"])
+    changes = 0
+
+    try:
+        # Remove records of dropped or changed mappings
+        for selector, host_record in service["records"].items():
+            desired = host_records.get(selector)
+            if desired and all(desired[key] == host_record.get(key) for key in HOST_RECORD_KEYS):
+                continue
+
+            try:
+                if get_client(api_key, api_secret, api_gw_url).owns(host_record.get("id")):
+                    with stage(STAGE_REMOVE):
+                        remove_record(api_key, api_secret, api_gw_url, host_record["id"])
+                    LOGGER.debug("Removed bind record %s", host_record)
+                    record_touched("removed", host_record)
+                else:
+                    LOGGER.info("Released bind record %s of mapping %s of service %s, it was not added by the updater", host_record.get("id"), selector, service_id)
+                    record_touched("released", host_record)
+            except Exception as ex:
+                if is_retryable(ex):
+                    raise
+
+                LOGGER.warning(str(ex))
+
+            records.pop(selector)
+            changes += 1
+
+        # Add records of new or changed mappings
+        for selector, host_record in host_records.items():
+            if selector in records:
+                continue
+
+            if add_host_record(api_key, api_secret, api_gw_url, service_id, selector, host_record):
+                records[selector] = host_record
+                changes += 1
+
+    finally:
+        # Keep the progress made, also if the update is replayed later
+        if changes:
+            if records:
+                active[service_id] = { "id" : service_id, "records" : records }
+            else:
+                active.pop(service_id, None)
+
+    if not changes:
+        LOGGER.debug("Mappings of service %s did not change", service_id)
+        return 0
+
+    LOGGER.info("Updated %d bind records of service %s", changes, service_id)
+    return changes
+
+def add_host_record(api_key, api_secret, api_gw_url, service_id, selector, host_record):
+    """
+    Adds the bind record of a mapping, unless it already exists
+
+    The domain id and the record id are stored in the host record.
+
+    Returns
+    -------
+    bool
+        True, if the host record is backed by a bind record
+    """
+    with stage(STAGE_LOOKUP):
         host_record["domain_id"] = search_domain(api_key, api_secret, api_gw_url, host_record.get("domain"))
 
-        if not host_record.get("domain_id"):
-            LOGGER.warning("Could not find domain id for domain %s on service %s", host_record.get("domain"), service_id)
+    if not host_record.get("domain_id"):
+        LOGGER.warning("Could not find domain id for domain %s on service %s", host_record.get("domain"), service_id)
+        return False
 
+    try:
         # Only add a new record to the OPNSense if it does not already exist
-        host_record["id"] = search_record(api_key, api_secret, api_gw_url, host_record.get("domain"), host_record.get("type"), host_record.get("host"))
+        with stage(STAGE_LOOKUP):
+            host_record["id"] = search_record(api_key, api_secret, api_gw_url, host_record.get("domain"), host_record.get("type"), host_record.get("host"))
+
         if not host_record.get("id"):
-            result = add_record(api_key, api_secret, api_gw_url, host_record.get("domain_id"), host_record.get("host"), host_record.get("type"), host_record.get("value"))
+            with stage(STAGE_ADD):
+                result = add_record(api_key, api_secret, api_gw_url, host_record.get("domain_id"), host_record.get("host"), host_record.get("type"), host_record.get("value"))
             host_record["id"] = result.get("uuid")
-            LOGGER.info("Added bind record %s", host_record)
+            LOGGER.debug("Added bind record %s", host_record)
+            record_touched("added", host_record)
         else:
-            LOGGER.warning("For service %s, host record %s already exists on domain %s", service_id, host_record, host_record.get("domain"))
+            LOGGER.warning("For service %s, %s record %s already exists on domain %s", service_id, host_record.get("type"), host_record.get("host"), host_record.get("domain"))
+            record_touched("adopted", host_record)
 
-        service = {
-            "id" : service_id,
-            "record" : host_record
-        }
-        
-        ACTIVE_SERVICES[service_id] = service
-        LOGGER.info("Added service %s", service)
+    except Exception as ex:
+        # Let retryable errors fail the event, so it is replayed later
+        if is_retryable(ex):
+            raise
+
+        LOGGER.error("Failed to add host record %s of service %s: %s", selector, service_id, ex)
+        return False
+
+    return True
 
 def service_removed(api_key, api_secret, api_gw_url, service_id):
-    service = ACTIVE_SERVICES.get(service_id)
+    """
+    Removes the bind records of a removed service
+
+    The records of a service that is not tracked, e.g. because it was
+    created while the state was lost, are recovered from the host records
+    in the mapping cache. The cache entry is kept, so other firewalls and a
+    replay of the event can recover them as well.
+    """
+    active = active_services(api_gw_url)
+    service = active.get(service_id)
     if not service:
-        LOGGER.error("No active service found for service id %s", service_id)
-        return
-    
-    record_id = service["record"]["id"]
-    
-    try:
-        remove_record(api_key, api_secret, api_gw_url, record_id)
-        LOGGER.info("Removed bind record %s", service.get("record"))
-    except Exception as ex:
-        LOGGER.warning(str(ex))
-                  
-    ACTIVE_SERVICES.pop(service_id, None)
-    LOGGER.info("Removed service %s", service)
+        host_records = SERVICE_MAPPINGS.get(service_id)
+        if host_records:
+            service = recover_service_records(get_client(api_key, api_secret, api_gw_url), service_id, host_records)
+
+        if not service:
+            LOGGER.error("No active service found for service id %s", service_id)
+            return
+
+        LOGGER.info("Recovered %d bind records of untracked service %s from its labels", len(service["records"]), service_id)
+
+    # Remove all records of the service in one pass and keep the failed ones
+    remaining = remove_service_records(get_client(api_key, api_secret, api_gw_url), service)
+
+    if remaining:
+        active[service_id] = { "id" : service_id, "records" : remaining }
+        raise BindApiError("Failed to remove {} bind records of service {}".format(len(remaining), service_id), retryable=True)
+
+    active.pop(service_id, None)
+    LOGGER.info("Removed service %s with %d bind records", service_id, len(service["records"]))
+
+def reconcile(api_key, api_secret, api_gw_url, api_client : docker.APIClient):
+    """
+    Reconciles the labels of all swarm services with the bind records
 
-def process_docker_events(api_key, api_secret, api_gw_url, docker_url):
-    docker_client = docker.DockerClient(base_url=docker_url)
+    Parameters
+    ----------
+    api_key : str
+        The API key used for authentication
+    api_secret : str
+        The API secred used for authentication
+    base_url : str
+        The base URL for accessing the OPNSense API. This is an URL without path
+        Example: "https://fw.example.org"
+    api_client : docker.APIClient
+        The docker API client
+
+    Returns
+    -------
+    dict
+        The number of added, adopted and removed records
+    """
+    return reconcile_services(get_client(api_key, api_secret, api_gw_url), api_client, active_services(api_gw_url), SERVICE_MAPPINGS)
+
+def apply_manifest(api_key, api_secret, api_gw_url, records):
+    """
+    Brings the bind records in line with the records of a manifest
+
+    Parameters
+    ----------
+    api_key : str
+        The API key used for authentication
+    api_secret : str
+        The API secred used for authentication
+    base_url : str
+        The base URL for accessing the OPNSense API. This is an URL without path
+        Example: "https://fw.example.org"
+    records : list
+        The desired records as read by `read_manifest`
+
+    Returns
+    -------
+    dict
+        The number of added, removed, unchanged and failed records
+    """
+    client = get_client(api_key, api_secret, api_gw_url)
+    from .manifest import plan_manifest, apply_plan
+
+    return apply_plan(client, plan_manifest(client, records))
+
+def handle_docker_event(api_key, api_secret, api_gw_url, api_client : docker.APIClient, scheduler : ReconfigureScheduler, event):
+    action = event["Action"]
+    service_id = event["Actor"]["ID"]
+    attributes = event["Actor"].get("Attributes")
+
+    EVENTS.inc(action=action)
+    start = time.time()
+
+    match action:
+        case "create":
+            handle_service_created_event(api_key, api_secret, api_gw_url, api_client, service_id, attributes)
+            scheduler.request()
+
+        case "update":
+            if handle_service_updated_event(api_key, api_secret, api_gw_url, api_client, service_id, attributes):
+                scheduler.request()
+
+        case "remove":
+            service_removed(api_key, api_secret, api_gw_url, service_id)
+            scheduler.request()
+
+    # Measure from the time docker emitted the event, if known
+    if event.get("timeNano"):
+        start = event["timeNano"] / 1e9
+
+    EVENT_SECONDS.observe(time.time() - start, action=action)
+
+def observe_docker_event(api_client : docker.APIClient, event):
+    """
+    Keeps a standby replica warm without changing any bind record
+
+    The host records of created and updated services are parsed into the
+    mapping cache, so the replica does not need to inspect them once it
+    becomes leader.
+    """
+    service_id = event["Actor"]["ID"]
+    attributes = event["Actor"].get("Attributes")
+
+    match event["Action"]:
+        case "create":
+            read_host_records(api_client, service_id, attributes, created=True)
+
+        case "update":
+            read_host_records(api_client, service_id, attributes)
+
+        case "remove":
+            SERVICE_MAPPINGS.discard(service_id)
+
+def list_services(api_client : docker.APIClient):
+    """
+    Lists all swarm services once and parses their host records into the mapping cache
+
+    Docker only filters services by whole label keys, not by the prefix of
+    the mapping labels, so all services are listed. Services without
+    mapping labels are cached as well, so their events need no inspect.
+
+    Returns
+    -------
+    ServiceSpecs
+        The listed services, to reconcile several firewalls without listing them again
+    """
+    from .plan import ServiceSpecs
+
+    service_payloads = api_client.services()
+    for service_payload in service_payloads:
+        SERVICE_MAPPINGS.parse(service_payload)
+
+    LOGGER.info("Cached the host records of %d services", len(service_payloads))
+    return ServiceSpecs(service_payloads)
+
+def refresh_indexes(target):
+    """
+    Reads the domains and the records of all domains in use on a firewall into the indexes of its client
+    """
+    client = get_client(target.api_key, target.api_secret, target.api_gw_url)
+    client.domains.refresh()
+    refresh_records(client, sorted(SERVICE_MAPPINGS.domains()))
+
+def process_docker_events(api_key, api_secret, api_gw_url, docker_url, reconfigure_delay=DEFAULT_RECONFIGURE_DELAY, reconfigure_max_delay=DEFAULT_RECONFIGURE_MAX_DELAY, workers=DEFAULT_WORKERS, queue_size=DEFAULT_QUEUE_SIZE, cursor_path=None, targets=None, elector=None, on_elected=None, on_demoted=None, warm_interval=None, audit_interval=None, audit_fix=False, audit_rate=None):
+    """
+    Listens for docker service events and applies them to the bind records
+
+    Every firewall target gets its own reconfigure scheduler and event
+    pipeline, fed from a single docker event stream, so a slow or unreachable
+    firewall does not delay the others.
+
+    With an elector only the leader among several replicas changes bind
+    records. Standbys follow the event stream, keep their mapping cache and
+    bind indexes warm and take over with a reconciliation once elected. The
+    reconciliation runs while the lease is renewed, and events are held
+    until it finished, so they do not race with it.
+
+    Parameters
+    ----------
+    targets : list
+        The firewalls to update. If None, only the firewall given by `api_key`, `api_secret` and `api_gw_url` is updated.
+    elector : LeaderElector
+        Elects the replica applying the changes or None to always apply them
+    on_elected : callable
+        Called when this replica becomes leader, before it catches up, e.g. to open the state
+    on_demoted : callable
+        Called when this replica stops being leader, e.g. to close the state
+    warm_interval : float
+        The interval in seconds in which a standby refreshes its bind indexes or None for the default
+    audit_interval : float
+        The interval in seconds in which the bind records are audited for drift or None to not audit them
+    audit_fix : bool
+        True to fix drifted bind records, False to only report them
+    audit_rate : float
+        The maximum number of bind API requests per second of an audit or None for the default
+    """
+    from .targets import Target, fan_out
+    from .events import EventCursor, ResumableEventStream
+    from .leader import DEFAULT_WARM_INTERVAL
+    from .audit import DriftAuditor, DEFAULT_AUDIT_RATE
+
+    warm_interval = DEFAULT_WARM_INTERVAL if warm_interval == None else warm_interval
+    audit_rate = DEFAULT_AUDIT_RATE if audit_rate == None else audit_rate
+
+    targets = targets or [ Target(api_key, api_secret, api_gw_url) ]
+    for target in targets[1:]:
+        TARGET_SERVICES.setdefault(target.api_gw_url, ServiceRepository())
+
+    # Coalesce the reconfigures of bursts of events per firewall
+    schedulers = [
+        ReconfigureScheduler(
+            lambda target=target: reconfigure_bind_controller(target.api_key, target.api_secret, target.api_gw_url),
+            delay=reconfigure_delay,
+            max_delay=reconfigure_max_delay
+        ).start()
+        for target in targets
+    ]
+
+    docker_client = create_docker_client(docker_url)
     api_client = docker_client.api
 
     LOGGER.info("Created docker client")
 
-    docker_events = docker_client.events(
-        filters={
-            "type" : "service"
-        }
+    # Resume the event stream where the last run stopped and after failures
+    cursor = EventCursor(cursor_path)
+    cursor.load()
+
+    docker_events = ResumableEventStream(
+        lambda since: docker_client.events(
+            since=since,
+            filters={
+                "type" : "service"
+            }
+        ),
+        cursor
     )
     LOGGER.info("Created event stream")
-  
+
+    # Catch up with changes that happened while the daemon was not running
+    def catch_up():
+        try:
+            service_specs = list_services(api_client)
+        except Exception as ex:
+            LOGGER.error("Failed to list the services: %s", ex)
+            return
+
+        for name, result in fan_out(targets, lambda target: reconcile(target.api_key, target.api_secret, target.api_gw_url, service_specs)).items():
+            if isinstance(result, Exception):
+                LOGGER.error("Failed to reconcile services on firewall %s: %s", name, result)
+
+    # Elected replicas hold their events until they caught up, only then they are leading
+    elected = threading.Event()
+    leading = threading.Event()
+    stopped = threading.Event()
+    term = 0
+
+    if elector:
+        # Only the leader persists the position in the event stream
+        cursor.path = None
+
+        def take_over(current):
+            catch_up()
+
+            # Stay standby, if the lease was lost meanwhile
+            if elected.is_set() and term == current:
+                leading.set()
+                LOGGER.info("Caught up, applying events")
+
+        def promote():
+            nonlocal term
+
+            if on_elected:
+                on_elected()
+
+            cursor.path = cursor_path
+            term += 1
+            elected.set()
+
+            # Catch up off the elector thread, so the lease is renewed meanwhile
+            threading.Thread(target=take_over, args=(term, ), name="leader-catch-up", daemon=True).start()
+
+        def demote():
+            elected.clear()
+            leading.clear()
+            cursor.path = None
+
+            if on_demoted:
+                on_demoted()
+
+        def keep_warm():
+            while not stopped.wait(warm_interval):
+                if not elected.is_set():
+                    for name, result in fan_out(targets, refresh_indexes).items():
+                        if isinstance(result, Exception):
+                            LOGGER.warning("Failed to refresh the indexes of firewall %s: %s", name, result)
+
+        elector.on_elected(promote)
+        elector.on_demoted(demote)
+        elector.start()
+
+        # Read the host records of all services and the records they use, so a takeover starts warm
+        if not elected.is_set():
+            LOGGER.info("Standing by as %s", elector.owner)
+
+            try:
+                list_services(api_client)
+            except Exception as ex:
+                LOGGER.warning("Failed to read the services: %s", ex)
+
+            fan_out(targets, refresh_indexes)
+
+        threading.Thread(target=keep_warm, name="standby-warmer", daemon=True).start()
+
+    else:
+        catch_up()
+        elected.set()
+        leading.set()
+
+    # Mark an event as processed once every firewall finished with it, events held for a replay are not finished
+    finishing = collections.Counter()
+    finishing_lock = threading.Lock()
+
+    def finish(event):
+        key = (event.get("timeNano"), event["Action"], event["Actor"]["ID"])
+        with finishing_lock:
+            finishing[key] += 1
+            if finishing[key] < len(targets):
+                return
+
+            del finishing[key]
+
+        cursor.done(event)
+
+        # Forget the host records of a removed service once all firewalls removed its records
+        if event["Action"] == "remove":
+            SERVICE_MAPPINGS.discard(event["Actor"]["ID"])
+
+    # Process events of different services concurrently, separately per firewall
+    def create_handler(target, scheduler):
+        def handle_event(event):
+            # Hold the events of a fresh leader until it caught up
+            while elected.is_set() and not leading.wait(1.0):
+                if stopped.is_set():
+                    # Not applied, so the event is read again after a restart
+                    return
+
+            if not leading.is_set():
+                observe_docker_event(api_client, event)
+                finish(event)
+                return
+
+            try:
+                with trace_event(event["Action"], event["Actor"]["ID"], target.name, event_correlation_id(event)):
+                    handle_docker_event(target.api_key, target.api_secret, target.api_gw_url, api_client, scheduler, event)
+            except Exception as ex:
+                TARGET_EVENTS.inc(target=target.name, result="failed")
+
+                # Keep the cursor behind an event held for a replay
+                if not is_retryable(ex):
+                    finish(event)
+                raise
+
+            TARGET_EVENTS.inc(target=target.name, result="applied")
+            finish(event)
+
+        return handle_event
+
+    pipelines = [ ]
+    for target, scheduler in zip(targets, schedulers):
+        pipeline = EventPipeline(
+            create_handler(target, scheduler),
+            workers=workers,
+            queue_size=queue_size,
+            dead_letters=DeadLetterQueue()
+        ).start()
+
+        # Replay held events as soon as the firewall is reachable again
+        get_client(target.api_key, target.api_secret, target.api_gw_url).breaker.on_close(pipeline.replay)
+        pipelines.append(pipeline)
+
+    # Hand every event to all firewalls, each reading at its own pace
+    if len(targets) == 1:
+        streams = [ docker_events ]
+    else:
+        fanout = EventFanOut(docker_events, len(targets))
+        streams = fanout.streams
+
+    QUEUE_DEPTH.set_function(lambda: sum(pipeline.depth() for pipeline in pipelines))
+    TRACKED_SERVICES.set_function(lambda: { (target.name,) : len(active_services(target.api_gw_url)) for target in targets })
+
+    # Audit the bind records in the background, only on the leader and while no events are waiting
+    auditors = [ ]
+    if audit_interval:
+        idle = lambda: leading.is_set() and sum(pipeline.depth() for pipeline in pipelines) == 0
+
+        auditors = [
+            DriftAuditor(
+                target.name,
+                get_client(target.api_key, target.api_secret, target.api_gw_url),
+                api_client,
+                active_services(target.api_gw_url),
+                interval=audit_interval,
+                fix=audit_fix,
+                rate=audit_rate,
+                idle=idle,
+                reconfigure=scheduler.request,
+                ordered=pipeline.ordered
+            ).start()
+            for target, scheduler, pipeline in zip(targets, schedulers, pipelines)
+        ]
+
+    def handle_signal(signum, frame):
+        LOGGER.warning("Received %s", signal.Signals(signum).name)
+        for pipeline in pipelines:
+            pipeline.stop()
+
+    previous_handlers = { }
+    if threading.current_thread() is threading.main_thread():
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            previous_handlers[signum] = signal.signal(signum, handle_signal)
+
     try:
-        LOGGER.info("Listening for events...")
+        LOGGER.info("Listening for events for %d firewalls...", len(targets))
 
-        for raw_event in docker_events:
-            event = json.loads(raw_event)
-            
-            action = event["Action"]
-            service_id = event["Actor"]["ID"]
+        if len(targets) > 1:
+            fanout.start()
 
-            match action:
-                case "create":
-                    handle_service_created_event(api_key, api_secret, api_gw_url, api_client, service_id)
-                    reconfigure_bind_controller(api_key, api_secret, api_gw_url)
+        for pipeline, stream in zip(pipelines, streams):
+            pipeline.feed(stream)
 
+        for pipeline in pipelines:
+            pipeline.wait()
 
-                case "remove":
-                    service_removed(api_key, api_secret, api_gw_url, service_id)
-                    reconfigure_bind_controller(api_key, api_secret, api_gw_url)
-    
-    except KeyboardInterrupt:
-        print("")
-        LOGGER.warning("Received SIGINT")
+    finally:
+        for signum, handler in previous_handlers.items():
+            signal.signal(signum, handler)
+
+        # Closing the stream also ends a read blocked on it
+        docker_events.close()
+        LOGGER.info("Closed event stream")
 
-    docker_events.close()
-    LOGGER.info("Closed event stream")
+    # Release the events held for a catch-up, so the workers can drain
+    stopped.set()
+    for pipeline in pipelines:
+        pipeline.close(timeout=5.0)
+    LOGGER.info("Stopped event workers")
+
+    for auditor in auditors:
+        auditor.close()
+
+    cursor.save()
 
     docker_client.close()
     LOGGER.info("Closed docker client")
 
-def _create_record_payload(domain_id, name, type, value):
-    return {
-        "record" : {
-            "enabled" : "1",
-            "domain"  : domain_id,
-            "name"    : name,
-            "type"    : type,
-            "value"   : value
-        }
-    }
+    for scheduler in schedulers:
+        scheduler.close()
 
-def _handle_response(response : requests.Response, message):
-    if not 'application/json' in response.headers.get('Content-Type', ''):
-        if response.text != None and response.text != "":
-            raise Exception("{} - {}: {}".format(response.status_code, message, response.text))
+    # Hand over to a standby only after the last changes were applied
+    if elector:
+        elector.close()
+
+def _report(results, quiet=False):
+    """
+    Prints the results of a command, keyed by firewall if there are several
+
+    Parameters
+    ----------
+    quiet : bool
+        Only log the results, e.g. because a dry run prints its changes instead
+
+    Raises
+    ------
+    Exception
+        If the command failed on any firewall
+    """
+    failed = [ name for name, result in results.items() if isinstance(result, Exception) ]
+
+    if len(results) == 1:
+        result = next(iter(results.values()))
+        if failed:
+            raise result
+
+        if quiet:
+            LOGGER.info("Result %s", result)
         else:
-            raise Exception("{} - {}".format(response.status_code, message))
-            
-    raise Exception("{} - {}: {}".format(response.status_code, message, response.json()))
+            print(result)
+        return
 
-def main():
-    logging.basicConfig(level=logging.INFO)
+    if quiet:
+        LOGGER.info("Results %s", { name : str(result) for name, result in results.items() })
+    else:
+        print({ name : str(result) if isinstance(result, Exception) else result for name, result in results.items() })
 
+    if failed:
+        raise Exception("Failed on firewalls {}".format(", ".join(failed)))
+
+def _report_changes(targets, output):
+    """
+    Prints the changes planned by a dry run as text or JSON, keyed by firewall if there are several
+    """
+    from .plan import format_changes
+
+    changes = { target.name : get_client(target.api_key, target.api_secret, target.api_gw_url).changes.to_json() for target in targets }
+
+    if output == "json":
+        print(json.dumps(changes if len(targets) > 1 else changes[targets[0].name], indent=2))
+        return
+
+    for name, target_changes in changes.items():
+        if len(targets) > 1:
+            print("# {}".format(name))
+        print(format_changes(target_changes))
+
+def main():
     parser = argparse.ArgumentParser(
         prog='opnsense_bind',
         description='Manages opnsense bind service DNS records',
         add_help=True
     )
     parser.add_argument("-u", "--url", help="The base URL to the opnsense router")
+    parser.add_argument("--dry-run", help="Plan the changes and print them instead of sending them to the opnsense router", action="store_true")
+    parser.add_argument("-o", "--output", help="The format of the changes printed by a dry run", choices=["text", "json"], default="text")
 
     command_parser = parser.add_subparsers(
         title="commands",
@@ -470,12 +999,144 @@ def main():
         help="Listen and process docker events"
     )
 
+    reconcile_parser = command_parser.add_parser(
+        "reconcile",
+        help="Reconcile the labels of all swarm services with the bind records"
+    )
+
+    apply_parser = command_parser.add_parser(
+        "apply",
+        help="Apply a manifest of records"
+    )
+    apply_parser.add_argument("manifest", help="the manifest file or - to read it from stdin", nargs="?", default="-")
+    apply_parser.add_argument("-f", "--format", help="the format of the manifest, detected by the file extension if omitted", choices=["json", "yaml", "csv"])
+
+    plan_parser = command_parser.add_parser(
+        "plan",
+        help="Print the changes a reconcile would make without making them"
+    )
+    plan_parser.add_argument("services", help="the service specs exported with docker service inspect or - to read them from stdin, lists the swarm services if omitted", nargs="?")
+    plan_parser.add_argument("-s", "--snapshot", help="the snapshot of the firewalls to plan against instead of reading them")
+
+    snapshot_parser = command_parser.add_parser(
+        "snapshot",
+        help="Print the domains and records of the firewalls for planning offline"
+    )
+
     args = parser.parse_args()
 
     dotenv.load_dotenv()
-    LOGGER.info("Loaded environment")
+
+    metrics_server = None
+    metrics_logger = None
 
     try:
+        configure_logging(os.environ.get(CONFIG_LOG_FORMAT, LOG_FORMAT_TEXT))
+        LOGGER.info("Loaded environment")
+
+        from .targets import parse_targets, fan_out
+
+        # Planning against a snapshot does not call the API and needs no credentials
+        offline = args.command == "plan" and args.snapshot != None
+        if offline:
+            targets = parse_targets(os.environ[CONFIG_API_GW_URL], os.environ.get(CONFIG_API_KEY, ""), os.environ.get(CONFIG_API_SECRET, ""), credentials=False)
+        else:
+            targets = parse_targets(os.environ[CONFIG_API_GW_URL], os.environ[CONFIG_API_KEY], os.environ[CONFIG_API_SECRET])
+
+        # A dry run plans the changes with the same lookups, optionally against a snapshot of the firewalls
+        dry_run = args.dry_run or args.command == "plan"
+
+        snapshots = { }
+        if args.command == "plan" and args.snapshot:
+            with open(args.snapshot, "r", encoding="utf-8") as snapshot:
+                snapshots = json.load(snapshot)
+
+            missing = [ target.name for target in targets if target.name not in snapshots ]
+            if missing:
+                raise ValueError("The snapshot holds no firewall {}".format(", ".join(missing)))
+
+        dry_run_options = { }
+        if dry_run:
+            from .plan import DryRunClient
+
+        # Keep a pooled connection per event worker by default
+        in_flight = int(os.environ.get(CONFIG_EVENT_WORKERS, DEFAULT_WORKERS))
+
+        # Create the shared pooled client of every firewall used by all commands
+        for target in targets:
+            if dry_run:
+                dry_run_options = { "client_class" : DryRunClient, "snapshot" : snapshots.get(target.name) }
+
+            get_client(
+                target.api_key,
+                target.api_secret,
+                target.api_gw_url,
+                pool_size=int(os.environ.get(CONFIG_API_POOL_SIZE, max(DEFAULT_POOL_SIZE, in_flight))),
+                timeout=float(os.environ.get(CONFIG_API_TIMEOUT, DEFAULT_TIMEOUT)),
+                domain_ttl=float(os.environ.get(CONFIG_DOMAIN_CACHE_TTL, DEFAULT_DOMAIN_TTL)),
+                record_ttl=float(os.environ.get(CONFIG_RECORD_CACHE_TTL, DEFAULT_RECORD_TTL)),
+                retries=int(os.environ.get(CONFIG_API_RETRIES, DEFAULT_RETRIES)),
+                breaker=CircuitBreaker(
+                    failure_threshold=int(os.environ.get(CONFIG_CIRCUIT_THRESHOLD, DEFAULT_FAILURE_THRESHOLD)),
+                    reset_timeout=float(os.environ.get(CONFIG_CIRCUIT_RESET, DEFAULT_RESET_TIMEOUT))
+                ),
+                owned=OWNED_RECORDS,
+                **dry_run_options
+            )
+
+        # Report metrics on a local endpoint and / or as log lines
+        if args.command == "events" and os.environ.get(CONFIG_METRICS_PORT):
+            metrics_server = MetricsServer(int(os.environ[CONFIG_METRICS_PORT]), os.environ.get(CONFIG_METRICS_ADDRESS, "127.0.0.1")).start()
+
+        if os.environ.get(CONFIG_METRICS_LOG_INTERVAL):
+            metrics_logger = MetricsLogger(float(os.environ[CONFIG_METRICS_LOG_INTERVAL]))
+            if args.command == "events":
+                metrics_logger.start()
+
+        # Track the records of every further firewall separately
+        if args.command in ("reconcile", "events", "plan"):
+            for target in targets[1:]:
+                TARGET_SERVICES[target.api_gw_url] = ServiceRepository()
+
+        # Restore the active services of previous runs, the first firewall keeps the state of single firewall setups
+        def open_state(read_only=False):
+            if os.environ.get(CONFIG_STATE_PATH):
+                ACTIVE_SERVICES.open(JournalStateStore(os.environ[CONFIG_STATE_PATH], read_only=read_only))
+
+                for target in targets[1:]:
+                    TARGET_SERVICES[target.api_gw_url].open(JournalStateStore(os.path.join(os.environ[CONFIG_STATE_PATH], "targets", target.name), read_only=read_only))
+
+                owned_path = os.path.join(os.environ[CONFIG_STATE_PATH], "owned")
+                migrate = not os.path.isdir(owned_path)
+                OWNED_RECORDS.open(JournalStateStore(owned_path, read_only=read_only))
+
+                # Earlier versions did not tell added from adopted records, so none of them is claimed
+                if migrate:
+                    unowned = sum(len(service["records"]) for services in [ ACTIVE_SERVICES, *TARGET_SERVICES.values() ] for service in services.values())
+                    if unowned:
+                        LOGGER.warning("Tracking %d bind records of an earlier version as not added by the updater, they are left in place when their services are removed", unowned)
+
+        def close_state():
+            ACTIVE_SERVICES.close()
+            for services in TARGET_SERVICES.values():
+                services.close()
+            OWNED_RECORDS.close()
+
+        # Replicas sharing a lease elect the one applying changes, only the leader opens the shared state
+        elector = None
+        if args.command == "events" and os.environ.get(CONFIG_LEADER_LOCK_PATH) and not dry_run:
+            from .leader import LeaderElector, FileLeaseBackend, DEFAULT_LEASE_TTL
+
+            elector = LeaderElector(
+                FileLeaseBackend(os.environ[CONFIG_LEADER_LOCK_PATH]),
+                ttl=float(os.environ.get(CONFIG_LEADER_LEASE_TTL, DEFAULT_LEASE_TTL))
+            )
+        elif args.command in ("reconcile", "events", "plan"):
+            # A dry run reads the state, possibly while a daemon writes it, but keeps its changes in memory only
+            open_state(read_only=dry_run)
+
+        report = lambda results: _report(results, quiet=dry_run)
+
         match args.command:
             case "add":
                 name = args.name
@@ -483,27 +1144,114 @@ def main():
                 record_type = args.type
                 value = args.value
 
-                domain_id = search_domain(os.environ[CONFIG_API_KEY], os.environ[CONFIG_API_SECRET], os.environ[CONFIG_API_GW_URL], domain)
-                result = add_record(os.environ[CONFIG_API_KEY], os.environ[CONFIG_API_SECRET], os.environ[CONFIG_API_GW_URL], domain_id, name, record_type, value)
-                print(result)
+                def add(target):
+                    domain_id = search_domain(target.api_key, target.api_secret, target.api_gw_url, domain)
+                    return add_record(target.api_key, target.api_secret, target.api_gw_url, domain_id, name, record_type, value)
+
+                report(fan_out(targets, add))
 
             case "remove":
                 domain = args.domain
                 name = args.name
                 record_type = args.type
 
-                result = remove_host_by_domain_and_name(os.environ[CONFIG_API_KEY], os.environ[CONFIG_API_SECRET], os.environ[CONFIG_API_GW_URL], domain, name, record_type)
-                print(result)
+                report(fan_out(targets, lambda target: remove_host_by_domain_and_name(target.api_key, target.api_secret, target.api_gw_url, domain, name, record_type)))
 
             case "reconfigure":
-                result = reconfigure_bind_controller(os.environ[CONFIG_API_KEY], os.environ[CONFIG_API_SECRET], os.environ[CONFIG_API_GW_URL])
-                print(result)
+                report(fan_out(targets, lambda target: reconfigure_bind_controller(target.api_key, target.api_secret, target.api_gw_url)))
     
+            case "reconcile":
+                docker_client = create_docker_client(os.environ["DOCKER_HOST"])
+                try:
+                    report(fan_out(targets, lambda target: reconcile(target.api_key, target.api_secret, target.api_gw_url, docker_client.api)))
+                finally:
+                    docker_client.close()
+
+            case "apply":
+                from .manifest import detect_format, read_manifest
+
+                manifest_format = args.format or detect_format(args.manifest)
+                if args.manifest == "-":
+                    records = read_manifest(sys.stdin, manifest_format)
+                else:
+                    with open(args.manifest, "r", encoding="utf-8", newline="") as manifest:
+                        records = read_manifest(manifest, manifest_format)
+
+                report(fan_out(targets, lambda target: apply_manifest(target.api_key, target.api_secret, target.api_gw_url, records)))
+
+            case "plan":
+                from .plan import read_service_specs
+
+                if args.services:
+                    if args.services == "-":
+                        api_client = read_service_specs(sys.stdin)
+                    else:
+                        with open(args.services, "r", encoding="utf-8") as services:
+                            api_client = read_service_specs(services)
+
+                    report(fan_out(targets, lambda target: reconcile(target.api_key, target.api_secret, target.api_gw_url, api_client)))
+                else:
+                    docker_client = create_docker_client(os.environ["DOCKER_HOST"])
+                    try:
+                        report(fan_out(targets, lambda target: reconcile(target.api_key, target.api_secret, target.api_gw_url, docker_client.api)))
+                    finally:
+                        docker_client.close()
+
+            case "snapshot":
+                from .plan import take_snapshot
+
+                results = fan_out(targets, lambda target: take_snapshot(get_client(target.api_key, target.api_secret, target.api_gw_url)))
+
+                failed = [ name for name, result in results.items() if isinstance(result, Exception) ]
+                if failed:
+                    raise Exception("Failed to read firewalls {}".format(", ".join(failed)))
+
+                print(json.dumps(results, indent=2))
+
             case "events":
-                process_docker_events(os.environ[CONFIG_API_KEY], os.environ[CONFIG_API_SECRET], os.environ[CONFIG_API_GW_URL], os.environ["DOCKER_HOST"])
+                audit_mode = os.environ.get(CONFIG_AUDIT_MODE, "report")
+                if audit_mode not in ("report", "fix"):
+                    raise ValueError("Unknown audit mode {}, use report or fix".format(audit_mode))
+
+                process_docker_events(
+                    targets[0].api_key,
+                    targets[0].api_secret,
+                    targets[0].api_gw_url,
+                    os.environ["DOCKER_HOST"],
+                    reconfigure_delay=float(os.environ.get(CONFIG_RECONFIGURE_DELAY, DEFAULT_RECONFIGURE_DELAY)),
+                    reconfigure_max_delay=float(os.environ.get(CONFIG_RECONFIGURE_MAX_DELAY, DEFAULT_RECONFIGURE_MAX_DELAY)),
+                    workers=int(os.environ.get(CONFIG_EVENT_WORKERS, DEFAULT_WORKERS)),
+                    queue_size=int(os.environ.get(CONFIG_EVENT_QUEUE_SIZE, DEFAULT_QUEUE_SIZE)),
+                    cursor_path=os.path.join(os.environ[CONFIG_STATE_PATH], "events.cursor") if os.environ.get(CONFIG_STATE_PATH) and not dry_run else None,
+                    targets=targets,
+                    elector=elector,
+                    on_elected=open_state,
+                    on_demoted=close_state,
+                    audit_interval=float(os.environ[CONFIG_AUDIT_INTERVAL]) if os.environ.get(CONFIG_AUDIT_INTERVAL) else None,
+                    audit_fix=audit_mode == "fix",
+                    audit_rate=float(os.environ[CONFIG_AUDIT_RATE]) if os.environ.get(CONFIG_AUDIT_RATE) else None
+                )
+
+        if dry_run and args.command != "snapshot":
+            _report_changes(targets, args.output)
 
     except Exception as ex:
         parser.exit(1, str(ex) + "\n")
 
+    finally:
+        if metrics_logger:
+            metrics_logger.close()
+
+        if metrics_server:
+            metrics_server.close()
+
+        ACTIVE_SERVICES.close()
+        for services in TARGET_SERVICES.values():
+            services.close()
+        TARGET_SERVICES.clear()
+        OWNED_RECORDS.close()
+
+        close_clients()
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,245 @@
+import csv
+import json
+import logging
+import os
+
+from concurrent.futures import ThreadPoolExecutor
+
+from .client import OpnBindClient
+
+LOGGER = logging.getLogger(__name__)
+
+# The keys every record of a manifest must have
+MANIFEST_KEYS = ("domain", "name", "type")
+
+# The supported manifest formats keyed by file extension
+MANIFEST_FORMATS = {
+    ".json" : "json",
+    ".yml" : "yaml",
+    ".yaml" : "yaml",
+    ".csv" : "csv"
+}
+
+# The states a record of a manifest may ask for
+STATE_PRESENT = "present"
+STATE_ABSENT = "absent"
+
+def detect_format(path):
+    """
+    Returns the manifest format of a file by its extension
+
+    Manifests read from stdin are expected to be JSON.
+    """
+    if path == "-":
+        return "json"
+
+    _, extension = os.path.splitext(path)
+    manifest_format = MANIFEST_FORMATS.get(extension.lower())
+    if not manifest_format:
+        raise ValueError("Unknown manifest format of {}, use one of {}".format(path, ", ".join(sorted(set(MANIFEST_FORMATS.values())))))
+
+    return manifest_format
+
+def read_manifest(stream, manifest_format):
+    """
+    Reads the desired records from a manifest
+
+    JSON and YAML manifests hold a list of records, or a mapping with the
+    list under `records`. CSV manifests have a header line naming the
+    columns. Every record has a `domain`, `name`, `type` and, unless its
+    `state` is `absent`, a `value`.
+
+    Parameters
+    ----------
+    stream : file
+        The manifest to read
+    manifest_format : str
+        The format of the manifest, one of `json`, `yaml` or `csv`
+
+    Returns
+    -------
+    list
+        The records of the manifest
+
+    Raises
+    ------
+    ValueError
+        If the manifest is malformed
+    """
+    match manifest_format:
+        case "json":
+            payload = json.load(stream)
+        case "yaml":
+            try:
+                import yaml
+            except ImportError:
+                raise ValueError("Reading YAML manifests requires PyYAML, install it with the yaml extra")
+
+            payload = yaml.safe_load(stream)
+        case "csv":
+            payload = list(csv.DictReader(stream))
+        case _:
+            raise ValueError("Unknown manifest format {}".format(manifest_format))
+
+    if isinstance(payload, dict):
+        payload = payload.get("records")
+
+    if not isinstance(payload, list):
+        raise ValueError("The manifest must hold a list of records")
+
+    return [ _validate_record(position, record) for position, record in enumerate(payload) ]
+
+def _validate_record(position, record):
+    if not isinstance(record, dict):
+        raise ValueError("Record {} of the manifest is not a mapping".format(position))
+
+    # Blank CSV cells count as missing
+    record = { key : str(value).strip() for key, value in record.items() if key and value != None and str(value).strip() != "" }
+    record.setdefault("state", STATE_PRESENT)
+
+    missing = [ key for key in MANIFEST_KEYS if key not in record ]
+    if record["state"] == STATE_PRESENT and "value" not in record:
+        missing.append("value")
+
+    if missing:
+        raise ValueError("Record {} of the manifest is missing {}".format(position, ", ".join(missing)))
+
+    if record["state"] not in (STATE_PRESENT, STATE_ABSENT):
+        raise ValueError("Record {} of the manifest has the unknown state {}".format(position, record["state"]))
+
+    return record
+
+def plan_manifest(client : OpnBindClient, records):
+    """
+    Computes the changes bringing the bind records in line with a manifest
+
+    Every domain of the manifest is resolved once and its records are read
+    in bulk, so the difference is computed without further API calls.
+
+    Parameters
+    ----------
+    client : OpnBindClient
+        The bind API client
+    records : list
+        The records of the manifest
+
+    Returns
+    -------
+    dict
+        The records to `add`, the existing records to `remove`, the number
+        of `unchanged` records and the records of `unknown` domains
+    """
+    plan = {
+        "add" : [ ],
+        "remove" : [ ],
+        "unchanged" : 0,
+        "unknown" : [ ]
+    }
+
+    # Resolve every domain and read its records once
+    domain_ids = { }
+    existing = { }
+    for domain_name in sorted({ record["domain"] for record in records }):
+        domain_id = client.search_domain(domain_name)
+        if not domain_id:
+            LOGGER.warning("Could not find domain id for domain %s", domain_name)
+            continue
+
+        domain_ids[domain_name] = domain_id
+        rows = existing[domain_name] = { }
+        for row in client.list_records(domain_id):
+            rows.setdefault((row["type"], row["name"]), [ ]).append(dict(row, domain=domain_name, domain_id=domain_id))
+
+    # Group the records by name and type, so record sets with several values are kept
+    desired = { }
+    for record in records:
+        if record["domain"] not in existing:
+            plan["unknown"].append(record)
+            continue
+
+        values = desired.setdefault((record["domain"], record["type"], record["name"]), { })
+        if record["state"] == STATE_PRESENT:
+            values[record["value"]] = record
+
+    for (domain_name, record_type, record_name), values in desired.items():
+        matches = existing[domain_name].get((record_type, record_name), [ ])
+
+        # Remove records holding values no longer asked for
+        stale = [ row for row in matches if row.get("value") not in values ]
+        current = { row.get("value") for row in matches }
+
+        plan["remove"].extend(stale)
+        plan["unchanged"] += len(matches) - len(stale)
+
+        # Count records asked to be absent that are already gone
+        if not values and not matches:
+            plan["unchanged"] += 1
+
+        for value, record in values.items():
+            if value not in current:
+                plan["add"].append(dict(record, domain_id=domain_ids[domain_name], replaces=[ row["uuid"] for row in stale ]))
+
+    return plan
+
+def apply_plan(client : OpnBindClient, plan):
+    """
+    Applies planned changes over the pooled connections of the client
+
+    Removals run before additions, so replaced records never exist twice.
+    A record is not added, if removing the record it replaces failed. Bind
+    is reconfigured once, if anything changed.
+
+    Parameters
+    ----------
+    client : OpnBindClient
+        The bind API client
+    plan : dict
+        The changes computed by `plan_manifest`
+
+    Returns
+    -------
+    dict
+        The number of added, removed, unchanged and failed records
+    """
+    kept = set()
+
+    def remove(row):
+        try:
+            client.remove_record(row["uuid"])
+        except Exception:
+            kept.add(row["uuid"])
+            raise
+
+        LOGGER.info("Removed bind record %s %s.%s", row["type"], row["name"], row["domain"])
+
+    def add(record):
+        if kept.intersection(record.get("replaces", [ ])):
+            raise ValueError("Skipped adding bind record {} {}.{}, the record it replaces still exists".format(record["type"], record["name"], record["domain"]))
+
+        client.add_record(record["domain_id"], record["name"], record["type"], record["value"])
+        LOGGER.info("Added bind record %s %s.%s", record["type"], record["name"], record["domain"])
+
+    summary = {
+        "added" : 0,
+        "removed" : 0,
+        "unchanged" : plan["unchanged"],
+        "failed" : len(plan["unknown"])
+    }
+
+    with ThreadPoolExecutor(max_workers=client.pool_size) as executor:
+        for action, key, changes in ((remove, "removed", plan["remove"]), (add, "added", plan["add"])):
+            futures = [ executor.submit(action, change) for change in changes ]
+
+            for future in futures:
+                try:
+                    future.result()
+                    summary[key] += 1
+                except Exception as ex:
+                    LOGGER.warning(str(ex))
+                    summary["failed"] += 1
+
+    if summary["added"] + summary["removed"] > 0:
+        client.reconfigure()
+
+    LOGGER.info("Applied manifest %s", summary)
+    return summary
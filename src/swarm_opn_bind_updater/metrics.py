@@ -0,0 +1,343 @@
+import json
+import logging
+import threading
+import time
+
+from contextlib import contextmanager
+
+LOGGER = logging.getLogger(__name__)
+
+# Default histogram buckets in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+class Metric:
+    """
+    Base of all metrics, holding one value per label set
+    """
+
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = { }
+        self.lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(label, "")) for label in self.labels)
+
+    def _format_labels(self, key, extra=None):
+        pairs = list(zip(self.labels, key))
+        if extra:
+            pairs.append(extra)
+
+        if not pairs:
+            return ""
+
+        return "{" + ",".join('{}="{}"'.format(label, value.replace("\\", "\\\\").replace('"', '\\"')) for label, value in pairs) + "}"
+
+    def render(self):
+        lines = [
+            "# HELP {} {}".format(self.name, self.help),
+            "# TYPE {} {}".format(self.name, self.type)
+        ]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append("{}{} {}".format(self.name, self._format_labels(key), value))
+
+        return lines
+
+    def snapshot(self):
+        with self.lock:
+            return { ",".join(key) : value for key, value in self.values.items() }
+
+class Counter(Metric):
+    """
+    Monotonically increasing counter
+    """
+
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self.lock:
+            return self.values.get(self._key(labels), 0)
+
+class Gauge(Metric):
+    """
+    Value that can go up and down, optionally read from a function
+    """
+
+    type = "gauge"
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        self.function = None
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self._key(labels)] = value
+
+    def set_function(self, function):
+        """
+        Reads the value of the gauge from a function whenever it is collected
+
+        The function of a labelled gauge returns all values keyed by the
+        tuple of their label values, so labels no longer returned are dropped.
+        """
+        self.function = function
+
+    def _collect(self):
+        function = self.function
+        if function:
+            try:
+                if self.labels:
+                    values = { tuple(str(label) for label in key) : value for key, value in function().items() }
+                    with self.lock:
+                        self.values = values
+                else:
+                    self.set(function())
+            except Exception as ex:
+                LOGGER.debug("Failed to collect gauge %s: %s", self.name, ex)
+
+    def render(self):
+        self._collect()
+        return super().render()
+
+    def snapshot(self):
+        self._collect()
+        return super().snapshot()
+
+class Histogram(Metric):
+    """
+    Distribution of observed values in cumulative buckets
+    """
+
+    type = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            counts, total, count = self.values.get(key) or ([ 0 ] * len(self.buckets), 0.0, 0)
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+
+            self.values[key] = (counts, total + value, count + 1)
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Observes the duration of the enclosed block
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self):
+        lines = [
+            "# HELP {} {}".format(self.name, self.help),
+            "# TYPE {} {}".format(self.name, self.type)
+        ]
+        with self.lock:
+            for key, (counts, total, count) in sorted(self.values.items()):
+                for bound, bucket_count in zip(self.buckets, counts):
+                    lines.append("{}_bucket{} {}".format(self.name, self._format_labels(key, ("le", str(bound))), bucket_count))
+                lines.append("{}_bucket{} {}".format(self.name, self._format_labels(key, ("le", "+Inf")), count))
+                lines.append("{}_sum{} {}".format(self.name, self._format_labels(key), total))
+                lines.append("{}_count{} {}".format(self.name, self._format_labels(key), count))
+
+        return lines
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                ",".join(key) : { "count" : count, "sum" : round(total, 6) }
+                for key, (counts, total, count) in self.values.items()
+            }
+
+class Registry:
+    """
+    Collection of metrics rendered together
+    """
+
+    def __init__(self):
+        self.metrics = [ ]
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """
+        Renders all metrics in the Prometheus text format
+        """
+        lines = [ ]
+        for metric in self.metrics:
+            lines.extend(metric.render())
+
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        """
+        Returns the current values of all metrics, omitting unused ones
+        """
+        return { metric.name : values for metric in self.metrics if (values := metric.snapshot()) }
+
+REGISTRY = Registry()
+
+INSPECT_SECONDS = REGISTRY.register(Histogram(
+    "swarm_opn_bind_inspect_service_seconds",
+    "Latency of docker service inspections"
+))
+API_SECONDS = REGISTRY.register(Histogram(
+    "swarm_opn_bind_api_seconds",
+    "Latency of OPNSense bind API calls",
+    labels=("endpoint",)
+))
+EVENT_SECONDS = REGISTRY.register(Histogram(
+    "swarm_opn_bind_event_seconds",
+    "Time from a docker event until its bind records are processed",
+    labels=("action",)
+))
+RECONFIGURE_SECONDS = REGISTRY.register(Histogram(
+    "swarm_opn_bind_reconfigure_seconds",
+    "Duration of bind service reconfigures"
+))
+
+EVENTS = REGISTRY.register(Counter(
+    "swarm_opn_bind_events_total",
+    "Processed docker service events",
+    labels=("action",)
+))
+API_ERRORS = REGISTRY.register(Counter(
+    "swarm_opn_bind_api_errors_total",
+    "Failed OPNSense bind API calls",
+    labels=("endpoint",)
+))
+API_RETRIES = REGISTRY.register(Counter(
+    "swarm_opn_bind_api_retries_total",
+    "Retried OPNSense bind API calls",
+    labels=("endpoint",)
+))
+RECONFIGURES_COALESCED = REGISTRY.register(Counter(
+    "swarm_opn_bind_reconfigures_coalesced_total",
+    "Bind reconfigure requests saved by coalescing"
+))
+TARGET_EVENTS = REGISTRY.register(Counter(
+    "swarm_opn_bind_target_events_total",
+    "Docker service events applied to or failed on a firewall",
+    labels=("target", "result")
+))
+DRIFTS = REGISTRY.register(Counter(
+    "swarm_opn_bind_drifts_total",
+    "Bind records found drifted from the swarm service labels",
+    labels=("target", "kind")
+))
+
+QUEUE_DEPTH = REGISTRY.register(Gauge(
+    "swarm_opn_bind_queue_depth",
+    "Docker events waiting to be processed"
+))
+TRACKED_SERVICES = REGISTRY.register(Gauge(
+    "swarm_opn_bind_tracked_services",
+    "Services with tracked bind records per firewall",
+    labels=("target",)
+))
+
+class MetricsServer:
+    """
+    Serves the metrics of a registry on a local HTTP `/metrics` endpoint
+
+    Parameters
+    ----------
+    port : int
+        The port to listen on
+    address : str
+        The address to listen on
+    registry : Registry
+        The registry to serve
+    """
+
+    def __init__(self, port, address="127.0.0.1", registry=REGISTRY):
+        # Only the daemon serves metrics, so the CLI does not pay for importing the HTTP server
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+
+                body = registry.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                LOGGER.debug(format, *args)
+
+        self.server = ThreadingHTTPServer((address, port), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, name="metrics-server", daemon=True)
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def start(self):
+        self.thread.start()
+        LOGGER.info("Serving metrics on port %d", self.port)
+        return self
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+class MetricsLogger:
+    """
+    Periodically logs the metrics of a registry as one JSON line
+
+    Parameters
+    ----------
+    interval : float
+        The time in seconds between two dumps
+    registry : Registry
+        The registry to dump
+    """
+
+    def __init__(self, interval, registry=REGISTRY):
+        self.interval = interval
+        self.registry = registry
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="metrics-logger", daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def dump(self):
+        LOGGER.info("Metrics %s", json.dumps(self.registry.snapshot(), sort_keys=True))
+
+    def close(self):
+        self.stopped.set()
+        if self.thread.is_alive():
+            self.thread.join()
+
+        self.dump()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self.dump()
@@ -0,0 +1,325 @@
+import json
+import logging
+import queue
+import threading
+
+from .resilience import is_retryable
+
+LOGGER = logging.getLogger(__name__)
+
+# Default number of worker threads processing events
+DEFAULT_WORKERS = 4
+
+# Default number of events queued per worker before the reader blocks
+DEFAULT_QUEUE_SIZE = 100
+
+# Default interval in seconds in which held dead letters are replayed
+DEFAULT_REPLAY_INTERVAL = 60.0
+
+# Default number of events a consumer of a fan-out may lag behind before a warning
+DEFAULT_FANOUT_LAG_WARNING = 1000
+
+# Marker telling a worker to stop
+_STOP = object()
+
+# Marker telling a worker to replay the dead letters of its services
+_REPLAY = object()
+
+class EventPipeline:
+    """
+    Processes docker service events concurrently
+
+    A reader thread pushes events onto bounded queues, one per worker. Events
+    are sharded by service id, so all events of one service are processed by
+    the same worker in the order they arrived, while events of different
+    services are processed in parallel. A full queue blocks the reader, which
+    gives backpressure towards the docker event stream.
+
+    Parameters
+    ----------
+    handler : callable
+        Processes a single decoded event
+    workers : int
+        The number of worker threads
+    queue_size : int
+        The number of events queued per worker before the reader blocks
+    dead_letters : DeadLetterQueue
+        Holds events failing with a retryable error until they are replayed.
+        If None, such events count as failed.
+    replay_interval : float
+        The interval in seconds in which held dead letters are replayed
+    """
+
+    def __init__(self, handler, workers=DEFAULT_WORKERS, queue_size=DEFAULT_QUEUE_SIZE, dead_letters=None, replay_interval=DEFAULT_REPLAY_INTERVAL):
+        self.handler = handler
+        self.queues = [ queue.Queue(maxsize=queue_size) for _ in range(workers) ]
+        self.workers = [
+            threading.Thread(target=self._work, args=(index, events), name="event-worker-{}".format(index), daemon=True)
+            for index, events in enumerate(self.queues)
+        ]
+        self.reader = None
+        self.stopped = threading.Event()
+
+        self.dead_letters = dead_letters
+        self.replay_interval = replay_interval
+        self.replayer = threading.Thread(target=self._replay_periodically, name="event-replayer", daemon=True)
+
+        self.processed = 0
+        self.failed = 0
+        self.lock = threading.Lock()
+
+        # Held by a worker while it processes an event, one per worker
+        self.shard_locks = [ threading.Lock() for _ in self.queues ]
+
+    def start(self):
+        """
+        Starts the worker threads
+        """
+        for worker in self.workers:
+            worker.start()
+
+        if self.dead_letters is not None:
+            self.replayer.start()
+
+        return self
+
+    def feed(self, raw_events):
+        """
+        Starts the reader thread consuming raw docker events
+
+        The pipeline is stopped when the event stream ends.
+
+        Parameters
+        ----------
+        raw_events : iterable
+            The raw JSON encoded or decoded docker events
+        """
+        self.reader = threading.Thread(target=self._read, args=(raw_events,), name="event-reader", daemon=True)
+        self.reader.start()
+
+    def submit(self, event):
+        """
+        Queues a decoded event on the worker responsible for its service
+
+        Blocks while the queue of that worker is full.
+
+        Parameters
+        ----------
+        event : dict
+            The decoded docker event
+        """
+        self.queues[self._shard(event["Actor"]["ID"])].put(event)
+
+    def replay(self):
+        """
+        Lets every worker replay the held dead letters of its services
+        """
+        for events in self.queues:
+            try:
+                events.put_nowait(_REPLAY)
+            except queue.Full:
+                LOGGER.debug("Postponed replay of dead letters on a full queue")
+
+    def ordered(self, service_id):
+        """
+        Returns the lock held while an event of the service is processed
+
+        Changes of a service made outside of the pipeline, e.g. by an audit,
+        take it to never interleave with the handling of its events.
+
+        Parameters
+        ----------
+        service_id : str
+            The id of the service
+        """
+        return self.shard_locks[self._shard(service_id)]
+
+    def depth(self):
+        """
+        Returns the number of queued events
+        """
+        return sum(events.qsize() for events in self.queues)
+
+    def stop(self):
+        """
+        Signals the pipeline to stop reading events
+        """
+        self.stopped.set()
+
+    def wait(self):
+        """
+        Blocks until the pipeline was signaled to stop
+        """
+        while not self.stopped.wait(0.5):
+            pass
+
+    def close(self, timeout=None):
+        """
+        Stops the reader, lets the workers drain their queues and stops them
+
+        Parameters
+        ----------
+        timeout : float
+            The time in seconds to wait for the reader thread to end
+        """
+        self.stopped.set()
+
+        if self.reader:
+            self.reader.join(timeout)
+
+        for events in self.queues:
+            events.put(_STOP)
+
+        for worker in self.workers:
+            worker.join()
+
+        if self.dead_letters:
+            LOGGER.warning("Dropped %d held events, they are recovered by the next reconciliation", len(self.dead_letters))
+
+        LOGGER.info("Processed %d events, %d failed", self.processed, self.failed)
+
+    def _read(self, raw_events):
+        try:
+            for raw_event in raw_events:
+                if self.stopped.is_set():
+                    break
+
+                # Accept raw JSON events as well as already decoded ones
+                event = raw_event if isinstance(raw_event, dict) else json.loads(raw_event)
+                self.submit(event)
+
+        except Exception as ex:
+            if not self.stopped.is_set():
+                LOGGER.error("Failed to read docker events: %s", ex)
+
+        finally:
+            self.stopped.set()
+
+    def _shard(self, service_id):
+        return hash(service_id) % len(self.queues)
+
+    def _replay_periodically(self):
+        while not self.stopped.wait(self.replay_interval):
+            if len(self.dead_letters):
+                self.replay()
+
+    def _work(self, index, events):
+        while True:
+            event = events.get()
+            if event is _STOP:
+                return
+
+            if event is _REPLAY:
+                self._replay(index)
+                continue
+
+            # Keep the order of events behind a held event of the same service
+            service_id = event["Actor"]["ID"]
+            if self.dead_letters is not None and self.dead_letters.holds(service_id):
+                self.dead_letters.put(service_id, event)
+                continue
+
+            self._process(event)
+
+    def _replay(self, index):
+        held = self.dead_letters.take(lambda service_id: self._shard(service_id) == index)
+
+        for service_id, service_events in held.items():
+            LOGGER.info("Replaying %d events of service %s", len(service_events), service_id)
+
+            for position, event in enumerate(service_events):
+                if not self._process(event):
+                    # Hold the failed event and the events behind it again
+                    for remaining in service_events[position + 1:]:
+                        self.dead_letters.put(service_id, remaining)
+                    break
+
+    def _process(self, event):
+        service_id = event["Actor"]["ID"]
+
+        try:
+            with self.shard_locks[self._shard(service_id)]:
+                self.handler(event)
+            with self.lock:
+                self.processed += 1
+
+        except Exception as ex:
+            if self.dead_letters is not None and is_retryable(ex):
+                LOGGER.warning("Holding event %s of service %s for replay: %s", event.get("Action"), service_id, ex)
+                self.dead_letters.put(service_id, event)
+                return False
+
+            LOGGER.exception("Failed to process event %s of service %s", event.get("Action"), service_id)
+            with self.lock:
+                self.failed += 1
+
+        return True
+
+class EventFanOut:
+    """
+    Copies one event stream to several consumers, each reading at its own pace
+
+    A reader thread decodes every event once and appends it to one unbounded
+    queue per consumer, so a slow consumer never holds back the others. A
+    warning is logged when a consumer lags far behind.
+
+    Parameters
+    ----------
+    raw_events : iterable
+        The raw JSON encoded or decoded docker events
+    consumers : int
+        The number of consumers
+    on_event : callable
+        Called with every decoded event before it is handed out
+    lag_warning : int
+        The number of events a consumer may lag behind before a warning
+    """
+
+    def __init__(self, raw_events, consumers, on_event=None, lag_warning=DEFAULT_FANOUT_LAG_WARNING):
+        self.raw_events = raw_events
+        self.on_event = on_event
+        self.lag_warning = lag_warning
+
+        self.queues = [ queue.Queue() for _ in range(consumers) ]
+        self.streams = [ self._consume(events) for events in self.queues ]
+        self.reader = threading.Thread(target=self._read, name="event-fanout", daemon=True)
+
+    def start(self):
+        """
+        Starts the reader thread
+        """
+        self.reader.start()
+        return self
+
+    def lag(self):
+        """
+        Returns the number of events each consumer has not read yet
+        """
+        return [ events.qsize() for events in self.queues ]
+
+    def _read(self):
+        try:
+            for raw_event in self.raw_events:
+                event = raw_event if isinstance(raw_event, dict) else json.loads(raw_event)
+                if self.on_event:
+                    self.on_event(event)
+
+                for index, events in enumerate(self.queues):
+                    events.put(event)
+                    if events.qsize() == self.lag_warning:
+                        LOGGER.warning("Event consumer %d lags %d events behind", index, self.lag_warning)
+
+        except Exception as ex:
+            LOGGER.error("Failed to read docker events: %s", ex)
+
+        finally:
+            for events in self.queues:
+                events.put(_STOP)
+
+    def _consume(self, events):
+        while True:
+            event = events.get()
+            if event is _STOP:
+                return
+
+            yield event
@@ -0,0 +1,195 @@
+import itertools
+import json
+import logging
+import threading
+
+from .client import OpnBindClient
+
+LOGGER = logging.getLogger(__name__)
+
+# The actions of a change set
+ACTION_ADD = "add"
+ACTION_REMOVE = "remove"
+ACTION_RECONFIGURE = "reconfigure"
+
+class ChangeSet:
+    """
+    Ordered, thread safe list of the bind API changes a dry run would have sent
+    """
+
+    def __init__(self):
+        self.changes = [ ]
+        self.lock = threading.Lock()
+
+    def __iter__(self):
+        with self.lock:
+            return iter(list(self.changes))
+
+    def __len__(self):
+        with self.lock:
+            return len(self.changes)
+
+    def record(self, change):
+        with self.lock:
+            self.changes.append(change)
+
+    def to_json(self):
+        """
+        Returns the changes as a list of dicts
+        """
+        return [ dict(change) for change in self ]
+
+class DryRunClient(OpnBindClient):
+    """
+    Bind API client that records changes instead of sending them
+
+    Domains and records are read from the bind API, or from a snapshot taken
+    with `take_snapshot`, and indexed like by `OpnBindClient`. Adding or
+    removing a record and reconfiguring bind only update the indexes and the
+    change set, so later lookups see the planned state.
+
+    Parameters
+    ----------
+    snapshot : dict
+        The domains and records to read instead of calling the bind API or None
+    """
+
+    def __init__(self, api_key, api_secret, api_gw_url, snapshot=None, **options):
+        super().__init__(api_key, api_secret, api_gw_url, **options)
+        self.snapshot = snapshot
+        self.changes = ChangeSet()
+        self.planned_ids = itertools.count(1)
+
+    def fetch_domains(self):
+        if self.snapshot != None:
+            return self.snapshot["domains"]
+
+        return super().fetch_domains()
+
+    def list_records(self, domain_id=None, **options):
+        if self.snapshot != None:
+            return [ dict(row) for row in self.snapshot["records"] if not domain_id or row["domain"] == domain_id ]
+
+        return super().list_records(domain_id, **options)
+
+    def add_record(self, domain_id, name, record_type, value):
+        uuid = "planned-{}".format(next(self.planned_ids))
+        self.changes.record({ "action" : ACTION_ADD, "domain" : self._domain_name(domain_id), "name" : name, "type" : record_type, "value" : value })
+        self.records.add(domain_id, record_type, name, uuid)
+        self.owned[uuid] = { "domain_id" : domain_id, "name" : name, "type" : record_type }
+
+        LOGGER.info("Would add bind record %s %s.%s -> %s", record_type, name, self._domain_name(domain_id), value)
+        return { "result" : "saved", "uuid" : uuid }
+
+    def remove_record(self, record_id):
+        change = { "action" : ACTION_REMOVE, "id" : record_id }
+
+        key = self.records.keys.get(record_id)
+        if key:
+            domain_id, record_type, name = key
+            change.update(domain=self._domain_name(domain_id), name=name, type=record_type)
+
+        self.changes.record(change)
+        self.records.discard(record_id)
+        self.owned.pop(record_id, None)
+
+        LOGGER.info("Would remove bind record %s", record_id)
+        return { "result" : "deleted" }
+
+    def reconfigure(self):
+        self.changes.record({ "action" : ACTION_RECONFIGURE })
+
+        LOGGER.info("Would reconfigure bind service")
+        return { "status" : "ok" }
+
+    def _domain_name(self, domain_id):
+        for name, (known_id, _) in self.domains.domains.items():
+            if known_id == domain_id:
+                return name
+
+        return domain_id
+
+def take_snapshot(client : OpnBindClient):
+    """
+    Reads the domains and all records of a firewall for planning offline
+
+    Returns
+    -------
+    dict
+        The domain payload of the bind API under `domains` and the record
+        rows under `records`
+    """
+    domains = client.fetch_domains()
+
+    # The record rows name their domain, the index needs its id
+    return {
+        "domains" : domains,
+        "records" : [ dict(row, domain=domain_id) for domain_id in domains for row in client.list_records(domain_id) ]
+    }
+
+class ServiceSpecs:
+    """
+    Stands in for the docker API client with exported service specs
+
+    Offers the service listing and inspection used by the reconciliation, so
+    a change set can be planned without access to the swarm, e.g. in CI.
+
+    Parameters
+    ----------
+    service_payloads : list
+        The service specs as printed by `docker service inspect`
+    """
+
+    def __init__(self, service_payloads):
+        self.service_payloads = { service_payload["ID"] : service_payload for service_payload in service_payloads }
+
+    def services(self, filters=None):
+        return list(self.service_payloads.values())
+
+    def inspect_service(self, service_id):
+        return self.service_payloads[service_id]
+
+def read_service_specs(stream):
+    """
+    Reads exported service specs, e.g. the output of `docker service inspect $(docker service ls -q)`
+
+    Raises
+    ------
+    ValueError
+        If the specs are malformed
+    """
+    payload = json.load(stream)
+    if isinstance(payload, dict):
+        payload = [ payload ]
+
+    if not isinstance(payload, list) or not all(isinstance(service_payload, dict) and "ID" in service_payload and "Spec" in service_payload for service_payload in payload):
+        raise ValueError("The service specs must be a list of services as printed by docker service inspect")
+
+    return ServiceSpecs(payload)
+
+def format_changes(changes):
+    """
+    Formats a change set as human readable lines
+
+    Returns
+    -------
+    str
+        One line per change, `+` for additions, `-` for removals and `~` for reconfigures
+    """
+    lines = [ ]
+    for change in changes:
+        match change["action"]:
+            case "add":
+                lines.append("+ {} {}.{} -> {}".format(change["type"], change["name"], change["domain"], change["value"]))
+            case "remove":
+                if "name" in change:
+                    lines.append("- {} {}.{} ({})".format(change["type"], change["name"], change["domain"], change["id"]))
+                else:
+                    lines.append("- {}".format(change["id"]))
+            case "reconfigure":
+                lines.append("~ reconfigure bind")
+
+    if not lines:
+        lines.append("No changes")
+
+    return "\n".join(lines)
@@ -0,0 +1,284 @@
+import logging
+
+from concurrent.futures import ThreadPoolExecutor
+
+from .client import OpnBindClient
+from .labels import HOST_RECORD_KEYS, parse_host_records
+from .resilience import is_retryable
+from .eventlog import STAGE_REMOVE, stage, record_touched
+
+LOGGER = logging.getLogger(__name__)
+
+def read_desired_services(api_client, mappings=None):
+    """
+    Reads the host records of all swarm services with one service listing
+
+    Parameters
+    ----------
+    api_client : docker.APIClient
+        The docker API client
+    mappings : MappingCache
+        The cache the host records are parsed into or None
+
+    Returns
+    -------
+    dict
+        The host records keyed by selector, keyed by service id. Services
+        without host records are omitted.
+    """
+    desired = { }
+
+    for service_payload in api_client.services():
+        service_id = service_payload["ID"]
+        if mappings != None:
+            host_records = mappings.parse(service_payload)
+        else:
+            host_records = parse_host_records(service_payload["Spec"].get("Labels"), service_id)
+
+        if host_records:
+            desired[service_id] = host_records
+
+    return desired
+
+def refresh_records(client : OpnBindClient, domain_names):
+    """
+    Refreshes the record index of the client for the given domains
+
+    Parameters
+    ----------
+    client : OpnBindClient
+        The bind API client
+    domain_names : iterable
+        The names of the domains to read
+    """
+    for domain_name in domain_names:
+        domain_id = client.search_domain(domain_name)
+        if not domain_id:
+            LOGGER.warning("Could not find domain id for domain %s", domain_name)
+            continue
+
+        client.records.refresh(domain_id)
+
+def remove_service_records(client : OpnBindClient, service):
+    """
+    Removes all bind records of a service in one pass
+
+    Records the updater did not add, e.g. adopted records created by hand,
+    are only released from tracking and left in place.
+
+    Parameters
+    ----------
+    client : OpnBindClient
+        The bind API client
+    service : dict
+        The active service holding its records keyed by selector
+
+    Returns
+    -------
+    dict
+        The records that could not be removed because of a retryable error,
+        keyed by selector. Records failing otherwise, e.g. because they are
+        already gone, are dropped.
+    """
+    remaining = { }
+
+    for selector, host_record in service["records"].items():
+        if not client.owns(host_record.get("id")):
+            LOGGER.info("Released bind record %s of mapping %s of service %s, it was not added by the updater", host_record.get("id"), selector, service["id"])
+            record_touched("released", host_record)
+            continue
+
+        try:
+            with stage(STAGE_REMOVE):
+                client.remove_record(host_record["id"])
+            LOGGER.debug("Removed bind record %s", host_record)
+            record_touched("removed", host_record)
+        except Exception as ex:
+            LOGGER.warning(str(ex))
+            if is_retryable(ex):
+                remaining[selector] = host_record
+
+    return remaining
+
+def recover_service_records(client : OpnBindClient, service_id, host_records):
+    """
+    Finds the bind records of a service that is not tracked from its host records
+
+    Parameters
+    ----------
+    client : OpnBindClient
+        The bind API client
+    service_id : str
+        The id of the service
+    host_records : dict
+        The host records keyed by selector, e.g. from the mapping cache
+
+    Returns
+    -------
+    dict
+        The active service holding the existing records keyed by selector
+        or None, if none of its records exist
+    """
+    records = { }
+
+    for selector, host_record in host_records.items():
+        domain_id = client.search_domain(host_record["domain"])
+        record_id = client.records.lookup(domain_id, host_record["type"], host_record["host"]) if domain_id else None
+
+        if record_id:
+            records[selector] = dict(host_record, domain_id=domain_id, id=record_id)
+
+    if not records:
+        return None
+
+    return { "id" : service_id, "records" : records }
+
+def reconcile_services(client : OpnBindClient, api_client, active_services, mappings=None):
+    """
+    Reconciles the labels of the swarm services with the bind records
+
+    Lists all swarm services and the bind records of all referenced domains in
+    bulk, computes the difference in memory and only applies the necessary
+    changes. Records of services that are not tracked yet are added or, if
+    they already exist, adopted. Tracked records whose mapping changed or
+    was dropped, e.g. while the daemon was not running, are replaced or
+    removed, and tracked records deleted on the firewall are added again.
+    Records of tracked services that no longer exist are removed, as are
+    records the updater added but no longer tracks, e.g. because it stopped
+    before tracking them. Records the updater did not add are never removed.
+    Bind is reconfigured once, if anything changed.
+
+    Parameters
+    ----------
+    client : OpnBindClient
+        The bind API client
+    api_client : docker.APIClient
+        The docker API client
+    active_services : dict
+        The repository of active services, updated in place
+    mappings : MappingCache
+        The cache the host records of the services are parsed into or None
+
+    Returns
+    -------
+    dict
+        The number of added, adopted and removed records
+    """
+    desired = read_desired_services(api_client, mappings)
+
+    domain_names = { host_record["domain"] for host_records in desired.values() for host_record in host_records.values() }
+    domain_names.update(host_record["domain"] for service in active_services.values() for host_record in service["records"].values() if host_record.get("domain"))
+    refresh_records(client, sorted(domain_names))
+
+    # Keep the tracked records still matching their mapping, the others are stale
+    kept = { }
+    removals = [ ]
+
+    for service_id, service in active_services.items():
+        host_records = desired.get(service_id, { })
+        records = { }
+        stale = { }
+
+        for selector, host_record in service["records"].items():
+            desired_record = host_records.get(selector)
+            domain_id = client.search_domain(host_record.get("domain"))
+
+            if domain_id and host_record.get("id") not in client.records.keys:
+                # Deleted on the firewall, the mapping is added again
+                LOGGER.info("Bind record of mapping %s of service %s is gone", selector, service_id)
+                client.owned.pop(host_record.get("id"), None)
+            elif desired_record and all(desired_record[key] == host_record.get(key) for key in HOST_RECORD_KEYS):
+                records[selector] = host_record
+            else:
+                stale[selector] = host_record
+
+        kept[service_id] = records
+        if stale:
+            removals.append({ "id" : service_id, "records" : stale })
+
+    # Records we added to the domains read, that no service tracks any more
+    tracked_ids = { host_record.get("id") for service in active_services.values() for host_record in service["records"].values() }
+    leaked = [ record_id for record_id in list(client.owned) if record_id in client.records.keys and record_id not in tracked_ids ]
+
+    # Only records we added are removed, the others are released
+    released = { host_record.get("id") for service in removals for host_record in service["records"].values() if not client.owns(host_record.get("id")) }
+
+    failed = 0
+    with ThreadPoolExecutor(max_workers=client.pool_size) as executor:
+        # Remove stale records first, so a mapping with a changed value is not adopted by its old record
+        removed = executor.map(lambda service: (service, remove_service_records(client, service)), removals)
+        leaked_futures = [ executor.submit(client.remove_record, record_id) for record_id in leaked ]
+
+        for service, remaining in removed:
+            failed += len(remaining)
+            kept[service["id"]].update(remaining)
+
+        for record_id, future in zip(leaked, leaked_futures):
+            try:
+                future.result()
+                LOGGER.info("Removed untracked bind record %s", record_id)
+            except Exception as ex:
+                LOGGER.warning(str(ex))
+                failed += 1
+
+        # Compute the additions
+        additions = [ ]
+        tracked = { }
+        adopted = 0
+
+        for service_id, host_records in desired.items():
+            for selector, host_record in host_records.items():
+                if selector in kept.get(service_id, { }):
+                    continue
+
+                host_record["domain_id"] = client.search_domain(host_record["domain"])
+                if not host_record["domain_id"]:
+                    continue
+
+                record_id = client.records.lookup(host_record["domain_id"], host_record["type"], host_record["host"])
+                if record_id:
+                    host_record["id"] = record_id
+                    tracked.setdefault(service_id, { })[selector] = host_record
+                    adopted += 1
+                else:
+                    additions.append((service_id, selector, host_record))
+
+        # Apply the additions over the pooled connections
+        def add(change):
+            service_id, selector, host_record = change
+            result = client.add_record(host_record["domain_id"], host_record["host"], host_record["type"], host_record["value"])
+            host_record["id"] = result.get("uuid")
+            LOGGER.debug("Added bind record %s", host_record)
+            return change
+
+        for future in [ executor.submit(add, change) for change in additions ]:
+            try:
+                service_id, selector, host_record = future.result()
+                tracked.setdefault(service_id, { })[selector] = host_record
+            except Exception as ex:
+                LOGGER.warning(str(ex))
+                failed += 1
+
+    # Track all records of a service at once, only writing the changed services
+    for service_id in set(kept) | set(tracked):
+        records = dict(kept.get(service_id, { }), **tracked.get(service_id, { }))
+        service = active_services.get(service_id)
+
+        if not records:
+            active_services.pop(service_id, None)
+        elif not service or records != service["records"]:
+            active_services[service_id] = { "id" : service_id, "records" : records }
+
+    summary = {
+        "services" : len(desired),
+        "added" : len(additions),
+        "adopted" : adopted,
+        "removed" : sum(1 for service in removals for host_record in service["records"].values() if host_record.get("id") not in released) + len(leaked),
+        "failed" : failed
+    }
+
+    if len(additions) + summary["removed"] > failed:
+        client.reconfigure()
+
+    LOGGER.info("Reconciled services %s", summary)
+    return summary
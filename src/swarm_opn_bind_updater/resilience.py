@@ -0,0 +1,225 @@
+import contextvars
+import logging
+import random
+import threading
+import time
+
+from contextlib import contextmanager
+
+LOGGER = logging.getLogger(__name__)
+
+# Default number of retries of a failed bind API call
+DEFAULT_RETRIES = 3
+
+# Default base and maximum delay in seconds between two retries
+DEFAULT_BACKOFF = 0.5
+DEFAULT_MAX_BACKOFF = 10.0
+
+# Default number of consecutive failures opening the circuit
+DEFAULT_FAILURE_THRESHOLD = 5
+
+# Default time in seconds the circuit stays open before a trial call
+DEFAULT_RESET_TIMEOUT = 30.0
+
+# HTTP status codes worth retrying
+RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+
+# Called before every bind API request of the current thread or task, e.g. to limit the rate of an audit
+REQUEST_PACE = contextvars.ContextVar("request_pace", default=None)
+
+class BindApiError(Exception):
+    """
+    Error accessing the bind API
+
+    Parameters
+    ----------
+    message : str
+        The error message
+    status_code : int
+        The HTTP status code or None, if no response was received
+    retryable : bool
+        Whether repeating the operation later may succeed
+    """
+
+    def __init__(self, message, status_code=None, retryable=False):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retryable = retryable
+
+class CircuitOpenError(BindApiError):
+    """
+    Raised instead of calling the bind API while the circuit is open
+    """
+
+    def __init__(self, message):
+        super().__init__(message, retryable=True)
+
+def is_retryable(ex):
+    """
+    Returns whether repeating the operation that raised the error may succeed
+    """
+    return getattr(ex, "retryable", False)
+
+def backoff_delay(attempt, backoff=DEFAULT_BACKOFF, max_backoff=DEFAULT_MAX_BACKOFF):
+    """
+    Returns the jittered exponential delay in seconds before the given retry
+
+    Parameters
+    ----------
+    attempt : int
+        The number of the retry, starting with 0
+    """
+    return random.uniform(0, min(max_backoff, backoff * (2 ** attempt)))
+
+@contextmanager
+def paced(pace):
+    """
+    Calls `pace` before every bind API request made within the block, retries included
+
+    Parameters
+    ----------
+    pace : callable
+        Waits until the next request may be made, raises to make no further requests
+    """
+    token = REQUEST_PACE.set(pace)
+    try:
+        yield
+    finally:
+        REQUEST_PACE.reset(token)
+
+def pace_request():
+    """
+    Waits until the current thread or task may make its next bind API request
+    """
+    pace = REQUEST_PACE.get()
+    if pace != None:
+        pace()
+
+class CircuitBreaker:
+    """
+    Pauses calls to the bind API while the firewall is down
+
+    After `failure_threshold` consecutive failures the circuit opens and calls
+    fail fast for `reset_timeout` seconds. Then a single trial call is let
+    through. If it succeeds, the circuit closes and the listeners are
+    notified, otherwise it opens again.
+
+    Parameters
+    ----------
+    failure_threshold : int
+        The number of consecutive failures opening the circuit
+    reset_timeout : float
+        The time in seconds the circuit stays open before a trial call
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, failure_threshold=DEFAULT_FAILURE_THRESHOLD, reset_timeout=DEFAULT_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self.state = CircuitBreaker.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+        self.listeners = [ ]
+        self.lock = threading.Lock()
+
+    def on_close(self, listener):
+        """
+        Registers a callable notified whenever the circuit closes again
+        """
+        self.listeners.append(listener)
+
+    def is_open(self):
+        with self.lock:
+            return self.state == CircuitBreaker.OPEN and time.monotonic() - self.opened_at < self.reset_timeout
+
+    def before_call(self):
+        """
+        Checks whether a call may pass
+
+        Raises
+        ------
+        CircuitOpenError
+            If the circuit is open
+        """
+        with self.lock:
+            if self.state == CircuitBreaker.CLOSED:
+                return
+
+            if self.state == CircuitBreaker.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = CircuitBreaker.HALF_OPEN
+                self.trial = False
+
+            if self.state == CircuitBreaker.HALF_OPEN and not self.trial:
+                self.trial = True
+                return
+
+        raise CircuitOpenError("Circuit to bind API is open")
+
+    def record_success(self):
+        with self.lock:
+            closed = self.state != CircuitBreaker.CLOSED
+
+            self.state = CircuitBreaker.CLOSED
+            self.failures = 0
+            self.opened_at = None
+
+        if closed:
+            LOGGER.info("Circuit to bind API closed")
+            for listener in self.listeners:
+                listener()
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+
+            if self.state == CircuitBreaker.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != CircuitBreaker.OPEN:
+                    LOGGER.warning("Circuit to bind API opened after %d failures", self.failures)
+
+                self.state = CircuitBreaker.OPEN
+                self.opened_at = time.monotonic()
+
+class DeadLetterQueue:
+    """
+    Holds events that failed with a retryable error, in order per service
+
+    Once an event of a service is held, all later events of the same service
+    are held as well, so replaying them keeps their order.
+    """
+
+    def __init__(self):
+        self.events = { }
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        with self.lock:
+            return sum(len(events) for events in self.events.values())
+
+    def holds(self, service_id):
+        with self.lock:
+            return service_id in self.events
+
+    def put(self, service_id, event):
+        with self.lock:
+            self.events.setdefault(service_id, [ ]).append(event)
+
+    def take(self, predicate):
+        """
+        Removes and returns the held events of all services matching the predicate
+
+        Returns
+        -------
+        dict
+            The events in their original order keyed by service id
+        """
+        with self.lock:
+            taken = { service_id : events for service_id, events in self.events.items() if predicate(service_id) }
+            for service_id in taken:
+                del self.events[service_id]
+
+        return taken
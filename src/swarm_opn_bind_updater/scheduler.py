@@ -0,0 +1,166 @@
+import logging
+import threading
+import time
+
+from .metrics import RECONFIGURE_SECONDS, RECONFIGURES_COALESCED
+from .eventlog import current_trace, log_reconfigure
+
+LOGGER = logging.getLogger(__name__)
+
+# Default quiet window in seconds after the last request before reconfiguring
+DEFAULT_RECONFIGURE_DELAY = 2.0
+
+# Default maximum time in seconds a pending reconfigure may be postponed
+DEFAULT_RECONFIGURE_MAX_DELAY = 10.0
+
+class ReconfigureScheduler:
+    """
+    Coalesces bursts of bind reconfigure requests
+
+    Every change to the bind database requests a reconfigure. Instead of
+    restarting bind for each request, the scheduler waits until no further
+    request arrived for `delay` seconds and then reconfigures once. A steady
+    trickle of requests is flushed at the latest `max_delay` seconds after the
+    first pending request.
+
+    Parameters
+    ----------
+    reconfigure : callable
+        Performs the actual reconfigure of the bind service
+    delay : float
+        The quiet window in seconds after the last request
+    max_delay : float
+        The maximum time in seconds a pending reconfigure may be postponed
+    """
+
+    def __init__(self, reconfigure, delay=DEFAULT_RECONFIGURE_DELAY, max_delay=DEFAULT_RECONFIGURE_MAX_DELAY):
+        self.reconfigure = reconfigure
+        self.delay = delay
+        self.max_delay = max_delay
+
+        self.requested = 0
+        self.performed = 0
+        self.saved = 0
+        self.failed = 0
+
+        self.pending = 0
+        self.first_request = None
+        self.last_request = None
+
+        # Correlation ids of the events the pending reconfigure was requested by
+        self.correlation_ids = [ ]
+
+        self.closed = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._run, name="reconfigure-scheduler", daemon=True)
+
+    def start(self):
+        """
+        Starts the background thread performing the reconfigures
+        """
+        self.thread.start()
+        return self
+
+    def request(self):
+        """
+        Requests a reconfigure of the bind service
+        """
+        trace = current_trace()
+
+        with self.condition:
+            now = time.monotonic()
+
+            self.requested += 1
+            self.pending += 1
+            self.last_request = now
+            if self.first_request == None:
+                self.first_request = now
+            if trace != None:
+                self.correlation_ids.append(trace.correlation_id)
+
+            self.condition.notify()
+
+    def flush(self):
+        """
+        Performs a pending reconfigure immediately
+        """
+        with self.condition:
+            pending, correlation_ids = self._take_pending()
+
+        if pending:
+            self._perform(pending, correlation_ids)
+
+    def close(self):
+        """
+        Stops the background thread and flushes a pending reconfigure
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+
+        if self.thread.is_alive():
+            self.thread.join()
+
+        self.flush()
+
+        LOGGER.info("Performed %d bind reconfigures for %d requests, saved %d", self.performed, self.requested, self.saved)
+
+    def _run(self):
+        while True:
+            with self.condition:
+                if self.closed:
+                    return
+
+                if not self.pending:
+                    self.condition.wait()
+                    continue
+
+                deadline = min(self.last_request + self.delay, self.first_request + self.max_delay)
+                remaining = deadline - time.monotonic()
+                if remaining > 0:
+                    self.condition.wait(remaining)
+                    continue
+
+                pending, correlation_ids = self._take_pending()
+
+            self._perform(pending, correlation_ids)
+
+    def _take_pending(self):
+        pending = self.pending
+        correlation_ids = self.correlation_ids
+
+        self.pending = 0
+        self.first_request = None
+        self.last_request = None
+        self.correlation_ids = [ ]
+
+        return pending, correlation_ids
+
+    def _perform(self, pending, correlation_ids):
+        start = time.perf_counter()
+        try:
+            with RECONFIGURE_SECONDS.time():
+                self.reconfigure()
+        except Exception as ex:
+            LOGGER.error("Failed to reconfigure bind service: %s", ex)
+            log_reconfigure(time.perf_counter() - start, pending, correlation_ids, failed=True)
+
+            # Keep the requests pending, so the next window retries
+            with self.condition:
+                self.failed += 1
+                self.pending += pending
+                self.correlation_ids[:0] = correlation_ids
+                now = time.monotonic()
+                self.last_request = now
+                if self.first_request == None:
+                    self.first_request = now
+
+            return
+
+        with self.condition:
+            self.performed += 1
+            self.saved += pending - 1
+
+        RECONFIGURES_COALESCED.inc(pending - 1)
+
+        log_reconfigure(time.perf_counter() - start, pending, correlation_ids)
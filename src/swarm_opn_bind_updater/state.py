@@ -0,0 +1,256 @@
+import json
+import logging
+import os
+import threading
+
+from collections.abc import MutableMapping
+
+LOGGER = logging.getLogger(__name__)
+
+# Default number of journal entries after which a snapshot is written
+DEFAULT_COMPACT_EVERY = 1000
+
+class MemoryStateStore:
+    """
+    State store keeping nothing, i.e. the state lives in memory only
+    """
+
+    def load(self):
+        return { }
+
+    def put(self, service_id, service):
+        pass
+
+    def delete(self, service_id):
+        pass
+
+    def close(self):
+        pass
+
+class JournalStateStore:
+    """
+    Crash-safe state store based on an append-only journal and a snapshot
+
+    Every change is appended to the journal and synced to disk before the
+    call returns. After `compact_every` journal entries the complete state
+    is written to a snapshot, which atomically replaces the previous one,
+    and the journal is truncated. Loading reads the snapshot and replays the
+    journal, so it costs O(records). A torn last journal line left by a
+    crash is cut off.
+
+    A read-only store, e.g. of a dry run, never creates, cuts off or writes
+    a file. Its changes are kept in memory only.
+
+    Parameters
+    ----------
+    path : str
+        The directory holding the snapshot and journal files
+    compact_every : int
+        The number of journal entries after which a snapshot is written
+    fsync : bool
+        Whether every change is synced to disk before returning
+    read_only : bool
+        True to only read the state, e.g. while a daemon writes it
+    """
+
+    def __init__(self, path, compact_every=DEFAULT_COMPACT_EVERY, fsync=True, read_only=False):
+        self.path = path
+        self.snapshot_path = os.path.join(path, "state.snapshot.json")
+        self.journal_path = os.path.join(path, "state.journal")
+        self.compact_every = compact_every
+        self.fsync = fsync
+        self.read_only = read_only
+
+        self.state = { }
+        self.entries = 0
+        self.journal = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        """
+        Reads the snapshot, replays the journal and opens the journal for appending, unless read-only
+
+        Returns
+        -------
+        dict
+            The persisted services keyed by service id
+        """
+        if not self.read_only:
+            os.makedirs(self.path, exist_ok=True)
+
+        state = { }
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, "r", encoding="utf-8") as snapshot:
+                state = json.load(snapshot)
+
+        entries = 0
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, "rb" if self.read_only else "r+b") as journal:
+                offset = 0
+                for line in journal:
+                    try:
+                        if not line.endswith(b"\n"):
+                            raise ValueError("Missing end of line")
+
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Cut the torn entry off, so new entries start on a fresh line, it may be in progress when read-only
+                        LOGGER.warning("Ignoring torn journal entry in %s", self.journal_path)
+                        if not self.read_only:
+                            journal.truncate(offset)
+                        break
+
+                    self._apply(state, entry)
+                    entries += 1
+                    offset += len(line)
+
+        with self.lock:
+            self.state = state
+            self.entries = entries
+            self.journal = None if self.read_only else open(self.journal_path, "a", encoding="utf-8")
+
+        LOGGER.info("Loaded %d services from %s", len(state), self.path)
+        return dict(state)
+
+    def put(self, service_id, service):
+        self._append({ "op" : "put", "id" : service_id, "service" : service })
+
+    def delete(self, service_id):
+        self._append({ "op" : "delete", "id" : service_id })
+
+    def compact(self):
+        """
+        Writes the complete state to a new snapshot and truncates the journal
+        """
+        with self.lock:
+            self._compact()
+
+    def close(self):
+        with self.lock:
+            if self.journal:
+                self.journal.close()
+                self.journal = None
+
+    def _append(self, entry):
+        line = json.dumps(entry, separators=(",", ":"))
+
+        with self.lock:
+            if self.read_only:
+                self._apply(self.state, entry)
+                return
+
+            self.journal.write(line + "\n")
+            self.journal.flush()
+            if self.fsync:
+                os.fsync(self.journal.fileno())
+
+            self._apply(self.state, entry)
+            self.entries += 1
+
+            if self.entries >= self.compact_every:
+                self._compact()
+
+    def _compact(self):
+        temporary_path = self.snapshot_path + ".tmp"
+        with open(temporary_path, "w", encoding="utf-8") as snapshot:
+            json.dump(self.state, snapshot, separators=(",", ":"))
+            snapshot.flush()
+            os.fsync(snapshot.fileno())
+
+        os.replace(temporary_path, self.snapshot_path)
+        self._sync_directory()
+
+        # Replaying the old journal over the new snapshot is harmless, so a
+        # crash before the journal is truncated loses nothing
+        self.journal.close()
+        self.journal = open(self.journal_path, "w", encoding="utf-8")
+        self.entries = 0
+
+    def _sync_directory(self):
+        try:
+            descriptor = os.open(self.path, os.O_RDONLY)
+        except OSError:
+            return
+
+        try:
+            os.fsync(descriptor)
+        except OSError:
+            pass
+        finally:
+            os.close(descriptor)
+
+    @staticmethod
+    def _apply(state, entry):
+        match entry["op"]:
+            case "put":
+                state[entry["id"]] = entry["service"]
+
+            case "delete":
+                state.pop(entry["id"], None)
+
+class ServiceRepository(MutableMapping):
+    """
+    Repository of active services backed by a state store
+
+    Behaves like a dict. Every change is written to the state store before
+    it becomes visible in memory.
+    """
+
+    def __init__(self, store=None):
+        self.store = store or MemoryStateStore()
+        self.services = { }
+        self.lock = threading.RLock()
+
+    def open(self, store):
+        """
+        Replaces the state store and loads the persisted services from it
+
+        Parameters
+        ----------
+        store
+            The state store, e.g. a JournalStateStore
+        """
+        with self.lock:
+            self.store.close()
+            self.store = store
+            self.services = store.load()
+
+    def close(self):
+        """
+        Closes the state store, keeping the services in memory only
+        """
+        with self.lock:
+            self.store.close()
+            self.store = MemoryStateStore()
+
+    def snapshot(self):
+        """
+        Returns a copy of the active services
+        """
+        with self.lock:
+            return dict(self.services)
+
+    def __getitem__(self, service_id):
+        return self.services[service_id]
+
+    def __setitem__(self, service_id, service):
+        with self.lock:
+            self.store.put(service_id, service)
+            self.services[service_id] = service
+
+    def __delitem__(self, service_id):
+        with self.lock:
+            if service_id not in self.services:
+                raise KeyError(service_id)
+
+            self.store.delete(service_id)
+            del self.services[service_id]
+
+    def __iter__(self):
+        return iter(self.snapshot())
+
+    def __len__(self):
+        return len(self.services)
+
+    def __contains__(self, service_id):
+        return service_id in self.services
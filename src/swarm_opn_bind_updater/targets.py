@@ -0,0 +1,122 @@
+import logging
+import re
+
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+LOGGER = logging.getLogger(__name__)
+
+class Target:
+    """
+    Firewall whose bind service receives the record changes
+
+    Parameters
+    ----------
+    api_key : str
+        The API key used for authentication
+    api_secret : str
+        The API secret used for authentication
+    api_gw_url : str
+        The base URL for accessing the OPNSense API
+    """
+
+    def __init__(self, api_key, api_secret, api_gw_url):
+        self.api_key = api_key
+        self.api_secret = api_secret
+        self.api_gw_url = api_gw_url
+
+        # Name usable in logs, metric labels and file names
+        self.name = re.sub(r"[^\w.-]+", "_", urlparse(api_gw_url).netloc or api_gw_url)
+
+    def __repr__(self):
+        return "Target({})".format(self.api_gw_url)
+
+def _split(value):
+    return [ part.strip() for part in value.split(",") if part.strip() ]
+
+def parse_targets(api_gw_urls, api_keys, api_secrets, credentials=True):
+    """
+    Reads the firewall targets from comma separated configuration values
+
+    A single API key and secret are shared by all targets, otherwise every
+    target needs its own. Targets that are never called may go without.
+
+    Parameters
+    ----------
+    api_gw_urls : str
+        The comma separated base URLs of the firewalls
+    api_keys : str
+        The comma separated API keys
+    api_secrets : str
+        The comma separated API secrets
+    credentials : bool
+        False, if the API of the targets is not called and keys and secrets may be missing
+
+    Returns
+    -------
+    list
+        The targets in the configured order
+
+    Raises
+    ------
+    ValueError
+        If the number of keys or secrets does not match the number of URLs
+    """
+    urls = _split(api_gw_urls)
+    keys = _split(api_keys)
+    secrets = _split(api_secrets)
+
+    if not urls:
+        raise ValueError("No firewall configured")
+
+    if not credentials:
+        keys = keys or [ "" ]
+        secrets = secrets or [ "" ]
+
+    if len(keys) == 1:
+        keys = keys * len(urls)
+    if len(secrets) == 1:
+        secrets = secrets * len(urls)
+
+    if len(keys) != len(urls) or len(secrets) != len(urls):
+        raise ValueError("Expected one API key and secret or one per firewall, got {} keys and {} secrets for {} firewalls".format(len(keys), len(secrets), len(urls)))
+
+    return [ Target(key, secret, url) for key, secret, url in zip(keys, secrets, urls) ]
+
+def fan_out(targets, call):
+    """
+    Calls a function for every target in parallel
+
+    A slow or failing target does not hold back the calls to the others.
+
+    Parameters
+    ----------
+    targets : list
+        The targets
+    call : callable
+        Receives a target and returns the result for it
+
+    Returns
+    -------
+    dict
+        The result or the raised exception keyed by target name
+    """
+    if len(targets) == 1:
+        target = targets[0]
+        try:
+            return { target.name : call(target) }
+        except Exception as ex:
+            return { target.name : ex }
+
+    results = { }
+    with ThreadPoolExecutor(max_workers=len(targets), thread_name_prefix="target") as executor:
+        futures = { target.name : executor.submit(call, target) for target in targets }
+
+        for name, future in futures.items():
+            try:
+                results[name] = future.result()
+            except Exception as ex:
+                LOGGER.error("Failed on firewall %s: %s", name, ex)
+                results[name] = ex
+
+    return results
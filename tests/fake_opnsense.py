@@ -0,0 +1,138 @@
+import collections
+import json
+import random
+import re
+import threading
+import time
+import uuid
+
+from pytest_httpserver import HTTPServer
+from werkzeug.wrappers import Request, Response
+
+class FakeBindServer:
+    """
+    Stateful simulation of the OPNSense bind API on a local `HTTPServer`
+
+    Implements reading the domains, searching, adding and deleting records
+    and reconfiguring the service. Every request can be delayed by a fixed
+    latency, and a share of the requests can be answered with an error.
+
+    Parameters
+    ----------
+    httpserver : HTTPServer
+        The server the API is registered on
+    domains : iterable
+        The names of the domains the server knows
+    latency : float
+        The delay in seconds added to every request
+    error_rate : float
+        The share of requests answered with `error_status`
+    error_status : int
+        The HTTP status code of injected errors
+    seed : int
+        The seed of the error injection, so runs are repeatable
+    """
+
+    def __init__(self, httpserver : HTTPServer, domains=("example.org",), latency=0.0, error_rate=0.0, error_status=503, seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.random = random.Random(seed)
+
+        self.domains = { str(uuid.uuid4()) : domain_name for domain_name in domains }
+        self.records = { }
+        self.calls = collections.Counter()
+        self.errors = 0
+        self.reconfigures = 0
+        self.changes = [ ]
+        self.lock = threading.Lock()
+
+        self.routes = {
+            "domain/get" : self._get_domains,
+            "record/searchRecord" : self._search_records,
+            "record/addRecord" : self._add_record,
+            "record/delRecord" : self._del_record,
+            "service/reconfigure" : self._reconfigure
+        }
+
+        httpserver.expect_request(re.compile(r"/api/bind/.*")).respond_with_handler(self._handle)
+
+    def domain_id(self, domain_name):
+        return next(domain_id for domain_id, name in self.domains.items() if name == domain_name)
+
+    def add(self, domain_name, name, record_type, value):
+        """
+        Adds a record directly, e.g. to simulate records created by hand
+        """
+        record_id = str(uuid.uuid4())
+        with self.lock:
+            self.records[record_id] = { "uuid" : record_id, "enabled" : "1", "domain" : self.domain_id(domain_name), "name" : name, "type" : record_type, "value" : value }
+
+        return record_id
+
+    def total_calls(self):
+        with self.lock:
+            return sum(self.calls.values())
+
+    def _handle(self, request : Request):
+        endpoint = "/".join(request.path.split("/")[3:5])
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        with self.lock:
+            self.calls[endpoint] += 1
+
+            if self.error_rate and self.random.random() < self.error_rate:
+                self.errors += 1
+                return Response("Injected error", status=self.error_status)
+
+            route = self.routes.get(endpoint)
+            if not route:
+                return Response("Unknown endpoint", status=404)
+
+            payload = request.get_json(silent=True) or { }
+            return Response(json.dumps(route(request, payload)), content_type="application/json")
+
+    def _get_domains(self, request, payload):
+        domains = { domain_id : { "enabled" : "1", "domainname" : domain_name } for domain_id, domain_name in self.domains.items() }
+        return { "domain" : { "domains" : { "domain" : domains } } }
+
+    def _search_records(self, request, payload):
+        rows = [
+            dict(record, domain=self.domains[record["domain"]])
+            for record in self.records.values()
+            if not payload.get("domain") or record["domain"] == payload["domain"]
+        ]
+
+        phrase = payload.get("searchPhrase")
+        if phrase:
+            rows = [ row for row in rows if phrase in (row["name"], row["type"], row["value"]) ]
+
+        page_size = int(payload.get("rowCount", len(rows) or 1))
+        start = (int(payload.get("current", 1)) - 1) * page_size
+
+        return { "rows" : rows[start:start + page_size], "rowCount" : page_size, "total" : len(rows), "current" : payload.get("current", 1) }
+
+    def _add_record(self, request, payload):
+        record = payload.get("record", { })
+        if record.get("domain") not in self.domains:
+            return { "result" : "failed", "validations" : { "record.domain" : "Domain not found" } }
+
+        record_id = str(uuid.uuid4())
+        self.records[record_id] = dict(record, uuid=record_id)
+        self.changes.append((time.perf_counter(), "add", record["name"]))
+
+        return { "result" : "saved", "uuid" : record_id }
+
+    def _del_record(self, request, payload):
+        record = self.records.pop(request.path.rsplit("/", 1)[1], None)
+        if not record:
+            return { "result" : "not found" }
+
+        self.changes.append((time.perf_counter(), "del", record["name"]))
+        return { "result" : "deleted" }
+
+    def _reconfigure(self, request, payload):
+        self.reconfigures += 1
+        return { "status" : "ok" }
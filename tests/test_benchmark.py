@@ -0,0 +1,393 @@
+import json
+import os
+import signal
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+import requests
+import urllib3
+
+from pytest_httpserver import HTTPServer
+
+import src.swarm_opn_bind_updater.main as main
+
+from src.swarm_opn_bind_updater.client import OpnBindClient
+from src.swarm_opn_bind_updater.labels import LABEL_PATTERN, MappingCache, parse_host_records
+
+from src.swarm_opn_bind_updater.targets import Target
+
+from tests.fake_opnsense import FakeBindServer
+
+API_KEY = "myKey"
+API_SECRET = "mySecret"
+
+DOMAIN_ID = "e7079f24-aeb7-4741-bd05-e005350bb5bf"
+DOMAIN_NAME = "example.org"
+
+# Number of simulated service create events per run
+EVENTS = 25
+
+# Number of services and foreign labels per service of the label benchmark
+LABEL_SERVICES = 200
+FOREIGN_LABELS = 300
+
+# Maximum time importing the CLI may take on top of requests, relative to importing requests on the same machine
+IMPORT_BUDGET = 0.3
+
+# Number of cold starts of the CLI and the modules only some commands may import
+IMPORT_RUNS = 5
+LAZY_MODULES = (
+    "docker",
+    "http.server",
+    "src.swarm_opn_bind_updater.leader",
+    "src.swarm_opn_bind_updater.audit",
+    "src.swarm_opn_bind_updater.manifest",
+    "src.swarm_opn_bind_updater.plan",
+    "src.swarm_opn_bind_updater.targets",
+    "src.swarm_opn_bind_updater.events"
+)
+
+def _serve_bind_api(httpserver : HTTPServer):
+    domains = {
+        "domain" : {
+            "domains" : {
+                "domain" : {
+                    DOMAIN_ID : {
+                        "enabled" : "1",
+                        "domainname" : DOMAIN_NAME
+                    }
+                }
+            }
+        }
+    }
+    httpserver.expect_request("/api/bind/domain/get").respond_with_json(domains)
+    httpserver.expect_request("/api/bind/record/searchRecord").respond_with_json({ "rows" : [ ] })
+    httpserver.expect_request("/api/bind/record/addRecord").respond_with_json({ "result" : "saved", "uuid" : "1" })
+    httpserver.expect_request("/api/bind/service/reconfigure").respond_with_json({ "status" : "ok" })
+
+def _count_connections(monkeypatch):
+    counter = { "connections" : 0 }
+    new_conn = urllib3.connectionpool.HTTPConnectionPool._new_conn
+
+    def counting_new_conn(self):
+        counter["connections"] += 1
+        return new_conn(self)
+
+    monkeypatch.setattr(urllib3.connectionpool.HTTPConnectionPool, "_new_conn", counting_new_conn)
+    return counter
+
+def _unpooled_event(base_url):
+    # Mirrors the calls of a service create event with module level requests
+    auth = (API_KEY, API_SECRET)
+    requests.get("".join([base_url, "/api/bind/domain/get"]), auth=auth)
+    requests.get("".join([base_url, "/api/bind/domain/get"]), auth=auth)
+    requests.post("".join([base_url, "/api/bind/record/searchRecord"]), auth=auth, json={ })
+    requests.post("".join([base_url, "/api/bind/record/addRecord"]), auth=auth, json={ })
+    requests.post("".join([base_url, "/api/bind/service/reconfigure"]), auth=auth, json={ })
+
+def _pooled_event(client : OpnBindClient):
+    domain_id = client.search_domain(DOMAIN_NAME)
+    client.search_record(DOMAIN_NAME, "CNAME", "host")
+    client.add_record(domain_id, "host", "CNAME", "ingress")
+    client.reconfigure()
+
+def test_benchmark_pooled_client(monkeypatch):
+    with HTTPServer(threaded=True) as httpserver:
+        _serve_bind_api(httpserver)
+        base_url = httpserver.url_for("").rstrip("/")
+        counter = _count_connections(monkeypatch)
+
+        start = time.perf_counter()
+        for _ in range(EVENTS):
+            _unpooled_event(base_url)
+        unpooled_latency = (time.perf_counter() - start) / EVENTS
+        unpooled_connections = counter["connections"]
+
+        counter["connections"] = 0
+        with OpnBindClient(API_KEY, API_SECRET, base_url) as client:
+            start = time.perf_counter()
+            for _ in range(EVENTS):
+                _pooled_event(client)
+            pooled_latency = (time.perf_counter() - start) / EVENTS
+        pooled_connections = counter["connections"]
+
+    print("")
+    print("unpooled: {:.2f} connections/event, {:.2f} ms/event".format(unpooled_connections / EVENTS, unpooled_latency * 1000))
+    print("pooled:   {:.2f} connections/event, {:.2f} ms/event".format(pooled_connections / EVENTS, pooled_latency * 1000))
+
+    assert unpooled_connections == 5 * EVENTS
+    assert pooled_connections == 1
+
+def _import_cli():
+    # Every run is a cold start in a fresh interpreter, requests is imported first as baseline
+    result = subprocess.run(
+        [ sys.executable, "-X", "importtime", "-c", "import requests; import src.swarm_opn_bind_updater.main" ],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        capture_output=True,
+        text=True,
+        check=True
+    )
+
+    # Lines read "import time: <self us> | <cumulative us> | <indented module>"
+    imports = { }
+    for line in result.stderr.splitlines():
+        if line.startswith("import time:") and not line.endswith("imported package"):
+            _, cumulative, module = line[len("import time:"):].split("|")
+            imports[module.strip()] = int(cumulative) / 1e6
+
+    return imports
+
+def test_benchmark_cli_import_time():
+    runs = [ _import_cli() for _ in range(IMPORT_RUNS) ]
+    import_seconds = statistics.median(imports["src.swarm_opn_bind_updater.main"] for imports in runs)
+    requests_seconds = statistics.median(imports["requests"] for imports in runs)
+
+    print("")
+    print("cli import: {:.1f} ms on top of requests {:.1f} ms".format(import_seconds * 1000, requests_seconds * 1000))
+
+    # Both are measured on the same machine, so the budget does not depend on its speed
+    assert [ module for module in LAZY_MODULES if any(module in imports for imports in runs) ] == [ ]
+    assert import_seconds < IMPORT_BUDGET * requests_seconds
+
+def _labelled_service(index):
+    labels = { "traefik.http.routers.service-{}-{}.rule".format(index, label) : "Host(`example.org`)" for label in range(FOREIGN_LABELS) }
+    for key, value in (("domain", "example.org"), ("host", "host-{}".format(index)), ("type", "CNAME"), ("value", "ingress")):
+        labels["com.aixo.cloud.ingress.mappings.0.{}".format(key)] = value
+
+    return { "ID" : "service-{}".format(index), "Version" : { "Index" : 1 }, "Spec" : { "Labels" : labels } }
+
+def _match_all_labels(labels_payload):
+    # Mirrors the former parser matching the pattern against every label
+    return [ LABEL_PATTERN.match(label) for label in labels_payload ]
+
+def test_benchmark_label_parsing():
+    services = [ _labelled_service(index) for index in range(LABEL_SERVICES) ]
+
+    start = time.perf_counter()
+    for service in services:
+        _match_all_labels(service["Spec"]["Labels"])
+    pattern_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for service in services:
+        parse_host_records(service["Spec"]["Labels"], service["ID"])
+    prefix_seconds = time.perf_counter() - start
+
+    cache = MappingCache()
+    for service in services:
+        cache.parse(service)
+
+    start = time.perf_counter()
+    for service in services:
+        cache.parse(service)
+    cached_seconds = time.perf_counter() - start
+
+    print("")
+    print("pattern: {:.1f} us/service".format(pattern_seconds / LABEL_SERVICES * 1e6))
+    print("prefix:  {:.1f} us/service".format(prefix_seconds / LABEL_SERVICES * 1e6))
+    print("cached:  {:.1f} us/service".format(cached_seconds / LABEL_SERVICES * 1e6))
+
+    assert prefix_seconds < pattern_seconds
+    assert cached_seconds < prefix_seconds
+    assert cache.hits == LABEL_SERVICES
+
+class FakeDockerApi:
+    def __init__(self, services):
+        self.services_payload = { service["ID"] : service for service in services }
+
+    def services(self, filters=None):
+        # The storm creates all services after the daemon started
+        return [ ]
+
+    def inspect_service(self, service_id):
+        return self.services_payload[service_id]
+
+class FakeDockerEventStream:
+    def __init__(self, events, emitted):
+        self.events = events
+        self.emitted = emitted
+        self.closed = threading.Event()
+
+    def __iter__(self):
+        for event in self.events:
+            if self.closed.is_set():
+                return
+
+            event = dict(event, timeNano=time.time_ns())
+            self.emitted[(event["Actor"]["ID"], event["Action"])] = time.perf_counter()
+            yield json.dumps(event).encode("utf-8")
+
+        # Keep the stream open like docker does
+        self.closed.wait()
+
+    def close(self):
+        self.closed.set()
+
+class FakeDockerClient:
+    def __init__(self, services, events):
+        self.api = FakeDockerApi(services)
+        self.events_payload = events
+        self.emitted = { }
+        self.streams = [ ]
+
+    def events(self, since=None, filters=None):
+        # A reconnect only delivers new events
+        stream = FakeDockerEventStream(self.events_payload if not self.streams else [ ], self.emitted)
+        self.streams.append(stream)
+        return stream
+
+    def close(self):
+        pass
+
+def _storm(services, mappings):
+    service_payloads = [ ]
+    events = [ ]
+
+    for index in range(services):
+        labels = { }
+        for mapping in range(mappings):
+            for key, value in (("domain", "example.org"), ("host", "svc{}-m{}".format(index, mapping)), ("type", "CNAME"), ("value", "ingress")):
+                labels["com.aixo.cloud.ingress.mappings.m{}.{}".format(mapping, key)] = value
+
+        service_id = "service-{}".format(index)
+        service_payloads.append({ "ID" : service_id, "Version" : { "Index" : 1 }, "Spec" : { "Name" : service_id, "Labels" : labels } })
+
+    for action in ("create", "remove"):
+        events.extend({ "Type" : "service", "Action" : action, "Actor" : { "ID" : payload["ID"], "Attributes" : { "name" : payload["ID"] } } } for payload in service_payloads)
+
+    return service_payloads, events
+
+def run_event_storm(monkeypatch, services, mappings, latency=0.0, error_rate=0.0, timeout=60.0):
+    """
+    Replays a storm of service create and remove events through the daemon against a fake firewall
+
+    Returns
+    -------
+    dict
+        The throughput in events/s, the bind API calls per event and the p50
+        and p99 latency in ms from emitting an event to its last record change
+    """
+    service_payloads, events = _storm(services, mappings)
+
+    with HTTPServer(threaded=True) as httpserver:
+        server = FakeBindServer(httpserver, latency=latency, error_rate=error_rate)
+        base_url = httpserver.url_for("").rstrip("/")
+
+        docker_client = FakeDockerClient(service_payloads, events)
+        monkeypatch.setattr(main, "create_docker_client", lambda docker_url: docker_client)
+
+        main.get_client(API_KEY, API_SECRET, base_url, pool_size=16, backoff=0)
+
+        def stop_when_done():
+            # Wait until every record was added and removed again
+            deadline = time.monotonic() + timeout
+            while time.monotonic() < deadline:
+                with server.lock:
+                    removed = sum(1 for change in server.changes if change[1] == "del")
+                if removed >= services * mappings:
+                    break
+                time.sleep(0.01)
+
+            os.kill(os.getpid(), signal.SIGTERM)
+
+        watcher = threading.Thread(target=stop_when_done, daemon=True)
+        watcher.start()
+
+        try:
+            main.process_docker_events(API_KEY, API_SECRET, base_url, "unix://fake", reconfigure_delay=0.05, reconfigure_max_delay=0.5, workers=8)
+        finally:
+            watcher.join()
+            main.close_clients()
+            main.SERVICE_MAPPINGS.clear()
+
+        # The last change of a service per action marks its event as applied
+        applied = { }
+        for at, change, name in server.changes:
+            service_id = "service-{}".format(name[3:].split("-")[0])
+            key = (service_id, "create" if change == "add" else "remove")
+            applied[key] = max(applied.get(key, 0), at)
+
+        latencies = sorted((applied[key] - emitted) * 1000 for key, emitted in docker_client.emitted.items() if key in applied)
+        duration = max(applied.values()) - min(docker_client.emitted.values())
+
+        return {
+            "events" : len(events),
+            "applied" : len(latencies),
+            "records" : len(server.records),
+            "events_per_second" : len(events) / duration,
+            "calls_per_event" : server.total_calls() / len(events),
+            "reconfigures" : server.reconfigures,
+            "errors" : server.errors,
+            "p50" : statistics.median(latencies),
+            "p99" : latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+        }
+
+def _print_storm(name, report):
+    print("")
+    print("{}: {:.0f} events/s, {:.2f} calls/event, p50 {:.1f} ms, p99 {:.1f} ms, {} reconfigures, {} injected errors".format(
+        name, report["events_per_second"], report["calls_per_event"], report["p50"], report["p99"], report["reconfigures"], report["errors"]
+    ))
+
+def test_benchmark_event_storm(monkeypatch):
+    report = run_event_storm(monkeypatch, services=50, mappings=3, latency=0.002)
+    _print_storm("threads", report)
+
+    assert report["applied"] == report["events"]
+    assert report["records"] == 0
+    assert report["reconfigures"] < report["events"]
+
+def test_benchmark_event_storm_with_errors(monkeypatch):
+    report = run_event_storm(monkeypatch, services=50, mappings=3, latency=0.002, error_rate=0.05)
+    _print_storm("with errors", report)
+
+    assert report["errors"] > 0
+    assert report["applied"] == report["events"]
+    assert report["records"] == 0
+
+def test_benchmark_event_storm_fans_out_to_firewalls(monkeypatch):
+    services, mappings = 20, 2
+    service_payloads, events = _storm(services, mappings)
+
+    with HTTPServer(threaded=True) as fast_httpserver, HTTPServer(threaded=True) as slow_httpserver:
+        fast = FakeBindServer(fast_httpserver)
+        slow = FakeBindServer(slow_httpserver, latency=0.05)
+        targets = [ Target(API_KEY, API_SECRET, httpserver.url_for("").rstrip("/")) for httpserver in (fast_httpserver, slow_httpserver) ]
+
+        docker_client = FakeDockerClient(service_payloads, events)
+        monkeypatch.setattr(main, "create_docker_client", lambda docker_url: docker_client)
+
+        for target in targets:
+            main.get_client(target.api_key, target.api_secret, target.api_gw_url, pool_size=16, backoff=0)
+
+        def stop_when_done():
+            deadline = time.monotonic() + 60.0
+            while time.monotonic() < deadline:
+                if all(sum(1 for change in server.changes if change[1] == "del") >= services * mappings for server in (fast, slow)):
+                    break
+                time.sleep(0.01)
+
+            os.kill(os.getpid(), signal.SIGTERM)
+
+        watcher = threading.Thread(target=stop_when_done, daemon=True)
+        watcher.start()
+
+        try:
+            main.process_docker_events(API_KEY, API_SECRET, targets[0].api_gw_url, "unix://fake", reconfigure_delay=0.05, reconfigure_max_delay=0.5, workers=4, targets=targets)
+        finally:
+            watcher.join()
+            main.close_clients()
+            main.SERVICE_MAPPINGS.clear()
+            main.TARGET_SERVICES.clear()
+
+    fast_done = max(at for at, _, _ in fast.changes) - min(docker_client.emitted.values())
+    slow_done = max(at for at, _, _ in slow.changes) - min(docker_client.emitted.values())
+
+    print("")
+    print("fast firewall: {:.0f} ms, slow firewall: {:.0f} ms".format(fast_done * 1000, slow_done * 1000))
+
+    assert len(fast.changes) == len(slow.changes) == 2 * services * mappings
+    assert fast.reconfigures >= 1 and slow.reconfigures >= 1
+    assert fast_done * 3 < slow_done
@@ -1,9 +1,38 @@
+import io
+import itertools
+import json
+import logging
+import os
+import random
+import re
+import signal
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
 import pytest
+import requests
 
 from requests_mock import Mocker
 
 import src.swarm_opn_bind_updater.main as main
 
+from src.swarm_opn_bind_updater.client import OpnBindClient, RecordIndex
+from src.swarm_opn_bind_updater.scheduler import ReconfigureScheduler
+from src.swarm_opn_bind_updater.pipeline import EventPipeline, EventFanOut
+from src.swarm_opn_bind_updater.manifest import read_manifest
+from src.swarm_opn_bind_updater.labels import MappingCache
+from src.swarm_opn_bind_updater.targets import Target, parse_targets, fan_out
+from src.swarm_opn_bind_updater.leader import LeaseBackend, FileLeaseBackend, LeaderElector
+from src.swarm_opn_bind_updater.plan import DryRunClient, read_service_specs, format_changes
+from src.swarm_opn_bind_updater.audit import DriftAuditor
+from src.swarm_opn_bind_updater.state import JournalStateStore, ServiceRepository
+from src.swarm_opn_bind_updater.resilience import BindApiError, CircuitBreaker, CircuitOpenError, DeadLetterQueue
+from src.swarm_opn_bind_updater.events import EventCursor, ResumableEventStream
+from src.swarm_opn_bind_updater.eventlog import JsonFormatter, trace_event
+from src.swarm_opn_bind_updater.metrics import Registry, Counter, Gauge, Histogram, MetricsServer, API_SECONDS, API_ERRORS
+
 API_KEY = "myKey"
 API_SECRET = "mySecret"
 
@@ -13,6 +42,53 @@ BIND_DOMAIN_GET = "https://example.org/api/bind/domain/get"
 BIND_RECORD_ADDRECORD = "https://example.org/api/bind/record/addRecord"
 BIND_RECORD_DELRECORD = "https://example.org/api/bind/record/delRecord"
 
+BIND_RECORD_SEARCHRECORD = "https://example.org/api/bind/record/searchRecord"
+BIND_SERVICE_RECONFIGURE = "https://example.org/api/bind/service/reconfigure"
+
+@pytest.fixture(autouse=True)
+def reset_clients():
+    # Retry without waiting
+    main.get_client(API_KEY, API_SECRET, BASE_URL, backoff=0)
+    yield
+    main.close_clients()
+    main.SERVICE_MAPPINGS.clear()
+    for services in [ main.ACTIVE_SERVICES, main.OWNED_RECORDS, *main.TARGET_SERVICES.values() ]:
+        services.close()
+        services.clear()
+    main.TARGET_SERVICES.clear()
+
+class FakeApiClient:
+    def __init__(self, services):
+        self.services_payload = services
+        self.inspected = [ ]
+
+    def services(self, filters=None):
+        return self.services_payload
+
+    def inspect_service(self, service_id):
+        self.inspected.append(service_id)
+        return next(service for service in self.services_payload if service["ID"] == service_id)
+
+def _service_payload(service_id, mappings):
+    labels = { "com.docker.stack.namespace" : "stack" }
+    for selector, (domain, host, type, value) in mappings.items():
+        prefix = "com.aixo.cloud.ingress.mappings.{}.".format(selector)
+        labels[prefix + "domain"] = domain
+        labels[prefix + "host"] = host
+        labels[prefix + "type"] = type
+        labels[prefix + "value"] = value
+
+    return { "ID" : service_id, "Spec" : { "Labels" : labels } }
+
+def _domains_payload(domains):
+    return {
+        "domain" : {
+            "domains": {
+                "domain" : domains
+            }
+        }
+    }
+
 def test_can_create_record_payload():
     domain_id = "dbf3748c-ac5a-4512-8941-4b8c10d3558d"
     name = "heinz"
@@ -104,3 +180,1233 @@ def test_remove_host_failed_without_result(requests_mock : Mocker):
         main.remove_record(API_KEY, API_SECRET, BASE_URL, record_id)
 
     assert str(ex.value) == "500 - Failed to remove host"
+
+def test_wrappers_share_pooled_client(requests_mock : Mocker):
+    record_id = "5b4bd2a4-64b8-4f5b-9a3c-04a2a0e0f1d6"
+    url = "".join([BIND_RECORD_DELRECORD, "/", record_id])
+    requests_mock.post(url=BIND_RECORD_ADDRECORD, json={ "result" : "saved" })
+    requests_mock.post(url=url, json={ "result" : "deleted" })
+
+    main.add_record(API_KEY, API_SECRET, BASE_URL, "dbf3748c-ac5a-4512-8941-4b8c10d3558d", "blog", "CNAME", "www.example.org")
+    main.remove_record(API_KEY, API_SECRET, BASE_URL, record_id)
+
+    client = main.get_client(API_KEY, API_SECRET, BASE_URL)
+
+    assert client is main.get_client(API_KEY, API_SECRET, BASE_URL)
+    assert client.session.auth == (API_KEY, API_SECRET)
+    assert requests_mock.call_count == 2
+    assert requests_mock.request_history[0].timeout == client.timeout
+
+def test_domain_lookups_are_cached(requests_mock : Mocker):
+    domain_id = "e7079f24-aeb7-4741-bd05-e005350bb5bf"
+    requests_mock.get(BIND_DOMAIN_GET, json=_domains_payload({ domain_id : { "enabled" : "1", "domainname" : "c.internal" } }))
+
+    for _ in range(30):
+        assert main.search_domain(API_KEY, API_SECRET, BASE_URL, "c.internal") == domain_id
+
+    assert requests_mock.call_count == 1
+
+    main.get_client(API_KEY, API_SECRET, BASE_URL).domains.invalidate()
+    main.search_domain(API_KEY, API_SECRET, BASE_URL, "c.internal")
+
+    assert requests_mock.call_count == 2
+
+def test_domain_lookup_miss_forces_refresh(requests_mock : Mocker):
+    old_id = "e7079f24-aeb7-4741-bd05-e005350bb5bf"
+    new_id = "0c2b8f5e-4bd6-4c41-9b0e-6a0b0d5b7a3e"
+    requests_mock.get(BIND_DOMAIN_GET, [
+        { "json" : _domains_payload({ old_id : { "enabled" : "1", "domainname" : "c.internal" } }) },
+        { "json" : _domains_payload({
+            old_id : { "enabled" : "1", "domainname" : "c.internal" },
+            new_id : { "enabled" : "0", "domainname" : "d.internal" }
+        }) }
+    ])
+
+    assert main.search_domain(API_KEY, API_SECRET, BASE_URL, "c.internal") == old_id
+    assert main.search_domain(API_KEY, API_SECRET, BASE_URL, "d.internal") == None
+    assert main.search_domain(API_KEY, API_SECRET, BASE_URL, "d.internal") == None
+
+    assert requests_mock.call_count == 2
+
+def test_reconfigure_scheduler_coalesces_bursts():
+    calls = [ ]
+    scheduler = ReconfigureScheduler(lambda: calls.append(time.monotonic()), delay=0.05, max_delay=5.0).start()
+
+    for _ in range(40):
+        scheduler.request()
+
+    time.sleep(0.3)
+    scheduler.close()
+
+    assert len(calls) == 1
+    assert scheduler.requested == 40
+    assert scheduler.saved == 39
+
+def test_reconfigure_scheduler_flushes_trickle_after_max_delay():
+    calls = [ ]
+    scheduler = ReconfigureScheduler(lambda: calls.append(time.monotonic()), delay=0.2, max_delay=0.25).start()
+
+    for _ in range(20):
+        scheduler.request()
+        time.sleep(0.05)
+
+    assert len(calls) >= 2
+
+    scheduler.close()
+
+    assert scheduler.performed == len(calls)
+    assert scheduler.saved == 20 - len(calls)
+
+def test_reconfigure_scheduler_retries_failures():
+    results = [ Exception("503 - Failed to reconfigure bind service"), None ]
+
+    def reconfigure():
+        result = results.pop(0)
+        if result:
+            raise result
+
+    scheduler = ReconfigureScheduler(reconfigure, delay=0.01, max_delay=1.0).start()
+    scheduler.request()
+
+    time.sleep(0.2)
+    scheduler.close()
+
+    assert scheduler.failed == 1
+    assert scheduler.performed == 1
+
+def test_event_pipeline_keeps_order_per_service():
+    processed = [ ]
+    lock = threading.Lock()
+
+    def handler(event):
+        time.sleep(random.random() / 1000)
+        with lock:
+            processed.append((event["Actor"]["ID"], event["Action"]))
+
+    raw_events = [ ]
+    for index in range(50):
+        for action in ("create", "update", "remove"):
+            raw_events.append(json.dumps({ "Action" : action, "Actor" : { "ID" : "service-{}".format(index) } }))
+
+    pipeline = EventPipeline(handler, workers=4, queue_size=2).start()
+    pipeline.feed(raw_events)
+    pipeline.wait()
+    pipeline.close()
+
+    assert pipeline.processed == 150
+    for index in range(50):
+        actions = [ action for service_id, action in processed if service_id == "service-{}".format(index) ]
+        assert actions == [ "create", "update", "remove" ]
+
+def test_event_pipeline_survives_failing_events():
+    def handler(event):
+        if event["Action"] == "create":
+            raise Exception("500 - Failed to add host")
+
+    pipeline = EventPipeline(handler, workers=2).start()
+    pipeline.submit({ "Action" : "create", "Actor" : { "ID" : "a" } })
+    pipeline.submit({ "Action" : "remove", "Actor" : { "ID" : "a" } })
+    pipeline.close()
+
+    assert pipeline.failed == 1
+    assert pipeline.processed == 1
+
+def test_reconcile_applies_only_the_difference(requests_mock : Mocker):
+    domain_id = "e7079f24-aeb7-4741-bd05-e005350bb5bf"
+    stale_record_id = "c3a5a8b0-51d6-4a3f-8b43-3d0f4b0e1a11"
+    requests_mock.get(BIND_DOMAIN_GET, json=_domains_payload({ domain_id : { "enabled" : "1", "domainname" : "example.org" } }))
+    requests_mock.post(BIND_RECORD_SEARCHRECORD, json={
+        "rows" : [ { "uuid" : "existing-uuid", "name" : "existing", "type" : "CNAME" } ],
+        "total" : 1
+    })
+    requests_mock.post(BIND_RECORD_ADDRECORD, json={ "result" : "saved", "uuid" : "new-uuid" })
+    requests_mock.post("".join([BIND_RECORD_DELRECORD, "/", stale_record_id]), json={ "result" : "deleted" })
+    requests_mock.post(BIND_SERVICE_RECONFIGURE, json={ "status" : "ok" })
+
+    api_client = FakeApiClient([
+        _service_payload("existing-service", { "0" : ("example.org", "existing", "CNAME", "ingress") }),
+        _service_payload("new-service", { "0" : ("example.org", "new", "CNAME", "ingress") }),
+        { "ID" : "unlabeled-service", "Spec" : { "Labels" : { } } }
+    ])
+    main.ACTIVE_SERVICES["stale-service"] = { "id" : "stale-service", "records" : { "0" : { "id" : stale_record_id } } }
+    main.get_client(API_KEY, API_SECRET, BASE_URL).owned[stale_record_id] = { "domain_id" : domain_id, "name" : "stale", "type" : "CNAME" }
+
+    summary = main.reconcile(API_KEY, API_SECRET, BASE_URL, api_client)
+
+    assert summary == { "services" : 2, "added" : 1, "adopted" : 1, "removed" : 1, "failed" : 0 }
+    assert main.ACTIVE_SERVICES["existing-service"]["records"]["0"]["id"] == "existing-uuid"
+    assert main.ACTIVE_SERVICES["new-service"]["records"]["0"]["id"] == "new-uuid"
+    assert "stale-service" not in main.ACTIVE_SERVICES
+    assert api_client.inspected == [ ]
+    assert [ request.url for request in requests_mock.request_history ].count(BIND_SERVICE_RECONFIGURE) == 1
+
+def test_reconcile_corrects_tracked_services(requests_mock : Mocker):
+    domain_id = "e7079f24-aeb7-4741-bd05-e005350bb5bf"
+    records = { uuid : { "domain" : domain_id, "name" : name, "type" : "CNAME", "value" : value } for uuid, name, value in (("uuid-kept", "kept", "ingress"), ("uuid-changed", "changed", "old"), ("uuid-dropped", "dropped", "ingress")) }
+    uuids = itertools.count()
+
+    def add_record(request, context):
+        uuid = "uuid-{}".format(next(uuids))
+        records[uuid] = request.json()["record"]
+        return { "result" : "saved", "uuid" : uuid }
+
+    def del_record(request, context):
+        return { "result" : "deleted" if records.pop(request.path.rsplit("/", 1)[1], None) else "not found" }
+
+    requests_mock.get(BIND_DOMAIN_GET, json=_domains_payload({ domain_id : { "enabled" : "1", "domainname" : "example.org" } }))
+    requests_mock.post(BIND_RECORD_ADDRECORD, json=add_record)
+    requests_mock.post(re.compile(BIND_RECORD_DELRECORD + "/.*"), json=del_record)
+    requests_mock.post(BIND_RECORD_SEARCHRECORD, json=lambda request, context: { "rows" : [ dict(record, uuid=uuid) for uuid, record in records.items() ], "total" : len(records) })
+    requests_mock.post(BIND_SERVICE_RECONFIGURE, json={ "status" : "ok" })
+
+    # The labels changed and a record was deleted by hand while the daemon was not running
+    main.ACTIVE_SERVICES["a"] = { "id" : "a", "records" : {
+        selector : { "domain" : "example.org", "host" : selector, "type" : "CNAME", "value" : value, "domain_id" : domain_id, "id" : "uuid-{}".format(selector) }
+        for selector, value in (("kept", "ingress"), ("changed", "old"), ("deleted", "ingress"), ("dropped", "ingress"))
+    } }
+    client = main.get_client(API_KEY, API_SECRET, BASE_URL)
+    for uuid in ("uuid-changed", "uuid-deleted", "uuid-dropped"):
+        client.owned[uuid] = { "domain_id" : domain_id, "name" : uuid[5:], "type" : "CNAME" }
+
+    api_client = FakeApiClient([ _service_payload("a", { selector : ("example.org", selector, "CNAME", value) for selector, value in (("kept", "ingress"), ("changed", "new"), ("deleted", "ingress")) }) ])
+    summary = main.reconcile(API_KEY, API_SECRET, BASE_URL, api_client)
+
+    assert summary == { "services" : 1, "added" : 2, "adopted" : 0, "removed" : 2, "failed" : 0 }
+    assert sorted((record["name"], record["value"]) for record in records.values()) == [ ("changed", "new"), ("deleted", "ingress"), ("kept", "ingress") ]
+
+    tracked = main.ACTIVE_SERVICES["a"]["records"]
+    assert sorted(tracked) == [ "changed", "deleted", "kept" ]
+    assert tracked["kept"]["id"] == "uuid-kept"
+    assert tracked["changed"]["value"] == "new" and tracked["changed"]["id"] in records
+    assert "uuid-deleted" not in client.owned
+
+    assert main.reconcile(API_KEY, API_SECRET, BASE_URL, api_client) == { "services" : 1, "added" : 0, "adopted" : 0, "removed" : 0, "failed" : 0 }
+
+def test_journal_state_store_survives_restart(tmp_path):
+    services = ServiceRepository()
+    services.open(JournalStateStore(str(tmp_path), compact_every=3))
+
+    for index in range(5):
+        services["service-{}".format(index)] = { "id" : "service-{}".format(index), "records" : { "0" : { "id" : str(index) } } }
+    services.pop("service-1")
+    services.close()
+
+    # Simulate a crash while appending the last entry
+    with open(tmp_path / "state.journal", "a", encoding="utf-8") as journal:
+        journal.write('{"op":"delete","id":"serv')
+
+    restored = ServiceRepository()
+    restored.open(JournalStateStore(str(tmp_path)))
+
+    assert sorted(restored) == [ "service-0", "service-2", "service-3", "service-4" ]
+    assert restored["service-4"]["records"]["0"]["id"] == "4"
+    assert (tmp_path / "state.snapshot.json").exists()
+
+    restored["service-5"] = { "id" : "service-5", "records" : { "0" : { "id" : "5" } } }
+    restored.close()
+
+    reopened = ServiceRepository()
+    reopened.open(JournalStateStore(str(tmp_path)))
+
+    assert "service-5" in reopened
+
+    reopened.close()
+
+def test_multi_mapping_services_leave_no_orphans(requests_mock : Mocker):
+    domain_id = "e7079f24-aeb7-4741-bd05-e005350bb5bf"
+    records = { }
+    uuids = itertools.count()
+
+    def add_record(request, context):
+        record = request.json()["record"]
+        uuid = "uuid-{}".format(next(uuids))
+        records[uuid] = record
+        return { "result" : "saved", "uuid" : uuid }
+
+    def del_record(request, context):
+        uuid = request.path.rsplit("/", 1)[1]
+        return { "result" : "deleted" if records.pop(uuid, None) else "not found" }
+
+    def search_record(request, context):
+        return { "rows" : [ dict(record, uuid=uuid) for uuid, record in records.items() ], "total" : len(records) }
+
+    requests_mock.get(BIND_DOMAIN_GET, json=_domains_payload({ domain_id : { "enabled" : "1", "domainname" : "example.org" } }))
+    requests_mock.post(BIND_RECORD_ADDRECORD, json=add_record)
+    requests_mock.post(re.compile(BIND_RECORD_DELRECORD + "/.*"), json=del_record)
+    requests_mock.post(BIND_RECORD_SEARCHRECORD, json=search_record)
+
+    api_client = FakeApiClient([
+        _service_payload("service-{}".format(index), {
+            "m1" : ("example.org", "first-{}".format(index), "CNAME", "ingress"),
+            "m2" : ("example.org", "second-{}".format(index), "CNAME", "ingress"),
+            "m3" : ("example.org", "third-{}".format(index), "A", "192.168.1.1")
+        })
+        for index in range(3)
+    ])
+
+    for _ in range(3):
+        for index in range(3):
+            main.handle_service_created_event(API_KEY, API_SECRET, BASE_URL, api_client, "service-{}".format(index))
+
+        assert len(records) == 9
+        assert len(main.ACTIVE_SERVICES["service-0"]["records"]) == 3
+
+        for index in range(3):
+            main.service_removed(API_KEY, API_SECRET, BASE_URL, "service-{}".format(index))
+
+        assert records == { }
+        assert len(main.ACTIVE_SERVICES) == 0
+
+def test_record_index_pages_once_and_updates_incrementally(requests_mock : Mocker):
+    domain_id = "e7079f24-aeb7-4741-bd05-e005350bb5bf"
+    rows = [ { "uuid" : "uuid-{}".format(index), "name" : "host-{}".format(index), "type" : "CNAME" } for index in range(120) ]
+
+    def search_record(request, context):
+        payload = request.json()
+        start = (payload["current"] - 1) * payload["rowCount"]
+        return { "rows" : rows[start:start + payload["rowCount"]], "total" : len(rows) }
+
+    requests_mock.get(BIND_DOMAIN_GET, json=_domains_payload({ domain_id : { "enabled" : "1", "domainname" : "example.org" } }))
+    requests_mock.post(BIND_RECORD_SEARCHRECORD, json=search_record)
+    requests_mock.post(BIND_RECORD_ADDRECORD, json={ "result" : "saved", "uuid" : "uuid-new" })
+    requests_mock.post("".join([BIND_RECORD_DELRECORD, "/uuid-119"]), json={ "result" : "deleted" })
+
+    client = main.get_client(API_KEY, API_SECRET, BASE_URL)
+    client.records.refresh(domain_id)
+
+    assert requests_mock.call_count == 1
+    assert client.list_records(domain_id, page_size=50) == rows
+    assert requests_mock.call_count == 4
+
+    assert main.search_record(API_KEY, API_SECRET, BASE_URL, "example.org", "CNAME", "host-119") == "uuid-119"
+    assert main.search_record(API_KEY, API_SECRET, BASE_URL, "example.org", "CNAME", "host-120") == None
+
+    main.add_record(API_KEY, API_SECRET, BASE_URL, domain_id, "host-120", "CNAME", "ingress")
+    main.remove_record(API_KEY, API_SECRET, BASE_URL, "uuid-119")
+
+    assert main.search_record(API_KEY, API_SECRET, BASE_URL, "example.org", "CNAME", "host-120") == "uuid-new"
+    assert main.search_record(API_KEY, API_SECRET, BASE_URL, "example.org", "CNAME", "host-119") == None
+    assert requests_mock.call_count == 7
+
+def test_record_index_reads_domains_without_blocking_lookups():
+    reading = threading.Event()
+    release = threading.Event()
+    finished = threading.Event()
+    fetched = [ ]
+
+    def fetch(domain_id):
+        fetched.append(domain_id)
+        if domain_id == "slow":
+            reading.set()
+            release.wait(5.0)
+            finished.set()
+            return [ { "uuid" : "uuid-removed", "type" : "A", "name" : "removed" } ]
+
+        return [ { "uuid" : "uuid-fast", "type" : "A", "name" : "fast" } ]
+
+    index = RecordIndex(fetch)
+    readers = [ threading.Thread(target=index.lookup, args=("slow", "A", "removed")) for _ in range(3) ]
+    for reader in readers:
+        reader.start()
+    reading.wait(5.0)
+
+    # Other domains are looked up and own changes are kept while a domain is read
+    assert index.lookup("fast", "A", "fast") == "uuid-fast"
+    assert not finished.is_set()
+    index.add("slow", "A", "added", "uuid-added")
+    index.discard("uuid-removed")
+
+    release.set()
+    for reader in readers:
+        reader.join()
+
+    assert fetched == [ "slow", "fast" ]
+    assert index.lookup("slow", "A", "added") == "uuid-added"
+    assert index.lookup("slow", "A", "removed") == None
+
+def test_service_update_only_touches_changed_mappings(requests_mock : Mocker):
+    domain_id = "e7079f24-aeb7-4741-bd05-e005350bb5bf"
+    requests_mock.get(BIND_DOMAIN_GET, json=_domains_payload({ domain_id : { "enabled" : "1", "domainname" : "example.org" } }))
+    requests_mock.post(BIND_RECORD_SEARCHRECORD, json={ "rows" : [ ] })
+    requests_mock.post(BIND_RECORD_ADDRECORD, json={ "result" : "saved", "uuid" : "uuid-new" })
+    requests_mock.post("".join([BIND_RECORD_DELRECORD, "/uuid-changed"]), json={ "result" : "deleted" })
+    requests_mock.post("".join([BIND_RECORD_DELRECORD, "/uuid-dropped"]), json={ "result" : "deleted" })
+
+    main.ACTIVE_SERVICES["service"] = { "id" : "service", "records" : {
+        "same" : { "domain" : "example.org", "host" : "same", "type" : "CNAME", "value" : "ingress", "domain_id" : domain_id, "id" : "uuid-same" },
+        "changed" : { "domain" : "example.org", "host" : "changed", "type" : "CNAME", "value" : "old", "domain_id" : domain_id, "id" : "uuid-changed" },
+        "dropped" : { "domain" : "example.org", "host" : "dropped", "type" : "CNAME", "value" : "ingress", "domain_id" : domain_id, "id" : "uuid-dropped" }
+    } }
+    client = main.get_client(API_KEY, API_SECRET, BASE_URL)
+    for name in ("same", "changed", "dropped"):
+        client.owned["uuid-" + name] = { "domain_id" : domain_id, "name" : name, "type" : "CNAME" }
+
+    api_client = FakeApiClient([ _service_payload("service", {
+        "same" : ("example.org", "same", "CNAME", "ingress"),
+        "changed" : ("example.org", "changed", "CNAME", "new")
+    }) ])
+
+    assert main.handle_service_updated_event(API_KEY, API_SECRET, BASE_URL, api_client, "service") == 3
+
+    deleted = sorted(request.url.rsplit("/", 1)[1] for request in requests_mock.request_history if request.url.startswith(BIND_RECORD_DELRECORD))
+    assert deleted == [ "uuid-changed", "uuid-dropped" ]
+
+    records = main.ACTIVE_SERVICES["service"]["records"]
+    assert sorted(records) == [ "changed", "same" ]
+    assert records["changed"]["id"] == "uuid-new"
+    assert records["same"]["id"] == "uuid-same"
+
+    calls = requests_mock.call_count
+
+    assert main.handle_service_updated_event(API_KEY, API_SECRET, BASE_URL, api_client, "service") == 0
+    assert requests_mock.call_count == calls
+
+def test_service_update_releases_records_it_did_not_add(requests_mock : Mocker):
+    domain_id = "e7079f24-aeb7-4741-bd05-e005350bb5bf"
+    requests_mock.get(BIND_DOMAIN_GET, json=_domains_payload({ domain_id : { "enabled" : "1", "domainname" : "example.org" } }))
+    requests_mock.post(BIND_RECORD_SEARCHRECORD, json={ "rows" : [ ] })
+    requests_mock.post(BIND_RECORD_ADDRECORD, json={ "result" : "saved", "uuid" : "uuid-new" })
+
+    # The records were adopted, e.g. created by hand before the service was deployed
+    main.ACTIVE_SERVICES["service"] = { "id" : "service", "records" : {
+        "changed" : { "domain" : "example.org", "host" : "changed", "type" : "CNAME", "value" : "old", "domain_id" : domain_id, "id" : "uuid-changed" },
+        "dropped" : { "domain" : "example.org", "host" : "dropped", "type" : "CNAME", "value" : "ingress", "domain_id" : domain_id, "id" : "uuid-dropped" }
+    } }
+    api_client = FakeApiClient([ _service_payload("service", { "changed" : ("example.org", "changed", "CNAME", "new") }) ])
+
+    assert main.handle_service_updated_event(API_KEY, API_SECRET, BASE_URL, api_client, "service") == 3
+
+    # Both records are released, the changed mapping is backed by a new record
+    assert not any(request.url.startswith(BIND_RECORD_DELRECORD) for request in requests_mock.request_history)
+
+    records = main.ACTIVE_SERVICES["service"]["records"]
+    assert sorted(records) == [ "changed" ]
+    assert records["changed"]["id"] == "uuid-new"
+
+def test_untracked_service_update_reads_added_labels(requests_mock : Mocker):
+    domain_id = "e7079f24-aeb7-4741-bd05-e005350bb5bf"
+    requests_mock.get(BIND_DOMAIN_GET, json=_domains_payload({ domain_id : { "enabled" : "1", "domainname" : "example.org" } }))
+    requests_mock.post(BIND_RECORD_SEARCHRECORD, json={ "rows" : [ ] })
+    requests_mock.post(BIND_RECORD_ADDRECORD, json={ "result" : "saved", "uuid" : "uuid-new" })
+
+    # The service was cached without mapping labels, then updated with --label-add
+    main.list_services(FakeApiClient([ dict(_service_payload("service", { }), Version={ "Index" : 1 }) ]))
+    api_client = FakeApiClient([ dict(_service_payload("service", { "0" : ("example.org", "new", "CNAME", "ingress") }), Version={ "Index" : 2 }) ])
+
+    assert main.handle_service_updated_event(API_KEY, API_SECRET, BASE_URL, api_client, "service") == 1
+    assert api_client.inspected == [ "service" ]
+    assert [ request.url for request in requests_mock.request_history ].count(BIND_RECORD_ADDRECORD) == 1
+    assert main.ACTIVE_SERVICES["service"]["records"]["0"]["id"] == "uuid-new"
+
+def test_metrics_are_served_in_prometheus_format():
+    registry = Registry()
+    events = registry.register(Counter("events_total", "Events", labels=("action",)))
+    latency = registry.register(Histogram("latency_seconds", "Latency", buckets=(0.1, 1.0)))
+
+    events.inc(action="create")
+    events.inc(action="create")
+    latency.observe(0.5)
+
+    server = MetricsServer(0, registry=registry).start()
+    try:
+        response = requests.get("http://127.0.0.1:{}/metrics".format(server.port))
+    finally:
+        server.close()
+
+    assert response.status_code == 200
+    assert 'events_total{action="create"} 2' in response.text
+    assert 'latency_seconds_bucket{le="0.1"} 0' in response.text
+    assert 'latency_seconds_bucket{le="1.0"} 1' in response.text
+    assert 'latency_seconds_count 1' in response.text
+
+def test_labelled_gauges_read_every_value_from_their_function():
+    registry = Registry()
+    tracked = registry.register(Gauge("tracked_services", "Services", labels=("target",)))
+
+    repositories = { "fw1.example.org" : { "a" : { }, "b" : { } }, "fw2.example.org" : { "c" : { } } }
+    tracked.set_function(lambda: { (name,) : len(services) for name, services in repositories.items() })
+
+    assert 'tracked_services{target="fw1.example.org"} 2' in registry.render()
+    assert 'tracked_services{target="fw2.example.org"} 1' in registry.render()
+
+    del repositories["fw2.example.org"]
+    assert tracked.snapshot() == { "fw1.example.org" : 2 }
+
+def test_bind_api_calls_are_timed(requests_mock : Mocker):
+    requests_mock.post(url=BIND_RECORD_ADDRECORD, status_code=400, text="dah")
+
+    errors = API_ERRORS.value(endpoint="record/addRecord")
+
+    with pytest.raises(Exception):
+        main.add_record(API_KEY, API_SECRET, BASE_URL, "b78013ea-cdaf-4335-b429-7af99b2f9a12", "blog", "CNAME", "www.example.org")
+
+    assert API_ERRORS.value(endpoint="record/addRecord") == errors + 1
+    assert "record/addRecord" in API_SECONDS.snapshot()
+
+def test_retryable_errors_are_retried(requests_mock : Mocker):
+    requests_mock.post(url=BIND_SERVICE_RECONFIGURE, response_list=[
+        { "status_code" : 503, "text" : "starting" },
+        { "exc" : requests.ConnectionError("refused") },
+        { "json" : { "status" : "ok" } }
+    ])
+
+    assert main.reconfigure_bind_controller(API_KEY, API_SECRET, BASE_URL) == { "status" : "ok" }
+    assert requests_mock.call_count == 3
+
+def test_circuit_opens_while_firewall_is_down(requests_mock : Mocker):
+    requests_mock.post(url=BIND_SERVICE_RECONFIGURE, exc=requests.ConnectionError("refused"))
+
+    client = OpnBindClient(API_KEY, API_SECRET, BASE_URL, retries=1, backoff=0, breaker=CircuitBreaker(failure_threshold=2, reset_timeout=0.1))
+    closed = [ ]
+    client.breaker.on_close(lambda: closed.append(True))
+
+    with pytest.raises(BindApiError) as ex:
+        client.reconfigure()
+
+    assert ex.value.retryable
+    assert requests_mock.call_count == 2
+
+    with pytest.raises(CircuitOpenError):
+        client.reconfigure()
+
+    assert requests_mock.call_count == 2
+
+    time.sleep(0.1)
+    requests_mock.post(url=BIND_SERVICE_RECONFIGURE, json={ "status" : "ok" })
+
+    assert client.reconfigure() == { "status" : "ok" }
+    assert closed == [ True ]
+
+def test_adds_are_only_retried_if_not_sent_and_failed_trials_reopen(requests_mock : Mocker):
+    client = OpnBindClient(API_KEY, API_SECRET, BASE_URL, retries=2, backoff=0, breaker=CircuitBreaker(failure_threshold=1, reset_timeout=0.1))
+
+    # A connection reset after sending may have added the record already
+    requests_mock.post(BIND_RECORD_ADDRECORD, exc=requests.ConnectionError("reset"))
+    with pytest.raises(BindApiError):
+        client.add_record("domain", "host", "CNAME", "ingress")
+
+    assert requests_mock.call_count == 1
+
+    # A gateway timeout may follow a record the firewall added, so the records are read before sending it again
+    client = OpnBindClient(API_KEY, API_SECRET, BASE_URL, retries=2, backoff=0)
+    requests_mock.post(BIND_RECORD_ADDRECORD, [ { "status_code" : 504, "text" : "timeout" }, { "json" : { "result" : "saved", "uuid" : "duplicate-uuid" } } ])
+    requests_mock.post(BIND_RECORD_SEARCHRECORD, json={ "rows" : [ { "uuid" : "added-uuid", "name" : "host", "type" : "CNAME", "value" : "ingress" } ], "total" : 1 })
+
+    assert client.add_record("domain", "host", "CNAME", "ingress")["uuid"] == "added-uuid"
+    assert client.owns("added-uuid")
+    assert [ request.url for request in requests_mock.request_history ].count(BIND_RECORD_ADDRECORD) == 2
+
+    requests_mock.post(BIND_RECORD_ADDRECORD, [ { "status_code" : 504, "text" : "timeout" }, { "json" : { "result" : "saved", "uuid" : "new-uuid" } } ])
+    requests_mock.post(BIND_RECORD_SEARCHRECORD, json={ "rows" : [ ], "total" : 0 })
+
+    assert client.add_record("domain", "host", "CNAME", "ingress")["uuid"] == "new-uuid"
+    assert [ request.url for request in requests_mock.request_history ].count(BIND_RECORD_ADDRECORD) == 4
+
+    # A rejected request was not carried out
+    requests_mock.post(BIND_RECORD_ADDRECORD, [ { "status_code" : 429, "text" : "slow down" }, { "json" : { "result" : "saved", "uuid" : "uuid" } } ])
+    assert client.add_record("domain", "host", "CNAME", "ingress")["uuid"] == "uuid"
+
+    # A trial call broken off mid-response opens the circuit again instead of blocking it for good
+    time.sleep(0.1)
+    requests_mock.post(url=BIND_SERVICE_RECONFIGURE, exc=requests.exceptions.ChunkedEncodingError("reset"))
+    with pytest.raises(BindApiError):
+        client.reconfigure()
+
+    time.sleep(0.1)
+    requests_mock.post(url=BIND_SERVICE_RECONFIGURE, json={ "status" : "ok" })
+    assert client.reconfigure() == { "status" : "ok" }
+
+def test_event_pipeline_replays_dead_letters_in_order():
+    processed = [ ]
+    available = threading.Event()
+
+    def handler(event):
+        if not available.is_set():
+            raise BindApiError("503 - Failed to add host", 503, retryable=True)
+        processed.append(event["Action"])
+
+    dead_letters = DeadLetterQueue()
+    pipeline = EventPipeline(handler, workers=2, dead_letters=dead_letters).start()
+    pipeline.submit({ "Action" : "create", "Actor" : { "ID" : "a" } })
+    pipeline.submit({ "Action" : "update", "Actor" : { "ID" : "a" } })
+    pipeline.submit({ "Action" : "remove", "Actor" : { "ID" : "a" } })
+
+    while len(dead_letters) < 3:
+        time.sleep(0.01)
+
+    available.set()
+    pipeline.replay()
+    pipeline.close()
+
+    assert processed == [ "create", "update", "remove" ]
+    assert len(dead_letters) == 0
+
+class FakeEventStream:
+    def __init__(self, events, error=None):
+        self.events = [ json.dumps(event).encode("utf-8") for event in events ]
+        self.error = error
+        self.closed = False
+
+    def __iter__(self):
+        yield from self.events
+        if self.error:
+            raise self.error
+
+    def close(self):
+        self.closed = True
+
+def _docker_event(time_nano, action, service_id):
+    return { "Action" : action, "Actor" : { "ID" : service_id }, "timeNano" : time_nano }
+
+def test_event_stream_resumes_after_failures(tmp_path):
+    streams = [
+        FakeEventStream([ _docker_event(1000000001, "create", "a"), _docker_event(2000000002, "create", "b") ], error=requests.ConnectionError("docker restarted")),
+        FakeEventStream([ _docker_event(2000000002, "create", "b"), _docker_event(3000000003, "remove", "a") ])
+    ]
+    opened = [ ]
+
+    def open_stream(since):
+        opened.append(since)
+        return streams.pop(0)
+
+    cursor = EventCursor(str(tmp_path / "events.cursor"), save_interval=0)
+    stream = ResumableEventStream(open_stream, cursor, backoff=0)
+
+    received = [ ]
+    for event in stream:
+        received.append((event["Action"], event["Actor"]["ID"]))
+        cursor.done(event)
+        if len(received) == 3:
+            stream.close()
+
+    assert received == [ ("create", "a"), ("create", "b"), ("remove", "a") ]
+    assert opened == [ None, "2.000000002" ]
+    assert stream.duplicates == 1
+
+    restarted = EventCursor(str(tmp_path / "events.cursor"))
+
+    assert restarted.load() == 3000000003
+
+def test_cursor_is_saved_by_concurrent_workers(tmp_path):
+    cursor_path = str(tmp_path / "events.cursor")
+    cursor = EventCursor(cursor_path, save_interval=0)
+    events = [ { "timeNano" : time_nano } for time_nano in range(1, 2001) ]
+    for event in events:
+        cursor.read(event)
+
+    with ThreadPoolExecutor(8) as executor:
+        list(executor.map(cursor.done, events))
+
+    assert EventCursor(cursor_path).load() == 2000
+    assert os.listdir(tmp_path) == [ "events.cursor" ]
+
+class FakeDockerEventStream:
+    def __init__(self, events):
+        self.events = events
+        self.closed = threading.Event()
+
+    def __iter__(self):
+        yield from (json.dumps(event).encode("utf-8") for event in self.events)
+
+        # Keep the stream open like docker does
+        self.closed.wait()
+
+    def close(self):
+        self.closed.set()
+
+class FakeDockerClient:
+    def __init__(self, events):
+        self.api = FakeApiClient([ ])
+        self.events_payload = events
+
+    def events(self, since=None, filters=None):
+        return FakeDockerEventStream(self.events_payload)
+
+    def close(self):
+        pass
+
+def test_cursor_stays_behind_events_held_for_replay(requests_mock : Mocker, monkeypatch, tmp_path):
+    domain_id = "e7079f24-aeb7-4741-bd05-e005350bb5bf"
+    added = threading.Event()
+
+    def add_record(request, context):
+        if request.json()["record"]["name"] == "held":
+            context.status_code = 503
+            return { "result" : "failed" }
+
+        added.set()
+        return { "result" : "saved", "uuid" : "uuid-applied" }
+
+    requests_mock.get(BIND_DOMAIN_GET, json=_domains_payload({ domain_id : { "enabled" : "1", "domainname" : "example.org" } }))
+    requests_mock.post(BIND_RECORD_SEARCHRECORD, json={ "rows" : [ ] })
+    requests_mock.post(BIND_RECORD_ADDRECORD, json=add_record)
+    requests_mock.post(BIND_SERVICE_RECONFIGURE, json={ "status" : "ok" })
+
+    # The firewall refuses the first service, so its event is held for a replay
+    events = [
+        { "Action" : "create", "Actor" : { "ID" : name, "Attributes" : _service_payload(name, { "0" : ("example.org", name, "CNAME", "ingress") })["Spec"]["Labels"] }, "timeNano" : time_nano }
+        for name, time_nano in (("held", 1000), ("applied", 2000))
+    ]
+    docker_client = FakeDockerClient(events)
+    monkeypatch.setattr(main, "create_docker_client", lambda docker_url: docker_client)
+
+    def stop_when_applied():
+        added.wait(10.0)
+        time.sleep(0.2)
+        os.kill(os.getpid(), signal.SIGTERM)
+
+    threading.Thread(target=stop_when_applied, daemon=True).start()
+    cursor_path = str(tmp_path / "events.cursor")
+    main.process_docker_events(API_KEY, API_SECRET, BASE_URL, "unix://fake", reconfigure_delay=0.05, reconfigure_max_delay=0.1, workers=2, cursor_path=cursor_path)
+
+    assert main.ACTIVE_SERVICES["applied"]["records"]["0"]["id"] == "uuid-applied"
+    assert "held" not in main.ACTIVE_SERVICES
+    assert EventCursor(cursor_path).load() == 999
+
+def test_stop_during_catch_up_releases_held_events(monkeypatch, tmp_path):
+    listing = threading.Event()
+    caught_up = threading.Event()
+
+    class SlowApiClient(FakeApiClient):
+        def services(self, filters=None):
+            listing.set()
+            caught_up.wait(10.0)
+            return self.services_payload
+
+    docker_client = FakeDockerClient([ _docker_event(1000, "create", "held") ])
+    docker_client.api = SlowApiClient([ ])
+    monkeypatch.setattr(main, "create_docker_client", lambda docker_url: docker_client)
+
+    def stop_while_catching_up():
+        listing.wait(10.0)
+        time.sleep(0.2)
+        os.kill(os.getpid(), signal.SIGTERM)
+
+    threading.Thread(target=stop_while_catching_up, daemon=True).start()
+    elector = LeaderElector(FileLeaseBackend(str(tmp_path / "lease.json")), owner="a", ttl=10.0)
+    started = time.monotonic()
+    try:
+        main.process_docker_events(API_KEY, API_SECRET, BASE_URL, "unix://fake", reconfigure_delay=0.05, reconfigure_max_delay=0.1, workers=2, elector=elector)
+    finally:
+        caught_up.set()
+
+    # The held event is not applied, so it is read again after a restart
+    assert time.monotonic() - started < 5.0
+    assert "held" not in main.ACTIVE_SERVICES
+
+def test_event_cursor_only_advances_past_processed_events():
+    cursor = EventCursor()
+    first = _docker_event(100, "create", "a")
+    second = _docker_event(200, "create", "b")
+
+    cursor.read(first)
+    cursor.read(second)
+    cursor.done(second)
+
+    assert cursor.processed() == 99
+
+    cursor.done(first)
+
+    assert cursor.processed() == 200
+
+def test_read_manifest_formats():
+    csv_manifest = io.StringIO("domain,name,type,value,state\nexample.org,www,CNAME,ingress,\nexample.org,old,CNAME,,absent\n")
+    json_manifest = io.StringIO(json.dumps({ "records" : [
+        { "domain" : "example.org", "name" : "www", "type" : "CNAME", "value" : "ingress" },
+        { "domain" : "example.org", "name" : "old", "type" : "CNAME", "state" : "absent" }
+    ] }))
+
+    expected = [
+        { "domain" : "example.org", "name" : "www", "type" : "CNAME", "value" : "ingress", "state" : "present" },
+        { "domain" : "example.org", "name" : "old", "type" : "CNAME", "state" : "absent" }
+    ]
+
+    assert read_manifest(csv_manifest, "csv") == expected
+    assert read_manifest(json_manifest, "json") == expected
+
+    with pytest.raises(ValueError, match="missing value"):
+        read_manifest(io.StringIO(json.dumps([ { "domain" : "example.org", "name" : "www", "type" : "A" } ])), "json")
+
+def test_apply_manifest_applies_only_the_difference(requests_mock : Mocker):
+    domain_id = "e7079f24-aeb7-4741-bd05-e005350bb5bf"
+
+    requests_mock.get(BIND_DOMAIN_GET, json=_domains_payload({ domain_id : { "enabled" : "1", "domainname" : "example.org" } }))
+    requests_mock.post(BIND_RECORD_SEARCHRECORD, json={
+        "rows" : [
+            { "uuid" : "uuid-www", "name" : "www", "type" : "CNAME", "value" : "ingress" },
+            { "uuid" : "uuid-api", "name" : "api", "type" : "CNAME", "value" : "old-ingress" },
+            { "uuid" : "uuid-rr-1", "name" : "rr", "type" : "A", "value" : "10.0.0.1" },
+            { "uuid" : "uuid-gone", "name" : "gone", "type" : "A", "value" : "10.0.0.9" }
+        ],
+        "total" : 4
+    })
+    add_record = requests_mock.post(BIND_RECORD_ADDRECORD, json={ "result" : "saved", "uuid" : "new-uuid" })
+    del_record = requests_mock.post(re.compile(BIND_RECORD_DELRECORD + "/.*"), json={ "result" : "deleted" })
+    reconfigure = requests_mock.post(BIND_SERVICE_RECONFIGURE, json={ "status" : "ok" })
+
+    records = [
+        { "domain" : "example.org", "name" : "www", "type" : "CNAME", "value" : "ingress", "state" : "present" },
+        { "domain" : "example.org", "name" : "api", "type" : "CNAME", "value" : "ingress", "state" : "present" },
+        { "domain" : "example.org", "name" : "rr", "type" : "A", "value" : "10.0.0.1", "state" : "present" },
+        { "domain" : "example.org", "name" : "rr", "type" : "A", "value" : "10.0.0.2", "state" : "present" },
+        { "domain" : "example.org", "name" : "gone", "type" : "A", "state" : "absent" },
+        { "domain" : "unknown.org", "name" : "www", "type" : "A", "value" : "10.0.0.3", "state" : "present" }
+    ]
+
+    result = main.apply_manifest(API_KEY, API_SECRET, BASE_URL, records)
+
+    assert result == { "added" : 2, "removed" : 2, "unchanged" : 2, "failed" : 1 }
+    assert sorted(request.url.rsplit("/", 1)[1] for request in del_record.request_history) == [ "uuid-api", "uuid-gone" ]
+    assert sorted((request.json()["record"]["name"], request.json()["record"]["value"]) for request in add_record.request_history) == [ ("api", "ingress"), ("rr", "10.0.0.2") ]
+    assert reconfigure.call_count == 1
+
+def test_mapping_cache_parses_labels_once_per_version():
+    cache = MappingCache(size=2)
+    service_payload = _service_payload("a", { "0" : ("example.org", "host", "CNAME", "ingress") })
+    service_payload["Version"] = { "Index" : 7 }
+
+    host_records = cache.parse(service_payload)
+    host_records["0"]["id"] = "uuid"
+
+    assert cache.parse(service_payload) == { "0" : { "domain" : "example.org", "host" : "host", "type" : "CNAME", "value" : "ingress" } }
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    service_payload["Version"] = { "Index" : 8 }
+    service_payload["Spec"]["Labels"]["com.aixo.cloud.ingress.mappings.0.host"] = "other"
+
+    assert cache.parse(service_payload)["0"]["host"] == "other"
+    assert cache.misses == 2
+
+    cache.put("b", 1, { })
+    cache.put("c", 1, { })
+
+    assert "a" not in cache
+    assert cache.get("c") == { }
+
+def test_created_event_skips_inspect_with_attributes_and_duplicates(requests_mock : Mocker):
+    domain_id = "e7079f24-aeb7-4741-bd05-e005350bb5bf"
+    requests_mock.get(BIND_DOMAIN_GET, json=_domains_payload({ domain_id : { "enabled" : "1", "domainname" : "example.org" } }))
+    requests_mock.post(BIND_RECORD_SEARCHRECORD, json={ "rows" : [ ] })
+    requests_mock.post(BIND_RECORD_ADDRECORD, json={ "result" : "saved", "uuid" : "uuid-new" })
+
+    service_payload = _service_payload("a", { "0" : ("example.org", "host", "CNAME", "ingress") })
+    service_payload["Version"] = { "Index" : 7 }
+    api_client = FakeApiClient([ service_payload, _service_payload("b", { }) ])
+
+    main.handle_service_created_event(API_KEY, API_SECRET, BASE_URL, api_client, "a")
+    main.handle_service_created_event(API_KEY, API_SECRET, BASE_URL, api_client, "a")
+
+    attributes = dict(_service_payload("b", { "0" : ("example.org", "other", "CNAME", "ingress") })["Spec"]["Labels"], name="b")
+    main.handle_service_created_event(API_KEY, API_SECRET, BASE_URL, api_client, "b", attributes)
+
+    assert api_client.inspected == [ "a" ]
+    assert main.ACTIVE_SERVICES["a"]["records"]["0"]["id"] == "uuid-new"
+    assert main.ACTIVE_SERVICES["b"]["records"]["0"]["host"] == "other"
+
+def test_parse_targets_shares_or_pairs_credentials():
+    targets = parse_targets("https://fw1.example.org, https://fw2.example.org:8443", "key", "secret")
+
+    assert [ (target.api_key, target.api_secret, target.name) for target in targets ] == [ ("key", "secret", "fw1.example.org"), ("key", "secret", "fw2.example.org_8443") ]
+
+    targets = parse_targets("https://fw1.example.org,https://fw2.example.org", "key1,key2", "secret1,secret2")
+    assert [ target.api_key for target in targets ] == [ "key1", "key2" ]
+
+    with pytest.raises(ValueError):
+        parse_targets("https://fw1.example.org,https://fw2.example.org,https://fw3.example.org", "key1,key2", "secret")
+
+def test_fan_out_tracks_results_per_target():
+    targets = parse_targets("https://fw1.example.org,https://fw2.example.org", "key", "secret")
+
+    def call(target):
+        if target.name == "fw2.example.org":
+            raise BindApiError("503 - Failed to reconfigure", 503, retryable=True)
+        return { "status" : "ok" }
+
+    results = fan_out(targets, call)
+
+    assert results["fw1.example.org"] == { "status" : "ok" }
+    assert isinstance(results["fw2.example.org"], BindApiError)
+
+def test_event_fanout_does_not_wait_for_slow_consumers():
+    raw_events = [ json.dumps({ "Action" : "create", "Actor" : { "ID" : str(index) } }) for index in range(20) ]
+    read = [ ]
+
+    fanout = EventFanOut(raw_events, 2, on_event=read.append).start()
+    fast, slow = fanout.streams
+
+    assert [ event["Actor"]["ID"] for event in fast ] == [ str(index) for index in range(20) ]
+    assert fanout.lag() == [ 0, 21 ]
+    assert len(read) == 20
+    assert len(list(slow)) == 20
+
+def test_lease_backends_must_implement_every_method():
+    class AcquireOnly(LeaseBackend):
+        def acquire(self, owner, ttl):
+            return True
+
+    with pytest.raises(TypeError):
+        AcquireOnly()
+
+def test_file_lease_elects_one_leader_and_fails_over(tmp_path):
+    backend = FileLeaseBackend(str(tmp_path / "leader.lease"))
+    changes = [ ]
+
+    first = LeaderElector(backend, owner="first", ttl=60.0)
+    second = LeaderElector(backend, owner="second", ttl=60.0)
+    second.on_elected(lambda: changes.append("second elected"))
+
+    first.step()
+    second.step()
+
+    assert first.is_leader() and not second.is_leader()
+    assert backend.holder() == "first"
+
+    # A released lease is taken over at once
+    first.close()
+    second.step()
+
+    assert second.is_leader()
+    assert changes == [ "second elected" ]
+
+    # An expired lease is taken over without its holder
+    assert backend.acquire("second", -1.0)
+    assert backend.acquire("third", 60.0)
+
+    second.on_demoted(lambda: changes.append("second demoted"))
+    second.step()
+
+    assert not second.is_leader()
+    assert changes == [ "second elected", "second demoted" ]
+
+def test_standby_observes_events_without_changing_records(requests_mock : Mocker):
+    service_payload = _service_payload("a", { "0" : ("example.org", "host", "CNAME", "ingress") })
+    service_payload["Version"] = { "Index" : 3 }
+    api_client = FakeApiClient([ service_payload ])
+
+    main.observe_docker_event(api_client, _docker_event(1, "create", "a"))
+    main.observe_docker_event(api_client, _docker_event(2, "update", "a"))
+
+    assert main.SERVICE_MAPPINGS.get("a", 3)["0"]["host"] == "host"
+    assert main.SERVICE_MAPPINGS.domains() == { "example.org" }
+    assert len(main.ACTIVE_SERVICES) == 0
+    assert requests_mock.call_count == 0
+
+    main.observe_docker_event(api_client, _docker_event(3, "remove", "a"))
+    assert "a" not in main.SERVICE_MAPPINGS
+
+def test_plan_against_snapshot_and_exported_specs_sends_nothing(requests_mock : Mocker):
+    domain_id = "e7079f24-aeb7-4741-bd05-e005350bb5bf"
+    snapshot = {
+        "domains" : { domain_id : { "enabled" : "1", "domainname" : "example.org" } },
+        "records" : [
+            { "uuid" : "existing-uuid", "domain" : domain_id, "name" : "existing", "type" : "CNAME", "value" : "ingress" },
+            { "uuid" : "stale-uuid", "domain" : domain_id, "name" : "stale", "type" : "CNAME", "value" : "ingress" }
+        ]
+    }
+
+    main.close_clients()
+    client = main.get_client(API_KEY, API_SECRET, BASE_URL, client_class=DryRunClient, snapshot=snapshot)
+
+    api_client = read_service_specs(io.StringIO(json.dumps([
+        _service_payload("existing-service", { "0" : ("example.org", "existing", "CNAME", "ingress") }),
+        _service_payload("new-service", { "0" : ("example.org", "new", "CNAME", "ingress") })
+    ])))
+    main.ACTIVE_SERVICES["stale-service"] = { "id" : "stale-service", "records" : { "0" : { "id" : "stale-uuid" } } }
+    client.owned["stale-uuid"] = { "domain_id" : domain_id, "name" : "stale", "type" : "CNAME" }
+
+    summary = main.reconcile(API_KEY, API_SECRET, BASE_URL, api_client)
+
+    assert summary == { "services" : 2, "added" : 1, "adopted" : 1, "removed" : 1, "failed" : 0 }
+    assert requests_mock.call_count == 0
+
+    # Additions and removals are planned concurrently
+    changes = sorted(client.changes.to_json(), key=lambda change: change["action"])
+    assert changes == [
+        { "action" : "add", "domain" : "example.org", "name" : "new", "type" : "CNAME", "value" : "ingress" },
+        { "action" : "reconfigure" },
+        { "action" : "remove", "id" : "stale-uuid", "domain" : "example.org", "name" : "stale", "type" : "CNAME" }
+    ]
+    assert format_changes(changes).splitlines() == [
+        "+ CNAME new.example.org -> ingress",
+        "~ reconfigure bind",
+        "- CNAME stale.example.org (stale-uuid)"
+    ]
+
+def test_plan_against_snapshot_needs_no_credentials(requests_mock : Mocker, monkeypatch, tmp_path, capsys):
+    domain_id = "e7079f24-aeb7-4741-bd05-e005350bb5bf"
+    snapshot_path = tmp_path / "firewalls.json"
+    snapshot_path.write_text(json.dumps({ "opnsense.example.org" : { "domains" : { domain_id : { "enabled" : "1", "domainname" : "example.org" } }, "records" : [ ] } }))
+    specs_path = tmp_path / "services.json"
+    specs_path.write_text(json.dumps([ _service_payload("new-service", { "0" : ("example.org", "new", "CNAME", "ingress") }) ]))
+
+    monkeypatch.setenv(main.CONFIG_API_GW_URL, "https://opnsense.example.org")
+    monkeypatch.delenv(main.CONFIG_API_KEY, raising=False)
+    monkeypatch.delenv(main.CONFIG_API_SECRET, raising=False)
+    monkeypatch.delenv(main.CONFIG_STATE_PATH, raising=False)
+    monkeypatch.setattr("sys.argv", [ "swarm_opn_bind_updater", "plan", str(specs_path), "--snapshot", str(snapshot_path) ])
+
+    main.main()
+
+    assert requests_mock.call_count == 0
+    assert "+ CNAME new.example.org -> ingress" in capsys.readouterr().out
+
+def test_plan_leaves_the_state_untouched(requests_mock : Mocker, monkeypatch, tmp_path):
+    domain_id = "e7079f24-aeb7-4741-bd05-e005350bb5bf"
+    snapshot_path = tmp_path / "firewalls.json"
+    snapshot_path.write_text(json.dumps({ "opnsense.example.org" : { "domains" : { domain_id : { "enabled" : "1", "domainname" : "example.org" } }, "records" : [ ] } }))
+    specs_path = tmp_path / "services.json"
+    specs_path.write_text(json.dumps([ _service_payload("new-service", { "0" : ("example.org", "new", "CNAME", "ingress") }) ]))
+
+    # The journal of a running daemon ends with an entry it is still writing
+    state_path = tmp_path / "state"
+    state_path.mkdir()
+    (state_path / "state.snapshot.json").write_text(json.dumps({ "stale-service" : { "id" : "stale-service", "records" : { } } }))
+    (state_path / "state.journal").write_bytes(b'{"op":"delete","id":"stale-service"}\n{"op":"put","id":"new-')
+    before = { path.name : path.read_bytes() for path in state_path.iterdir() }
+
+    monkeypatch.setenv(main.CONFIG_API_GW_URL, "https://opnsense.example.org")
+    monkeypatch.setenv(main.CONFIG_STATE_PATH, str(state_path))
+    monkeypatch.setattr("sys.argv", [ "swarm_opn_bind_updater", "plan", str(specs_path), "--snapshot", str(snapshot_path) ])
+
+    main.main()
+
+    assert { path.name : path.read_bytes() for path in state_path.iterdir() } == before
+
+def test_drift_auditor_reports_and_fixes_drift(requests_mock : Mocker):
+    domain_id = "e7079f24-aeb7-4741-bd05-e005350bb5bf"
+    requests_mock.get(BIND_DOMAIN_GET, json=_domains_payload({ domain_id : { "enabled" : "1", "domainname" : "example.org" } }))
+    requests_mock.post(BIND_RECORD_SEARCHRECORD, json={
+        "rows" : [
+            { "uuid" : "ok-uuid", "enabled" : "1", "name" : "ok", "type" : "CNAME", "value" : "ingress" },
+            { "uuid" : "edited-uuid", "enabled" : "1", "name" : "edited", "type" : "CNAME", "value" : "elsewhere" },
+            { "uuid" : "disabled-uuid", "enabled" : "0", "name" : "disabled", "type" : "CNAME", "value" : "ingress" },
+            { "uuid" : "orphan-uuid", "enabled" : "1", "name" : "orphan", "type" : "CNAME", "value" : "ingress" },
+            { "uuid" : "manual-uuid", "enabled" : "1", "name" : "manual", "type" : "CNAME", "value" : "elsewhere" }
+        ],
+        "total" : 5
+    })
+    requests_mock.post(re.compile(BIND_RECORD_DELRECORD), json={ "result" : "deleted" })
+    requests_mock.post(BIND_RECORD_ADDRECORD, json={ "result" : "saved", "uuid" : "fixed-uuid" })
+
+    names = [ "ok", "edited", "disabled", "deleted", "manual" ]
+    api_client = FakeApiClient([ _service_payload(name, { "0" : ("example.org", name, "CNAME", "ingress") }) for name in names ])
+    client = main.get_client(API_KEY, API_SECRET, BASE_URL)
+    for name in names + [ "orphan" ]:
+        main.ACTIVE_SERVICES[name] = { "id" : name, "records" : { "0" : { "domain" : "example.org", "host" : name, "type" : "CNAME", "value" : "ingress", "id" : name + "-uuid" } } }
+
+        # The manual record was adopted, not added by the updater
+        if name != "manual":
+            client.owned[name + "-uuid"] = { "domain_id" : domain_id, "name" : name, "type" : "CNAME" }
+
+    reconfigures = [ ]
+    auditor = DriftAuditor("example.org", client, api_client, main.ACTIVE_SERVICES, rate=1000.0, reconfigure=lambda: reconfigures.append(True))
+
+    drifts = auditor.audit()
+
+    assert sorted((drift["service"], drift["kind"]) for drift in drifts) == [ ("deleted", "missing"), ("disabled", "disabled"), ("edited", "changed"), ("manual", "changed"), ("orphan", "orphaned") ]
+    assert not any(request.url.startswith((BIND_RECORD_DELRECORD, BIND_RECORD_ADDRECORD)) for request in requests_mock.request_history)
+    assert reconfigures == [ ]
+
+    auditor.fix = True
+    auditor.audit()
+
+    deleted = sorted(request.url.rsplit("/", 1)[1] for request in requests_mock.request_history if request.url.startswith(BIND_RECORD_DELRECORD))
+    assert deleted == [ "disabled-uuid", "edited-uuid", "orphan-uuid" ]
+    assert [ request.url for request in requests_mock.request_history ].count(BIND_RECORD_ADDRECORD) == 3
+    assert reconfigures == [ True ]
+
+    assert main.ACTIVE_SERVICES["ok"]["records"]["0"]["id"] == "ok-uuid"
+    assert all(main.ACTIVE_SERVICES[name]["records"]["0"]["id"] == "fixed-uuid" for name in ("edited", "disabled", "deleted"))
+    assert main.ACTIVE_SERVICES["manual"]["records"]["0"]["id"] == "manual-uuid"
+    assert "orphan" not in main.ACTIVE_SERVICES
+
+def test_drift_auditor_paces_every_request(requests_mock : Mocker):
+    domain_id = "e7079f24-aeb7-4741-bd05-e005350bb5bf"
+    sent = [ ]
+
+    def respond(payload):
+        def handler(request, context):
+            sent.append(time.monotonic())
+            return payload
+        return handler
+
+    requests_mock.get(BIND_DOMAIN_GET, json=respond(_domains_payload({ domain_id : { "enabled" : "1", "domainname" : "example.org" } })))
+    requests_mock.post(BIND_RECORD_SEARCHRECORD, json=respond({ "rows" : [ ], "total" : 0 }))
+    requests_mock.post(BIND_RECORD_ADDRECORD, json=respond({ "result" : "saved", "uuid" : "fixed-uuid" }))
+
+    api_client = FakeApiClient([ _service_payload("deleted", { "0" : ("example.org", "deleted", "CNAME", "ingress") }) ])
+    client = main.get_client(API_KEY, API_SECRET, BASE_URL)
+    main.ACTIVE_SERVICES["deleted"] = { "id" : "deleted", "records" : { "0" : { "domain" : "example.org", "host" : "deleted", "type" : "CNAME", "value" : "ingress", "id" : "deleted-uuid" } } }
+
+    rate = 20.0
+    auditor = DriftAuditor("example.org", client, api_client, main.ACTIVE_SERVICES, fix=True, rate=rate, reconfigure=lambda: None)
+    auditor.audit()
+
+    # Reading the domains and records and re-adding the record, each request waits for its own slot
+    assert len(sent) >= 3
+    assert min(later - earlier for earlier, later in zip(sent, sent[1:])) >= 0.9 / rate
+
+def test_drift_fix_waits_for_the_event_of_its_service(requests_mock : Mocker):
+    domain_id = "e7079f24-aeb7-4741-bd05-e005350bb5bf"
+    requests_mock.get(BIND_DOMAIN_GET, json=_domains_payload({ domain_id : { "enabled" : "1", "domainname" : "example.org" } }))
+    requests_mock.post(BIND_RECORD_SEARCHRECORD, json={ "rows" : [ ], "total" : 0 })
+    requests_mock.post(BIND_RECORD_ADDRECORD, json={ "result" : "saved", "uuid" : "fixed-uuid" })
+
+    api_client = FakeApiClient([ _service_payload("a", { "0" : ("example.org", "a", "CNAME", "ingress") }) ])
+    client = main.get_client(API_KEY, API_SECRET, BASE_URL)
+    main.ACTIVE_SERVICES["a"] = { "id" : "a", "records" : { "0" : { "domain" : "example.org", "host" : "a", "type" : "CNAME", "value" : "ingress", "id" : "deleted-uuid" } } }
+
+    handling = threading.Event()
+    released = threading.Event()
+
+    def handler(event):
+        handling.set()
+        released.wait(10.0)
+        main.ACTIVE_SERVICES["a"] = { "id" : "a", "records" : { "0" : dict(main.ACTIVE_SERVICES["a"]["records"]["0"], id="event-uuid") } }
+
+    pipeline = EventPipeline(handler, workers=2).start()
+    pipeline.submit(_docker_event(1, "update", "a"))
+    handling.wait(10.0)
+
+    auditor = DriftAuditor("example.org", client, api_client, main.ACTIVE_SERVICES, fix=True, rate=1000.0, reconfigure=lambda: None, ordered=pipeline.ordered)
+    audit = threading.Thread(target=auditor.audit)
+    audit.start()
+    time.sleep(0.2)
+
+    # The fix waits for the event, then finds the record changed meanwhile
+    assert audit.is_alive()
+    released.set()
+    audit.join(10.0)
+    pipeline.close()
+
+    assert main.ACTIVE_SERVICES["a"]["records"]["0"]["id"] == "event-uuid"
+    assert BIND_RECORD_ADDRECORD not in [ request.url for request in requests_mock.request_history ]
+
+def test_only_records_added_by_the_updater_are_removed(requests_mock : Mocker):
+    domain_id = "e7079f24-aeb7-4741-bd05-e005350bb5bf"
+    records = { "manual-uuid" : { "domain" : domain_id, "name" : "manual", "type" : "CNAME", "value" : "ingress" } }
+    uuids = itertools.count()
+
+    def add_record(request, context):
+        uuid = "uuid-{}".format(next(uuids))
+        records[uuid] = request.json()["record"]
+        return { "result" : "saved", "uuid" : uuid }
+
+    def del_record(request, context):
+        uuid = request.path.rsplit("/", 1)[1]
+        return { "result" : "deleted" if records.pop(uuid, None) else "not found" }
+
+    requests_mock.get(BIND_DOMAIN_GET, json=_domains_payload({ domain_id : { "enabled" : "1", "domainname" : "example.org" } }))
+    requests_mock.post(BIND_RECORD_ADDRECORD, json=add_record)
+    requests_mock.post(re.compile(BIND_RECORD_DELRECORD + "/.*"), json=del_record)
+    requests_mock.post(BIND_RECORD_SEARCHRECORD, json=lambda request, context: { "rows" : [ dict(record, uuid=uuid) for uuid, record in records.items() ], "total" : len(records) })
+    requests_mock.post(BIND_SERVICE_RECONFIGURE, json={ "status" : "ok" })
+
+    api_client = FakeApiClient([ _service_payload("a", { "0" : ("example.org", "manual", "CNAME", "ingress"), "1" : ("example.org", "added", "CNAME", "ingress") }) ])
+    client = main.get_client(API_KEY, API_SECRET, BASE_URL)
+
+    # The manual record is adopted, but never removed
+    main.handle_service_created_event(API_KEY, API_SECRET, BASE_URL, api_client, "a")
+    assert main.ACTIVE_SERVICES["a"]["records"]["0"]["id"] == "manual-uuid"
+    assert list(client.owned) == [ "uuid-0" ]
+    assert [ row["name"] for row in client.list_owned_records(domain_id) ] == [ "added" ]
+
+    main.service_removed(API_KEY, API_SECRET, BASE_URL, "a")
+    assert list(records) == [ "manual-uuid" ]
+    assert client.owned == { }
+
+    # A record added but never tracked, e.g. after a crash, is cleaned up by the reconciliation
+    client.add_record(domain_id, "leaked", "CNAME", "ingress")
+    summary = main.reconcile(API_KEY, API_SECRET, BASE_URL, FakeApiClient([ ]))
+
+    assert summary["removed"] == 1
+    assert list(records) == [ "manual-uuid" ]
+
+def test_processed_events_are_logged_as_json_lines(requests_mock : Mocker, caplog):
+    domain_id = "e7079f24-aeb7-4741-bd05-e005350bb5bf"
+    requests_mock.get(BIND_DOMAIN_GET, json=_domains_payload({ domain_id : { "enabled" : "1", "domainname" : "example.org" } }))
+    requests_mock.post(BIND_RECORD_SEARCHRECORD, json={ "rows" : [ ] })
+    requests_mock.post(BIND_RECORD_ADDRECORD, json={ "result" : "saved", "uuid" : "uuid-new" })
+    requests_mock.post(BIND_SERVICE_RECONFIGURE, json={ "status" : "ok" })
+
+    api_client = FakeApiClient([ _service_payload("a", { "0" : ("example.org", "host", "CNAME", "ingress") }) ])
+    scheduler = ReconfigureScheduler(lambda: main.reconfigure_bind_controller(API_KEY, API_SECRET, BASE_URL))
+    caplog.set_level(logging.INFO, logger="src.swarm_opn_bind_updater.eventlog")
+
+    with trace_event("create", "a", "example.org") as trace:
+        main.handle_docker_event(API_KEY, API_SECRET, BASE_URL, api_client, scheduler, _docker_event(None, "create", "a"))
+    scheduler.flush()
+
+    formatter = JsonFormatter()
+    event, reconfigure = [ json.loads(formatter.format(record)) for record in caplog.records if record.name.endswith(".eventlog") ]
+
+    # Domains, records of the domain and the new record
+    assert event["correlation_id"] == trace.correlation_id
+    assert (event["action"], event["service"], event["target"], event["result"], event["api_calls"]) == ("create", "a", "example.org", "applied", 3)
+    assert event["records"] == [ { "change" : "added", "type" : "CNAME", "host" : "host", "domain" : "example.org", "id" : "uuid-new" } ]
+    assert sorted(event["stages_ms"]) == [ "add", "inspect", "lookup" ]
+
+    assert reconfigure["stage"] == "reconfigure"
+    assert reconfigure["correlation_ids"] == [ trace.correlation_id ]
+
+def test_event_has_one_correlation_id_on_all_firewalls(requests_mock : Mocker, monkeypatch, caplog):
+    domain_id = "e7079f24-aeb7-4741-bd05-e005350bb5bf"
+    added = threading.Semaphore(0)
+
+    def add_record(request, context):
+        added.release()
+        return { "result" : "saved", "uuid" : "uuid-new" }
+
+    requests_mock.get(re.compile(r"https://[^/]+/api/bind/domain/get"), json=_domains_payload({ domain_id : { "enabled" : "1", "domainname" : "example.org" } }))
+    requests_mock.post(re.compile(r"https://[^/]+/api/bind/record/searchRecord"), json={ "rows" : [ ] })
+    requests_mock.post(re.compile(r"https://[^/]+/api/bind/record/addRecord"), json=add_record)
+    requests_mock.post(re.compile(r"https://[^/]+/api/bind/service/reconfigure"), json={ "status" : "ok" })
+
+    service_payload = _service_payload("a", { "0" : ("example.org", "host", "CNAME", "ingress") })
+    docker_client = FakeDockerClient([ { "Action" : "create", "Actor" : { "ID" : "a", "Attributes" : service_payload["Spec"]["Labels"] }, "timeNano" : 1000 } ])
+    monkeypatch.setattr(main, "create_docker_client", lambda docker_url: docker_client)
+    caplog.set_level(logging.INFO, logger="src.swarm_opn_bind_updater.eventlog")
+
+    def stop_when_applied():
+        for _ in range(2):
+            added.acquire(timeout=10.0)
+        time.sleep(0.2)
+        os.kill(os.getpid(), signal.SIGTERM)
+
+    threading.Thread(target=stop_when_applied, daemon=True).start()
+    targets = [ Target(API_KEY, API_SECRET, BASE_URL), Target(API_KEY, API_SECRET, "https://second.example.org") ]
+    main.process_docker_events(API_KEY, API_SECRET, BASE_URL, "unix://fake", reconfigure_delay=0.05, reconfigure_max_delay=0.1, workers=2, targets=targets)
+
+    traces = [ record.event for record in caplog.records if hasattr(record, "event") ]
+    assert sorted(trace.target for trace in traces) == [ "example.org", "second.example.org" ]
+    assert len({ trace.correlation_id for trace in traces }) == 1
+
+def test_service_cache_is_warmed_once_and_recovers_removed_services(requests_mock : Mocker):
+    domain_id = "e7079f24-aeb7-4741-bd05-e005350bb5bf"
+    requests_mock.get(BIND_DOMAIN_GET, json=_domains_payload({ domain_id : { "enabled" : "1", "domainname" : "example.org" } }))
+    requests_mock.post(BIND_RECORD_SEARCHRECORD, json={ "rows" : [ { "uuid" : "uuid-b", "domain" : domain_id, "name" : "b", "type" : "CNAME", "value" : "ingress" } ], "total" : 1 })
+    requests_mock.post(BIND_RECORD_ADDRECORD, json={ "result" : "saved", "uuid" : "uuid-a" })
+    requests_mock.post("".join([BIND_RECORD_DELRECORD, "/uuid-b"]), json={ "result" : "deleted" })
+
+    service_payloads = [ _service_payload(service_id, { "0" : ("example.org", service_id, "CNAME", "ingress") }) for service_id in ("a", "b") ]
+    for index, service_payload in enumerate(service_payloads):
+        service_payload["Version"] = { "Index" : index }
+    api_client = FakeApiClient(service_payloads)
+
+    # One listing serves the create event without an inspect
+    service_specs = main.list_services(api_client)
+    assert sorted(service_id for service_id in ("a", "b") if service_id in main.SERVICE_MAPPINGS) == [ "a", "b" ]
+
+    main.handle_service_created_event(API_KEY, API_SECRET, BASE_URL, api_client, "a")
+    assert api_client.inspected == [ ]
+    assert main.ACTIVE_SERVICES["a"]["records"]["0"]["id"] == "uuid-a"
+    assert len(service_specs.services()) == 2
+
+    # The records of a service added by the updater, but never tracked, are recovered from its labels
+    client = main.get_client(API_KEY, API_SECRET, BASE_URL)
+    client.owned["uuid-b"] = { "domain_id" : domain_id, "name" : "b", "type" : "CNAME" }
+
+    main.service_removed(API_KEY, API_SECRET, BASE_URL, "b")
+    assert requests_mock.request_history[-1].path.endswith("/uuid-b")
+    assert "b" not in main.ACTIVE_SERVICES
+    assert client.owned == { "uuid-a" : { "domain_id" : domain_id, "name" : "a", "type" : "CNAME" } }